@@ -0,0 +1,45 @@
+# Сравнение кодеков тела пакета на сообщении пользователя с зашифрованным текстом.
+# Для каждого доступного кодека: размер пакета и время кодирования + разбора одного пакета, мкс.
+# В JSON шифротекст передаётся строкой base64, в msgpack - байтами.
+#
+# Запуск из каталога BasicsOfNetworkProgramming:
+#     python -m benchmarks.codecs --calls 50000 --size 256
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.variables import *
+from common.utils import encode_message, MessageDecoder, CODECS
+
+
+def measure(codec, message, calls):
+    decoder = MessageDecoder(framed=True, codec=codec)
+    start = time.perf_counter()
+    for i in range(calls):
+        decoder.feed(encode_message(message, True, codec))
+        decoder.next_message()
+    return (time.perf_counter() - start) / calls * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение кодеков')
+    parser.add_argument('--calls', type=int, default=50000)
+    parser.add_argument('--size', type=int, default=256, help='размер шифротекста, байт (RSA-2048 - 256)')
+    args = parser.parse_args()
+
+    message = {ACTION: MESSAGE, SENDER: 'test1', DESTINATION: 'test2', TIME: time.time(),
+               MESSAGE_TEXT: os.urandom(args.size), REQUEST_ID: 12345}
+    results = dict()
+    for name, codec in CODECS.items():
+        results[name] = {
+            'packet_bytes': len(encode_message(message, True, codec)),
+            'encode_decode_us': round(measure(codec, message, args.calls), 3),
+        }
+    print(json.dumps({'calls': args.calls, 'ciphertext_bytes': args.size, 'codecs': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Микробенчмарк накладных расходов декоратора log на пути отправки/приёма пакета.
+# Один цикл - send_message + get_message через пару сокетов. Сравниваются: функции без декоратора,
+# log с выключенной трассировкой, log при уровне логгера выше DEBUG, log с трассировкой
+# (обработчик NullHandler - без записи на диск) и прежняя реализация на inspect.stack().
+# Результат - JSON с временем цикла и накладными расходами на вызов, мкс.
+#
+# Запуск из каталога BasicsOfNetworkProgramming:
+#     python -m benchmarks.decos --calls 20000
+import argparse
+import functools
+import inspect
+import json
+import logging
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.variables import *
+from common import decos
+from common.utils import send_message, get_message, MessageDecoder
+
+
+def legacy_log(func):
+    # Прежний вариант декоратора: стек и аргументы разбираются при каждом вызове
+    @functools.wraps(func)
+    def logger_save(*args, **kwargs):
+        logger = logging.getLogger('server' if 'server.py' in sys.argv[0] else 'client')
+        logger.debug(f'Вызвана функция {func.__name__} с параметрами {args}, {kwargs} из модуля {func.__module__}\n'
+                     f'Вызов из функции {inspect.stack()[1][3]}')
+        return func(*args, **kwargs)
+
+    return logger_save
+
+
+def measure(send, recv, calls):
+    # Среднее время одного цикла отправки и приёма, мкс
+    server_sock, client_sock = socket.socketpair()
+    decoder = MessageDecoder(framed=True)
+    message = {ACTION: MESSAGE, SENDER: 'test1', DESTINATION: 'test2', TIME: 1.1, MESSAGE_TEXT: 'x' * 64}
+    start = time.perf_counter()
+    for i in range(calls):
+        send(server_sock, message, True)
+        recv(client_sock, decoder)
+    elapsed = time.perf_counter() - start
+    server_sock.close()
+    client_sock.close()
+    return elapsed / calls * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Накладные расходы декоратора log')
+    parser.add_argument('--calls', type=int, default=20000)
+    args = parser.parse_args()
+
+    plain_send, plain_recv = send_message.__wrapped__, get_message.__wrapped__
+    legacy_send, legacy_recv = legacy_log(plain_send), legacy_log(plain_recv)
+    logger = logging.getLogger('server' if 'server.py' in sys.argv[0] else 'client')
+    # На время замера записи в файл не нужны: меряем сам декоратор
+    handlers, level = logger.handlers[:], logger.level
+    logger.handlers = [logging.NullHandler()]
+
+    results = dict()
+    results['plain'] = measure(plain_send, plain_recv, args.calls)
+    decos.set_tracing(False)
+    results['log_tracing_off'] = measure(send_message, get_message, args.calls)
+    decos.set_tracing(True)
+    logger.setLevel(logging.INFO)
+    results['log_level_info'] = measure(send_message, get_message, args.calls)
+    results['legacy_level_info'] = measure(legacy_send, legacy_recv, args.calls)
+    logger.setLevel(logging.DEBUG)
+    results['log_tracing_on'] = measure(send_message, get_message, args.calls)
+    results['legacy_tracing_on'] = measure(legacy_send, legacy_recv, max(args.calls // 20, 100))
+
+    logger.handlers, logger.level = handlers, level
+    decos.set_tracing(TRACE_CALLS)
+
+    # Накладные расходы на один вызов декорированной функции (в цикле их два)
+    output = {
+        'calls': args.calls,
+        'cycle_us': {name: round(value, 3) for name, value in results.items()},
+        'overhead_per_call_us': {name: round((value - results['plain']) / 2, 3)
+                                 for name, value in results.items() if name != 'plain'},
+    }
+    print(json.dumps(output, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Сравнение режимов шифрования сообщений пользователей (client/crypto.py) на ключах RSA 2048 бит.
+# Для каждого размера текста: время шифрования и расшифровки одного сообщения, мкс, и пропускная способность, МБ/с.
+# rsa - PKCS1_OAEP на каждое сообщение, текст длиннее предела ключа (190 байт) не шифруется;
+# hybrid - ChaCha20-Poly1305 ключом переписки. Отдельно - первое сообщение переписки (создание ключа переписки и его
+# шифрование RSA у отправителя, расшифровка RSA у получателя), дальше ключ берётся из кэша.
+#
+# Запуск из каталога BasicsOfNetworkProgramming:
+#     python -m benchmarks.encryption --messages 2000 --sizes 64,190,1024,16384
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from Crypto.PublicKey import RSA
+from common.variables import *
+from client.protocol import create_message
+from client.core import MemoryClientDatabase
+from client.crypto import MessageCipher
+
+
+def measure(mode, keys, pubkey, text, messages):
+    sender = MessageCipher('sender', keys['sender'], MemoryClientDatabase(), mode)
+    recipient = MessageCipher('recipient', keys['recipient'], MemoryClientDatabase(), mode)
+    # Первое сообщение переписки (ключ RSA получателя импортирован заранее, при открытии чата)
+    sender.rsa_encryptor(pubkey)
+    start = time.perf_counter()
+    ciphertext, session_key = sender.encrypt('recipient', pubkey, text)
+    first_encrypt = time.perf_counter() - start
+    message = create_message('sender', 'recipient', ciphertext, session_key)
+    start = time.perf_counter()
+    recipient.decrypt(message)
+    first_decrypt = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encrypted = [create_message('sender', 'recipient', *sender.encrypt('recipient', pubkey, text))
+                 for i in range(messages)]
+    encrypt = (time.perf_counter() - start) / messages
+    start = time.perf_counter()
+    for message in encrypted:
+        recipient.decrypt(message)
+    decrypt = (time.perf_counter() - start) / messages
+    overhead = len(encrypted[0][MESSAGE_TEXT]) + len(encrypted[0].get(SESSION_KEY, b'')) - len(text)
+    return {
+        'first_encrypt_us': round(first_encrypt * 1000000, 2),
+        'first_decrypt_us': round(first_decrypt * 1000000, 2),
+        'encrypt_us': round(encrypt * 1000000, 2),
+        'decrypt_us': round(decrypt * 1000000, 2),
+        'encrypt_mb_s': round(len(text) / encrypt / 1000000, 3),
+        'decrypt_mb_s': round(len(text) / decrypt / 1000000, 3),
+        'overhead_bytes': overhead,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение режимов шифрования сообщений')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--sizes', default='64,190,1024,16384', help='размеры текста через запятую, байт')
+    parser.add_argument('--key-bits', type=int, default=2048)
+    args = parser.parse_args()
+
+    keys = {name: RSA.generate(args.key_bits) for name in ('sender', 'recipient')}
+    pubkey = keys['recipient'].publickey().export_key().decode('ascii')
+    results = dict()
+    for size in [int(size) for size in args.sizes.split(',')]:
+        text = os.urandom(size)
+        results[size] = dict()
+        for mode in ENCRYPTION_MODES:
+            try:
+                results[size][mode] = measure(mode, keys, pubkey, text, args.messages)
+            except ValueError as err:
+                # Текст длиннее предела PKCS1_OAEP
+                results[size][mode] = {'error': str(err)}
+    print(json.dumps({'messages': args.messages, 'key_bits': args.key_bits, 'sizes': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
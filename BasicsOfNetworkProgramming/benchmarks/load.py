@@ -0,0 +1,244 @@
+# Нагрузочный тест сервера мессенджера.
+# Регистрирует N пользователей во временной ServerStorage, запускает MessageProcessor
+# (в этом же процессе или отдельным процессом) и M одновременных клиентов без GUI,
+# которые проходят настоящую авторизацию (PRESENCE -> 511 HMAC -> 200) и обмениваются
+# MESSAGE / GET_CONTACTS / USERS_REQUEST. Результат - JSON с числом соединений и сообщений
+# в секунду, перцентилями задержки доставки и временем обработки запросов сервером (server_actions,
+# только для сервера в этом же процессе).
+#
+# Запуск из каталога BasicsOfNetworkProgramming:
+#     python -m benchmarks.load --users 200 --clients 100 --messages 50 --engine asyncio
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.variables import *
+from client.protocol import password_hash, create_message
+from client.headless import AsyncClient
+
+PASSWORD = 'benchmark'
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(percent / 100 * len(values))) - 1))
+    return values[index]
+
+
+class BenchClient(AsyncClient):
+    # Клиент нагрузочного теста: в тексте сообщения - время отправки, получатель считает по нему задержку доставки.
+    def __init__(self, username, passwd_hash, stats):
+        super().__init__(username, passwd_hash=passwd_hash, pubkey='benchmark', on_message=self.message_received)
+        self.stats = stats
+
+    def message_received(self, message):
+        self.stats['latency'].append(time.perf_counter() - float(message[MESSAGE_TEXT]))
+
+    async def send_chat(self, to):
+        ans = await self.request(create_message(self.username, to, repr(time.perf_counter())))
+        self.stats['sent' if ans.get(RESPONSE) == 200 else 'errors'] += 1
+
+    async def get_contacts(self):
+        await super().get_contacts()
+        self.stats['requests'] += 1
+
+    async def get_users(self):
+        await super().get_users()
+        self.stats['requests'] += 1
+
+
+async def run_clients(args, usernames, hashes):
+    stats = {'sent': 0, 'errors': 0, 'requests': 0, 'latency': []}
+    clients = [BenchClient(name, hashes[name], stats) for name in usernames[:args.clients]]
+
+    # Фаза 1: одновременное подключение и авторизация всех клиентов
+    start = time.perf_counter()
+    await asyncio.gather(*(client.connect(args.address, args.port) for client in clients))
+    connect_time = time.perf_counter() - start
+
+    # Фаза 2: каждый клиент шлёт сообщения случайным собеседникам, иногда запрашивает справочники
+    names = [client.username for client in clients]
+
+    async def client_load(client):
+        for i in range(args.messages):
+            await client.send_chat(random.choice(names))
+            if args.request_every and i % args.request_every == 0:
+                await client.get_contacts()
+                await client.get_users()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_load(client) for client in clients))
+    # Ждём доставки последних сообщений
+    expected = stats['sent']
+    deadline = time.perf_counter() + REQUEST_TIMEOUT
+    while len(stats['latency']) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    load_time = time.perf_counter() - start
+
+    await asyncio.gather(*(client.close() for client in clients))
+
+    latency = stats['latency']
+    return {
+        'engine': args.engine,
+        'backend': args.backend,
+        'server': 'subprocess' if args.subprocess else 'in-process',
+        'users': args.users,
+        'clients': len(clients),
+        'messages_per_client': args.messages,
+        'connect_seconds': round(connect_time, 4),
+        'connections_per_second': round(len(clients) / connect_time, 2),
+        'messages_sent': stats['sent'],
+        'messages_delivered': len(latency),
+        'errors': stats['errors'],
+        'requests': stats['requests'],
+        'messages_per_second': round(len(latency) / load_time, 2),
+        'latency_ms': {
+            'p50': round(percentile(latency, 50) * 1000, 3) if latency else None,
+            'p95': round(percentile(latency, 95) * 1000, 3) if latency else None,
+            'p99': round(percentile(latency, 99) * 1000, 3) if latency else None,
+        },
+    }
+
+
+def create_database(backend, usernames, hashes):
+    # Временная база с синтетическими пользователями: (хранилище в памяти, None) или (None, путь к файлу SQLite)
+    if backend == 'memory':
+        from server.memory_storage import MemoryStorage
+        database = MemoryStorage()
+        for name in usernames:
+            database.add_user(name, hashes[name])
+        return database, None
+    from server.database import ServerStorage
+    database_path = os.path.join(tempfile.mkdtemp(prefix='messenger_bench_'), 'bench.db3')
+    database = ServerStorage(database_path)
+    for name in usernames:
+        database.add_user(name, hashes[name])
+    database.close()
+    database.database_engine.dispose()
+    return None, database_path
+
+
+def start_server(args, database_path, database=None):
+    # Сервер в этом же процессе (поток) или отдельным процессом (этот же модуль в режиме --serve)
+    if args.subprocess:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks.load', '--serve', '--engine', args.engine,
+             '--address', args.address, '--port', str(args.port), '--database', database_path],
+            cwd=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+        return process, None
+    if database is None:
+        from server.database import ServerStorage
+        database = ServerStorage(database_path)
+    server = create_processor(args.engine, args.address, args.port, database)
+    server.daemon = True
+    server.start()
+    return server, database
+
+
+def create_processor(engine, address, port, database):
+    if engine == 'asyncio':
+        from server.async_core import AsyncMessageProcessor
+        return AsyncMessageProcessor(address, port, database)
+    from server.core import MessageProcessor
+    return MessageProcessor(address, port, database)
+
+
+def serve(args):
+    # Режим отдельного процесса: сервер работает, пока его не остановят
+    from server.database import ServerStorage
+    database = ServerStorage(args.database)
+    server = create_processor(args.engine, args.address, args.port, database)
+    server.daemon = True
+    server.start()
+    try:
+        server.join()
+    except KeyboardInterrupt:
+        pass
+    database.close()
+
+
+def compare(result, baseline_path, tolerance):
+    # Сравнение с сохранённым результатом: падение пропускной способности или рост p99 больше допуска - ошибка
+    with open(baseline_path, encoding=ENCODING) as file:
+        baseline = json.load(file)
+    failures = []
+    for key in ('connections_per_second', 'messages_per_second'):
+        if result[key] < baseline[key] * (1 - tolerance):
+            failures.append(f'{key}: {result[key]} < {baseline[key]}')
+    if baseline['latency_ms']['p99'] and result['latency_ms']['p99'] and \
+            result['latency_ms']['p99'] > baseline['latency_ms']['p99'] * (1 + tolerance):
+        failures.append(f"latency p99: {result['latency_ms']['p99']} > {baseline['latency_ms']['p99']}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест сервера мессенджера')
+    parser.add_argument('--users', type=int, default=100, help='зарегистрированных пользователей')
+    parser.add_argument('--clients', type=int, default=50, help='одновременных клиентов')
+    parser.add_argument('--messages', type=int, default=20, help='сообщений от каждого клиента')
+    parser.add_argument('--request-every', type=int, default=10,
+                        help='запрос контактов и пользователей каждые N сообщений (0 - не запрашивать)')
+    parser.add_argument('--engine', default=DEFAULT_ENGINE, choices=SERVER_ENGINES)
+    parser.add_argument('--subprocess', action='store_true', help='запустить сервер отдельным процессом')
+    parser.add_argument('--backend', default='sqlite', choices=('sqlite', 'memory'),
+                        help='хранилище сервера (memory - только в этом же процессе)')
+    parser.add_argument('--address', default=DEFAULT_IP_ADDRESS)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT + 1)
+    parser.add_argument('--output', help='файл для результата (по умолчанию stdout)')
+    parser.add_argument('--baseline', help='JSON предыдущего прогона для проверки регрессий')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--database', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+    args.clients = min(args.clients, args.users)
+    if args.backend == 'memory' and args.subprocess:
+        parser.error('хранилище в памяти недоступно серверу в отдельном процессе')
+
+    usernames = [f'bench_{i}' for i in range(args.users)]
+    hashes = {name: password_hash(name, PASSWORD) for name in usernames}
+    database, database_path = create_database(args.backend, usernames, hashes)
+
+    server, server_database = start_server(args, database_path, database)
+    time.sleep(1)
+    try:
+        result = asyncio.run(run_clients(args, usernames, hashes))
+    finally:
+        if args.subprocess:
+            server.terminate()
+            server.wait()
+        else:
+            server.running = False
+            server.join()
+            server_database.close()
+    if not args.subprocess:
+        # Время обработки запросов на сервере по видам запросов
+        result['server_actions'] = server.action_timings()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding=ENCODING) as file:
+            file.write(output)
+    print(output)
+
+    if args.baseline:
+        failures = compare(result, args.baseline, args.tolerance)
+        if failures:
+            print('Регрессия производительности:', *failures, sep='\n', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
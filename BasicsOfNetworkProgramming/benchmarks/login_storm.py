@@ -0,0 +1,125 @@
+# Волна переподключений: N клиентов одновременно подключаются и проходят полную авторизацию
+# (PRESENCE -> 511 HMAC -> 200), как после перезапуска сервера.
+# --answer-delay - задержка клиента перед ответом на 511, мс (время в сети): сервер, ждущий ответа
+# каждого клиента, проходит волну за N задержек, неблокирующий - примерно за одну.
+# --resume - измеряется вторая волна: клиенты переподключаются с токенами возобновления сессии из первой.
+# Результат - JSON со временем до авторизации всех клиентов, входами в секунду,
+# перцентилями времени входа одного клиента и числом отказов.
+# Число соединений ограничено лимитом открытых файлов (ulimit -n): в одном процессе с клиентами
+# на каждое соединение уходит два дескриптора, с --subprocess - один.
+#
+# Запуск из каталога BasicsOfNetworkProgramming:
+#     python -m benchmarks.login_storm --clients 5000 --engine asyncio
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.variables import *
+from client.protocol import password_hash
+from client.headless import AsyncClient
+from benchmarks.load import PASSWORD, percentile, create_database, start_server
+
+
+class StormClient(AsyncClient):
+    # Клиент с задержкой ответа на 511
+    def __init__(self, username, passwd_hash, answer_delay):
+        super().__init__(username, passwd_hash=passwd_hash, pubkey='benchmark')
+        self.answer_delay = answer_delay
+
+    async def recv(self):
+        message = await super().recv()
+        if self.answer_delay and message.get(RESPONSE) == 511:
+            await asyncio.sleep(self.answer_delay)
+        return message
+
+
+async def login(client, args, times):
+    # Не дождавшийся авторизации клиент считается отказом
+    start = time.perf_counter()
+    await asyncio.wait_for(client.connect(args.address, args.port), args.timeout)
+    times.append(time.perf_counter() - start)
+
+
+async def run_storm(args, usernames, hashes):
+    clients = [StormClient(name, hashes[name], args.answer_delay / 1000) for name in usernames]
+    if args.resume:
+        # Первая волна - полная авторизация, клиенты получают токены
+        await asyncio.gather(*(client.connect(args.address, args.port) for client in clients))
+        await asyncio.gather(*(client.close() for client in clients))
+        await asyncio.sleep(1)
+    times = []
+    start = time.perf_counter()
+    results = await asyncio.gather(*(login(client, args, times) for client in clients), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    failures = [result for result in results if isinstance(result, BaseException)]
+    await asyncio.gather(*(client.close() for client in clients if client.connected), return_exceptions=True)
+    return {
+        'engine': args.engine,
+        'backend': args.backend,
+        'server': 'subprocess' if args.subprocess else 'in-process',
+        'clients': len(clients),
+        'answer_delay_ms': args.answer_delay,
+        'resume': args.resume,
+        'authenticated': len(times),
+        'failures': len(failures),
+        'failure_examples': sorted({repr(failure) for failure in failures})[:5],
+        'seconds_to_all_authenticated': round(elapsed, 4),
+        'logins_per_second': round(len(times) / elapsed, 2),
+        'login_ms': {
+            'p50': round(percentile(times, 50) * 1000, 3) if times else None,
+            'p95': round(percentile(times, 95) * 1000, 3) if times else None,
+            'p99': round(percentile(times, 99) * 1000, 3) if times else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Волна одновременных авторизаций')
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--answer-delay', type=float, default=0, help='задержка ответа на 511, мс')
+    parser.add_argument('--resume', action='store_true', help='переподключение с токенами возобновления сессии')
+    parser.add_argument('--timeout', type=float, default=60, help='время на авторизацию одного клиента, секунд')
+    parser.add_argument('--engine', default='asyncio', choices=SERVER_ENGINES)
+    parser.add_argument('--subprocess', action='store_true', help='запустить сервер отдельным процессом')
+    parser.add_argument('--backend', default='sqlite', choices=('sqlite', 'memory'),
+                        help='хранилище сервера (memory - только в этом же процессе)')
+    parser.add_argument('--address', default=DEFAULT_IP_ADDRESS)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT + 2)
+    parser.add_argument('--output', help='файл для результата (по умолчанию stdout)')
+    args = parser.parse_args()
+    if args.backend == 'memory' and args.subprocess:
+        parser.error('хранилище в памяти недоступно серверу в отдельном процессе')
+
+    # Хэши паролей считаются заранее (pbkdf2 отпускает GIL, поэтому в несколько потоков)
+    usernames = [f'storm_{i}' for i in range(args.clients)]
+    with ThreadPoolExecutor() as pool:
+        hashes = dict(zip(usernames, pool.map(lambda name: password_hash(name, PASSWORD), usernames)))
+    database, database_path = create_database(args.backend, usernames, hashes)
+
+    server, server_database = start_server(args, database_path, database)
+    time.sleep(1)
+    try:
+        result = asyncio.run(run_storm(args, usernames, hashes))
+    finally:
+        if args.subprocess:
+            server.terminate()
+            server.wait()
+        else:
+            server.running = False
+            server.join()
+            server_database.close()
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding=ENCODING) as file:
+            file.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
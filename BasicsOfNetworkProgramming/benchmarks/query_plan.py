@@ -0,0 +1,104 @@
+# Проверка планов запросов ServerStorage.
+# Создаёт временную базу, вызывает все методы хранилища, которые использует сервер,
+# перехватывает каждый выполненный SQL-запрос и выводит для него EXPLAIN QUERY PLAN.
+# Полный просмотр таблицы (SCAN без индекса) в запросе с условием WHERE считается ошибкой:
+# такой запрос замедляется с ростом таблицы. Запросы без условия (весь справочник) просматривают таблицу по смыслу.
+#
+# Запуск из каталога BasicsOfNetworkProgramming:
+#     python -m benchmarks.query_plan [--strict]
+import argparse
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sqlalchemy import event
+
+
+def exercise(database):
+    # Вызовы всех методов хранилища, которые выполняют SQL
+    database.add_user('test1', b'hash1')
+    database.add_user('test2', b'hash2')
+    database.add_user('test3', b'hash3')
+    database.user_login('test1', '127.0.0.1', 7777, 'key1')
+    # Вход по токену: ключ подписи, проверка ключа, замена номера токена, отметка активного подключения
+    database.session_secret()
+    database.get_pubkey('test2')
+    database.swap_token('test1', None, 'first')
+    database.swap_token('test1', 'first', 'second')
+    database.user_resume('test1', '127.0.0.1', 7778)
+    database.add_contact('test1', 'test2')
+    database.get_contacts('test1')
+    database.remove_contact('test1', 'test2')
+    database.process_message('test1', 'test2')
+    database.stats_writer.flush()
+    database.store_offline('test2', {'mess_text': 'test'})
+    database.offline_count('test2')
+    database.pop_offline('test2')
+    # Очередь пуста - только выборка
+    database.pop_offline('test2')
+    database.users_list()
+    database.users_page()
+    database.users_page('test1', 2)
+    database.directory_changes(1)
+    database.active_users_list()
+    database.login_history()
+    database.login_history('test1')
+    database.message_history()
+    database.load_users()
+    database.refresh_users()
+    database.user_logout('test1')
+    database.remove_user('test3')
+
+
+def full_scans(plan):
+    # Строки плана с полным просмотром таблицы
+    return [detail for detail in plan if detail.startswith('SCAN') and 'INDEX' not in detail]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Планы запросов ServerStorage')
+    parser.add_argument('--strict', action='store_true', help='код возврата 1 при полном просмотре таблицы')
+    args = parser.parse_args()
+
+    from server.database import ServerStorage
+    database_path = os.path.join(tempfile.mkdtemp(prefix='messenger_plan_'), 'plan.db3')
+    database = ServerStorage(database_path)
+
+    statements = dict()
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0]
+        statements.setdefault(statement, parameters)
+
+    event.listen(database.database_engine, 'before_cursor_execute', capture)
+    exercise(database)
+    event.remove(database.database_engine, 'before_cursor_execute', capture)
+
+    failures = 0
+    connection = database.database_engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        for statement, parameters in statements.items():
+            if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            cursor.execute(f'EXPLAIN QUERY PLAN {statement}', parameters)
+            plan = [row[-1] for row in cursor.fetchall()]
+            scans = full_scans(plan)
+            flagged = scans and 'WHERE' in statement.upper()
+            failures += bool(flagged)
+            print(('FULL SCAN ' if flagged else 'OK        ') + ' '.join(statement.split()))
+            for detail in plan:
+                print(f'    {detail}')
+    finally:
+        connection.close()
+        database.close()
+
+    print(f'Запросов: {len(statements)}, с полным просмотром таблицы: {failures}')
+    if args.strict and failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+# Микробенчмарк стоимости подтверждения (ответа 200) на сервере.
+# Сравниваются сериализация словаря при каждом ответе (прежний путь) и готовый ответ EncodedReply:
+# только кодирование пакета и полный путь MessageProcessor.reply через пару сокетов,
+# с номером запроса (конвейерный режим) и без него.
+# Результат - JSON со временем одного ответа, мкс.
+#
+# Запуск из каталога BasicsOfNetworkProgramming:
+#     python -m benchmarks.replies --calls 100000
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.variables import *
+from common.utils import encode_message, MessageDecoder, REPLY_200
+from server.core import MessageProcessor
+
+
+def legacy_encode(request_id):
+    # Прежний путь: копия шаблона, номер запроса, json.dumps
+    response = dict(RESPONSE_200)
+    if request_id is not None:
+        response[REQUEST_ID] = request_id
+    return encode_message(response, True)
+
+
+def measure_encode(encode, calls, request_id):
+    start = time.perf_counter()
+    for i in range(calls):
+        encode(request_id)
+    return (time.perf_counter() - start) / calls * 1000000
+
+
+def measure_reply(response, calls, request):
+    # Ответы через MessageProcessor.reply, клиентская сторона вычитывает сокет, чтобы буфер не рос
+    processor = MessageProcessor('127.0.0.1', DEFAULT_PORT, None)
+    server_sock, client_sock = socket.socketpair()
+    server_sock.setblocking(False)
+    client_sock.setblocking(False)
+    processor.clients.append(server_sock)
+    processor.decoders[server_sock] = MessageDecoder(framed=True)
+    processor.write_buffers[server_sock] = bytearray()
+    start = time.perf_counter()
+    for i in range(calls):
+        processor.reply(server_sock, request, response)
+        if i % 64 == 0:
+            try:
+                while client_sock.recv(MAX_FRAME_LENGTH):
+                    pass
+            except BlockingIOError:
+                pass
+    elapsed = time.perf_counter() - start
+    server_sock.close()
+    client_sock.close()
+    return elapsed / calls * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Стоимость подтверждений сервера')
+    parser.add_argument('--calls', type=int, default=100000)
+    args = parser.parse_args()
+
+    pipelined = {ACTION: MESSAGE, REQUEST_ID: 12345}
+    plain = {ACTION: MESSAGE}
+    results = {
+        'encode_dict': measure_encode(legacy_encode, args.calls, None),
+        'encode_reply': measure_encode(lambda request_id: REPLY_200.encode(True, request_id), args.calls, None),
+        'encode_dict_req_id': measure_encode(legacy_encode, args.calls, 12345),
+        'encode_reply_req_id': measure_encode(lambda request_id: REPLY_200.encode(True, request_id),
+                                              args.calls, 12345),
+        'reply_dict': measure_reply(RESPONSE_200.copy(), args.calls, plain),
+        'reply_encoded': measure_reply(REPLY_200, args.calls, plain),
+        'reply_dict_req_id': measure_reply(RESPONSE_200.copy(), args.calls, pipelined),
+        'reply_encoded_req_id': measure_reply(REPLY_200, args.calls, pipelined),
+    }
+    print(json.dumps({'calls': args.calls, 'per_reply_us': {name: round(value, 3) for name, value in results.items()}},
+                     indent=2))
+
+
+if __name__ == '__main__':
+    main()
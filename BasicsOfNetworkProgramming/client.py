@@ -80,14 +80,15 @@ if __name__ == '__main__':
         message.critical(start_dialog, 'Ошибка сервера', error.text)
         exit(1)
     transport.setDaemon(True)
-    transport.start()
 
     # Удалим объект диалога за ненадобностью
     del start_dialog
 
-    # Создаём GUI
+    # Создаём GUI. Поток транспорта запускаем после подключения сигналов,
+    # чтобы не потерять отложенные сообщения, которые сервер отдаёт сразу после входа.
     main_window = ClientMainWindow(database, transport, keys)
     main_window.make_connection(transport)
+    transport.start()
     main_window.setWindowTitle(f'Чат Программа alpha release - {client_name}')
     client_app.exec_()
 
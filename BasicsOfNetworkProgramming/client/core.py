@@ -0,0 +1,619 @@
+import socket
+import sys
+import errno
+import time
+import logging
+import json
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+sys.path.append('../')
+from common.utils import *
+from common.variables import *
+from common.errors import ServerError, ProtocolError
+from client.protocol import *
+
+# Логер и объект блокировки для работы с сокетом (используется, если сервер не поддерживает конвейер).
+logger = logging.getLogger('client_dist')
+socket_lock = threading.Lock()
+
+
+class MemoryClientDatabase:
+    # Справочники клиента в памяти - для клиентов без GUI, которым не нужна база на диске.
+    # Повторяет методы ClientDatabase, которые использует ClientCore.
+    def __init__(self):
+        self.contacts = []
+        self.users = []
+        self.version = 0
+        # Кэш открытых ключей {имя: (ключ, отпечаток, действителен)}
+        self.pubkeys = dict()
+        # Ключи переписок: исходящие {(имя, отпечаток ключа): (ключ, ключ под RSA)}, входящие {(имя, id): ключ}
+        self.session_keys = {'out': dict(), 'in': dict()}
+
+    def contacts_clear(self):
+        self.contacts = []
+
+    def add_contact(self, contact):
+        if contact not in self.contacts:
+            self.contacts.append(contact)
+
+    def del_contact(self, contact):
+        if contact in self.contacts:
+            self.contacts.remove(contact)
+
+    def add_users(self, users_list, version=0):
+        self.users = list(users_list)
+        self.version = version
+
+    def update_users(self, added, removed, version):
+        removed = set(removed)
+        self.users = [user for user in self.users if user not in removed]
+        self.users.extend(user for user in added if user not in self.users)
+        self.version = version
+
+    def users_version(self):
+        return self.version
+
+    def get_contacts(self):
+        return list(self.contacts)
+
+    def get_users(self):
+        return list(self.users)
+
+    def check_user(self, user):
+        return user in self.users
+
+    def check_contact(self, contact):
+        return contact in self.contacts
+
+    def get_pubkey(self, user):
+        pubkey, fingerprint, valid = self.pubkeys.get(user, (None, None, False))
+        return pubkey if valid else None
+
+    def pubkey_fingerprint(self, user):
+        return self.pubkeys[user][1] if user in self.pubkeys else None
+
+    def save_pubkey(self, user, pubkey):
+        self.pubkeys[user] = (pubkey, key_fingerprint(pubkey), True)
+
+    def invalidate_pubkeys(self, users=None):
+        for user in self.pubkeys if users is None else users:
+            if user in self.pubkeys:
+                self.pubkeys[user] = self.pubkeys[user][:2] + (False,)
+
+    def get_session_key(self, contact, fingerprint):
+        return self.session_keys['out'].get((contact, fingerprint))
+
+    def find_session_key(self, contact, key_id):
+        return self.session_keys['in'].get((contact, key_id))
+
+    def save_session_key(self, contact, direction, key_id, session_key, wrapped=None, fingerprint=None):
+        if direction == 'out':
+            self.session_keys['out'][(contact, fingerprint)] = (session_key, wrapped)
+        else:
+            self.session_keys['in'][(contact, key_id)] = session_key
+
+
+class ClientCore(threading.Thread):
+    # Взаимодействие с сервером без зависимости от GUI: соединение, авторизация,
+    # запросы, приём сообщений, справочники и кэш открытых ключей (хранится в базе клиента).
+    # О событиях сообщает через функции обратного вызова (или переопределение методов-событий):
+    # on_message(message) - новое сообщение, on_update() - обновлены справочники (205),
+    # on_reconnecting() - связь прервалась, идёт переподключение, on_reconnected() - соединение восстановлено,
+    # on_connection_lost() - соединение восстановить не удалось.
+    # Попыток восстановить соединение после обрыва и начальная задержка между ними, секунд
+    reconnect_attempts = RECONNECT_ATTEMPTS
+    reconnect_interval = RECONNECT_DELAY
+
+    def __init__(self, port, ip_address, database, username, passwd, keys=None, pipelining=True,
+                 on_message=None, on_update=None, on_connection_lost=None, codecs=None,
+                 on_reconnecting=None, on_reconnected=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        # Функции обратного вызова
+        self.on_message = on_message
+        self.on_update = on_update
+        self.on_connection_lost = on_connection_lost
+        self.on_reconnecting = on_reconnecting
+        self.on_reconnected = on_reconnected
+        # Класс База данных - работа с базой (по умолчанию справочники в памяти)
+        self.database = database if database is not None else MemoryClientDatabase()
+        # Имя пользователя
+        self.username = username
+        # Пароль
+        self.password = passwd
+        # Сокет для работы с сервером, адрес сервера и флаг "вход выполнен"
+        self.transport = None
+        self.server_address = None
+        self.connected = False
+        # Разборщик входящего потока (буфер неполных пакетов и формат обмена)
+        self.decoder = MessageDecoder()
+        # Форматы тела пакетов, предлагаемые серверу (по умолчанию все доступные, двоичный первым)
+        self.codecs = list(codecs) if codecs is not None else list(CODECS)
+        # Набор ключей для шифрования
+        self.keys = keys
+        # Токен возобновления сессии из последнего ответа 200 - для входа без 511 при переподключении
+        self.session_token = None
+        # Конвейерный режим: предлагается серверу, включается, если сервер его подтвердил.
+        # В этом режиме поток-приёмник читает сокет постоянно и раздаёт ответы по номерам запросов.
+        self.pipelining = pipelining
+        self.pipelined = False
+        self.reader_active = False
+        # Ожидающие ответа запросы {номер запроса: Future}
+        self.pending = dict()
+        self.pending_lock = threading.Lock()
+        self.request_counter = itertools.count(1)
+        # Блокировка только на запись пакета в сокет
+        self.send_lock = threading.Lock()
+        # Обработка 205 (обновление справочников) делает запросы, поэтому выносится из потока-приёмника.
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # Сообщения, пришедшие до запуска потока (сервер отдаёт отложенные сообщения сразу после входа).
+        # Обрабатываются при запуске, когда обработчики событий уже подключены.
+        self.backlog = []
+        # Сообщения пользователя, не отправленные из-за обрыва связи. Уходят после переподключения,
+        # до этого новые сообщения встают в конец очереди (флаг online снят), чтобы сохранить порядок.
+        self.outbox = deque()
+        self.outbox_lock = threading.Lock()
+        self.online = threading.Event()
+        # Устанавливаем соединение:
+        self.connection_init(port, ip_address)
+        # Обновляем таблицы известных пользователей и контактов
+        try:
+            self.user_list_update()
+            self.contacts_list_update()
+        except OSError as err:
+            if err.errno:
+                logger.critical(f'Потеряно соединение с сервером.')
+                raise ServerError('Потеряно соединение с сервером!')
+            logger.error(
+                'Timeout соединения при обновлении списков пользователей.')
+        except json.JSONDecodeError:
+            logger.critical(f'Потеряно соединение с сервером.')
+            raise ServerError('Потеряно соединение с сервером!')
+        self.online.set()
+        # Флаг продолжения работы транспорта.
+        self.running = True
+
+    def connection_init(self, port, ip, attempts=CONNECT_ATTEMPTS):
+        # Установка соединения с сервером и сообщение серверу о нашем появлении.
+        # Между попытками подключения - растущая случайная задержка (reconnect_delay).
+        self.server_address = (ip, port)
+        connected = False
+        for i in range(attempts):
+            if i:
+                time.sleep(reconnect_delay(i - 1))
+            logger.info(f'Попытка подключения №{i + 1}')
+            # Новый сокет на каждую попытку: после неудачного connect сокет повторно не используется.
+            # Таймаут необходим для освобождения сокета.
+            self.transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.transport.settimeout(5)
+            try:
+                self.transport.connect((ip, port))
+            except OSError:
+                self.transport.close()
+            else:
+                connected = True
+                logger.debug("Connection established.")
+                break
+
+        # Если соединится не удалось - исключение
+        if not connected:
+            logger.critical('Не удалось установить соединение с сервером')
+            raise ServerError('Не удалось установить соединение с сервером')
+
+        logger.debug('Starting auth dialog.')
+        # Новое соединение начинается в исходном формате обмена
+        self.decoder = MessageDecoder()
+        self.pipelined = False
+
+        # Получаем публичный ключ и декодируем его из байтов
+        pubkey = self.keys.publickey().export_key().decode('ascii') if self.keys else None
+        token = self.session_token
+
+        # Авторизируемся на сервере
+        with socket_lock:
+            # Предлагаем серверу перейти на пакеты с заголовком длины, конвейерную обработку и двоичный формат,
+            # при наличии токена - вход без 511
+            presense = create_presence(self.username, pubkey, pipelining=self.pipelining, codecs=self.codecs,
+                                       token=token)
+            logger.debug(f"Presense message = {presense}")
+            # Отправляем серверу приветственное сообщение.
+            try:
+                send_message(self.transport, presense, self.decoder.framed)
+                ans = get_message(self.transport, self.decoder)
+                logger.debug(f'Server response = {ans}.')
+                # Если сервер вернул ошибку, бросаем исключение.
+                if RESPONSE in ans:
+                    if ans[RESPONSE] == 400:
+                        raise ServerError(ans[ERROR])
+                    elif ans[RESPONSE] == 511:
+                        # Если всё нормально, то продолжаем процедуру авторизации.
+                        # Хэш пароля нужен только здесь: при входе по токену pbkdf2 не считается.
+                        passwd_hash_string = password_hash(self.username, self.password)
+                        my_ans = create_auth_answer(passwd_hash_string, ans[DATA], pubkey if token else None)
+                        send_message(self.transport, my_ans, self.decoder.framed)
+                        ans = get_message(self.transport, self.decoder)
+                        self.process_server_ans(ans)
+                    self.session_started(ans)
+                self.connected = True
+            except (OSError, json.JSONDecodeError, ProtocolError) as err:
+                logger.debug(f'Connection error.', exc_info=err)
+                raise ServerError('Сбой соединения в процессе авторизации.')
+
+    def session_started(self, ans):
+        # Ответ 200 на вход: токен для следующего подключения, новый формат - со следующего пакета
+        if ans.get(RESPONSE) != 200:
+            return
+        self.session_token = ans.get(TOKEN)
+        if FRAMING in ans and ans[FRAMING]:
+            self.decoder.framed = True
+            self.decoder.codec = CODECS.get(ans.get(CODEC), JSON_CODEC)
+            self.pipelined = PIPELINING in ans and ans[PIPELINING]
+
+    def process_server_ans(self, message):
+        # Обработка сообщений от сервера
+        logger.debug('Разбор сообщения от сервера: %s', message)
+
+        # Если это подтверждение чего-либо
+        if RESPONSE in message:
+            if message[RESPONSE] == 200:
+                return
+            elif message[RESPONSE] == 400:
+                raise ServerError(f'{message[ERROR]}')
+            elif message[RESPONSE] == 205:
+                self.directory_update(message)
+                self.updated()
+            else:
+                logger.error(f'Принят неизвестный код подтверждения {message[RESPONSE]}')
+
+        # Если это сообщение от пользователя добавляем в базу, даём сигнал о новом сообщении
+        elif ACTION in message and message[ACTION] == MESSAGE and SENDER in message and DESTINATION in message \
+                and MESSAGE_TEXT in message and message[DESTINATION] == self.username:
+            logger.debug('Получено сообщение от пользователя %s:%s', message[SENDER], message[MESSAGE_TEXT])
+            self.message_received(message)
+
+    def message_received(self, message):
+        # Событие: новое сообщение от пользователя
+        if self.on_message:
+            self.on_message(message)
+
+    def updated(self):
+        # Событие: справочники обновлены по команде сервера
+        if self.on_update:
+            self.on_update()
+
+    def lost_connection(self):
+        # Событие: потеряно соединение с сервером
+        if self.on_connection_lost:
+            self.on_connection_lost()
+
+    def reconnecting(self):
+        # Событие: связь прервалась, начато переподключение
+        if self.on_reconnecting:
+            self.on_reconnecting()
+
+    def reconnected(self):
+        # Событие: соединение восстановлено, очередь сообщений отправлена, справочники обновлены
+        if self.on_reconnected:
+            self.on_reconnected()
+
+    def start(self):
+        # Поток-приёмник читает сокет сам, дальше запросы идут через него.
+        self.reader_active = self.pipelined
+        super().start()
+
+    def request(self, req, wait_answer=True):
+        # Отправка запроса серверу, возвращает Future с ответом.
+        # В конвейерном режиме не ждёт ответа: можно отправить много запросов подряд,
+        # ответы раздаст поток-приёмник по номеру запроса.
+        future = Future()
+        if not self.connected:
+            raise ConnectionResetError(errno.ENOTCONN, 'Нет соединения с сервером.')
+        if self.reader_active:
+            if wait_answer:
+                req[REQUEST_ID] = next(self.request_counter)
+                with self.pending_lock:
+                    self.pending[req[REQUEST_ID]] = future
+            with self.send_lock:
+                send_message(self.transport, req, True, self.decoder.codec)
+            if not wait_answer:
+                future.set_result(None)
+        else:
+            # Старый режим: запрос и ответ под общей блокировкой сокета.
+            with socket_lock:
+                send_message(self.transport, req, self.decoder.framed, self.decoder.codec)
+                answer = None
+                while wait_answer and answer is None:
+                    answer = get_message(self.transport, self.decoder)
+                    # Между запросом и ответом может прийти сообщение пользователя
+                    if RESPONSE not in answer:
+                        self.backlog.append(answer)
+                        answer = None
+                future.set_result(answer)
+        return future
+
+    def exchange(self, req):
+        # Синхронный запрос: отправка и ожидание ответа не дольше таймаута.
+        future = self.request(req)
+        try:
+            return future.result(REQUEST_TIMEOUT)
+        except FutureTimeoutError:
+            with self.pending_lock:
+                self.pending.pop(req.get(REQUEST_ID), None)
+            raise socket.timeout('Нет ответа от сервера.')
+
+    def contacts_list_update(self):
+        # Обновление списка контактов с сервера
+        self.database.contacts_clear()
+        logger.debug(f'Запрос контакт листа для пользователя {self.username}')
+        req = create_contacts_request(self.username)
+        logger.debug(f'Сформирован запрос {req}')
+        ans = self.exchange(req)
+        logger.debug(f'Получен ответ {ans}')
+        if RESPONSE in ans and ans[RESPONSE] == 202:
+            for contact in ans[LIST_INFO]:
+                self.database.add_contact(contact)
+        else:
+            logger.error('Не удалось обновить список контактов.')
+
+    def user_list_update(self):
+        # Обновление списка пользователей с сервера
+        # Известна версия справочника - сервер присылает только изменения после неё,
+        # иначе справочник загружается постранично и заменяет сохранённый.
+        logger.debug(f'Запрос списка известных пользователей {self.username}')
+        ans = self.exchange(create_users_request(self.username, version=self.database.users_version()))
+        if RESPONSE not in ans or ans[RESPONSE] != 202:
+            logger.error('Не удалось обновить список известных пользователей.')
+            return
+        # Сервер без версий справочника (версия 0) - при следующем обновлении снова полный список
+        version = ans.get(DIRECTORY_VERSION, 0)
+        if ans.get(DELTA):
+            # Имена из изменений - новые пользователи или сменившие ключ, их ключи запрашиваются заново
+            self.database.update_users(ans[LIST_INFO], ans[REMOVED], version)
+            self.database.invalidate_pubkeys(list(ans[LIST_INFO]) + list(ans[REMOVED]))
+            return
+        # Полный справочник: неизвестно, чьи ключи сменились за это время
+        self.database.invalidate_pubkeys()
+        users = list(ans[LIST_INFO])
+        # Изменения, сделанные во время загрузки страниц, придут со следующим обновлением:
+        # сохраняется версия первой страницы
+        while ans.get(NEXT_PAGE):
+            ans = self.exchange(create_users_request(self.username, after=ans[NEXT_PAGE]))
+            if RESPONSE not in ans or ans[RESPONSE] != 202:
+                logger.error('Не удалось обновить список известных пользователей.')
+                return
+            users.extend(ans[LIST_INFO])
+        self.database.add_users(users, version)
+
+    def directory_update(self, message):
+        # Обработка 205. Изменения справочника от версии, которая есть у клиента, применяются на месте:
+        # удалённые пользователи убираются из справочника и контактов, ключи изменившихся - из кэша ключей.
+        # Иначе (старый сервер, пропущенная рассылка) справочники запрашиваются заново.
+        if message.get(DELTA) and message.get(PREVIOUS_VERSION) == self.database.users_version():
+            self.database.update_users(message[LIST_INFO], message[REMOVED], message[DIRECTORY_VERSION])
+            self.database.invalidate_pubkeys(list(message[LIST_INFO]) + list(message[REMOVED]))
+            for user in message[REMOVED]:
+                self.database.del_contact(user)
+            return
+        self.user_list_update()
+        self.contacts_list_update()
+
+    def key_request(self, user):
+        # Публичный ключ пользователя: из кэша в базе клиента (работает и без связи с сервером),
+        # запрос к серверу - только для нового собеседника или после смены его ключа
+        pubkey = self.database.get_pubkey(user)
+        if pubkey:
+            return pubkey
+        logger.debug(f'Запрос публичного ключа для {user}')
+        ans = self.exchange(create_key_request(user))
+        if RESPONSE in ans and ans[RESPONSE] == 511:
+            previous = self.database.pubkey_fingerprint(user)
+            if previous and previous != key_fingerprint(ans[DATA]):
+                logger.warning(f'Открытый ключ пользователя {user} изменился.')
+            self.database.save_pubkey(user, ans[DATA])
+            return ans[DATA]
+        else:
+            logger.error(f'Не удалось получить ключ собеседника{user}.')
+
+    def add_contact(self, contact):
+        # Сведения о добавлении контакта с сервера
+        logger.debug(f'Создание контакта {contact}')
+        self.process_server_ans(self.exchange(create_contact_change(ADD_CONTACT, self.username, contact)))
+
+    def remove_contact(self, contact):
+        # Отправляем на сервер сведения об удалении контакта
+        logger.debug(f'Удаление контакта {contact}')
+        self.process_server_ans(self.exchange(create_contact_change(REMOVE_CONTACT, self.username, contact)))
+
+    def transport_shutdown(self):
+        # Уведомляем сервер о завершении работы клиента
+        self.running = False
+        try:
+            self.request(create_exit(self.username), wait_answer=False)
+        except OSError:
+            pass
+        logger.debug('Транспорт завершает работу.')
+        time.sleep(0.5)
+
+    def send_message(self, to, message, session_key=None):
+        # Отправляем на сервер сообщение от пользователя (session_key - см. client/crypto.py).
+        # Возвращает False, если связи нет и сообщение поставлено в очередь до переподключения.
+        message_dict = create_message(self.username, to, message, session_key)
+        logger.debug(f'Сформирован словарь сообщения: {message_dict}')
+        with self.outbox_lock:
+            if not self.online.is_set():
+                self.outbox.append(message_dict)
+                logger.info(f'Нет связи с сервером, сообщение для {to} поставлено в очередь')
+                return False
+        try:
+            ans = self.exchange(message_dict)
+        except socket.timeout:
+            raise
+        except OSError:
+            if not self.running:
+                raise
+            # Связь оборвалась во время отправки. Подтверждения нет, поэтому сообщение отправляется
+            # повторно после переподключения (при обрыве после приёма сервером получатель увидит его дважды).
+            with self.outbox_lock:
+                self.outbox.append(message_dict)
+                online = self.online.is_set()
+            if online:
+                # Переподключение могло завершиться раньше, чем сообщение попало в очередь
+                self.executor.submit(self.replay_outbox)
+            logger.info(f'Связь потеряна, сообщение для {to} поставлено в очередь')
+            return False
+        self.process_server_ans(ans)
+        logger.info(f'Отправлено сообщение для пользователя {to}')
+        return True
+
+    def replay_outbox(self):
+        # Отправка сообщений из очереди по порядку. Когда очередь пуста, новые сообщения снова уходят сразу.
+        # Возвращает False, если связь снова потеряна (очередь отправится после следующего входа).
+        while True:
+            with self.outbox_lock:
+                if not self.outbox:
+                    self.online.set()
+                    return True
+                message = self.outbox[0]
+            message.pop(REQUEST_ID, None)
+            try:
+                ans = self.exchange(message)
+            except socket.timeout:
+                # Сервер получил сообщение, но не ответил вовремя - повтор привёл бы к дублю
+                logger.error(f'Нет подтверждения сообщения из очереди для {message[DESTINATION]}')
+                ans = dict()
+            except OSError as err:
+                logger.error(f'Сообщения из очереди не отправлены: {err}')
+                return False
+            with self.outbox_lock:
+                self.outbox.popleft()
+            if ans.get(RESPONSE) == 400:
+                logger.error(f'Сервер не принял сообщение для {message[DESTINATION]}: {ans[ERROR]}')
+
+    def reconnect(self):
+        # Восстановление соединения после обрыва (в потоке-приёмнике).
+        # Попытки с растущей случайной задержкой, чтобы после перезапуска сервера клиенты
+        # не подключались одновременно. Сессия возобновляется по токену, без пароля.
+        self.connected = False
+        self.online.clear()
+        self.transport.close()
+        self.reconnecting()
+        ip, port = self.server_address
+        for attempt in range(self.reconnect_attempts):
+            time.sleep(reconnect_delay(attempt, self.reconnect_interval))
+            if not self.running:
+                return False
+            try:
+                self.connection_init(port, ip, attempts=1)
+            except ServerError as err:
+                logger.warning(f'Попытка восстановить соединение не удалась: {err}')
+                self.transport.close()
+                continue
+            logger.info('Соединение с сервером восстановлено.')
+            self.reader_active = self.pipelined
+            # Запросы ждут ответа от потока-приёмника, поэтому синхронизация - в потоке обработки 205
+            self.executor.submit(self.resynchronize)
+            return True
+        return False
+
+    def resynchronize(self):
+        # После переподключения: очередь сообщений, справочники (за время обрыва они могли измениться,
+        # вместе с ними сбрасываются сменившиеся ключи собеседников), затем событие reconnected.
+        try:
+            if not self.replay_outbox():
+                return
+            self.user_list_update()
+            self.contacts_list_update()
+        except (OSError, ServerError) as err:
+            logger.error(f'Не удалось обновить справочники после переподключения: {err}')
+            return
+        self.reconnected()
+
+    def run(self):
+        logger.debug('Запущен процесс - приёмник сообщений с сервера.')
+        backlog, self.backlog = self.backlog, []
+        for message in backlog:
+            self.process_server_ans(message)
+        while self.running:
+            if self.reader_active:
+                self.read_loop()
+            else:
+                self.poll_loop()
+            # Приём прекратился: завершение работы или обрыв связи
+            if self.running and not self.reconnect():
+                logger.critical('Не удалось восстановить соединение с сервером.')
+                self.running = False
+                self.lost_connection()
+
+    def poll_loop(self):
+        # Приёмник старого режима: сокет опрашивается под общей блокировкой. Завершается при обрыве связи.
+        while self.running:
+            # Отдыхаем секунду и снова пробуем захватить сокет.
+            # Если не сделать тут задержку, то отправка может достаточно долго ждать освобождения сокета.
+            time.sleep(1)
+            message = None
+            with socket_lock:
+                try:
+                    self.transport.settimeout(0.5)
+                    message = get_message(self.transport, self.decoder)
+                except OSError as err:
+                    if err.errno:
+                        logger.critical(f'Потеряно соединение с сервером.')
+                        return
+                # Проблемы с соединением
+                except (json.JSONDecodeError, TypeError, ProtocolError):
+                    logger.debug(f'Потеряно соединение с сервером.')
+                    return
+                finally:
+                    self.transport.settimeout(5)
+                # Сообщения, прочитанные запросами между ответами (в том числе отложенные после переподключения),
+                # пришли раньше сообщения из сокета
+                backlog, self.backlog = self.backlog, []
+
+            for queued in backlog:
+                self.process_server_ans(queued)
+            # Если сообщение получено, то вызываем функцию обработчик:
+            if message:
+                logger.debug('Принято сообщение с сервера: %s', message)
+                self.process_server_ans(message)
+
+    def read_loop(self):
+        # Приёмник конвейерного режима: сокет читается без общей блокировки,
+        # входящие сообщения обрабатываются сразу после получения.
+        while self.running:
+            try:
+                message = get_message(self.transport, self.decoder)
+            except socket.timeout:
+                continue
+            except (OSError, json.JSONDecodeError, TypeError, ProtocolError) as err:
+                self.reader_active = False
+                self.fail_pending(err)
+                if self.running:
+                    logger.critical(f'Потеряно соединение с сервером.')
+                break
+            logger.debug('Принято сообщение с сервера: %s', message)
+            self.dispatch(message)
+
+    def dispatch(self, message):
+        # Ответ на запрос отдаём ожидающему его Future, остальное - в обработчик.
+        if RESPONSE in message and REQUEST_ID in message:
+            with self.pending_lock:
+                future = self.pending.pop(message[REQUEST_ID], None)
+            if future:
+                future.set_result(message)
+            else:
+                logger.error(f'Получен ответ на неизвестный запрос {message[REQUEST_ID]}')
+        elif RESPONSE in message and message[RESPONSE] == 205:
+            self.executor.submit(self.process_server_ans, message)
+        else:
+            self.process_server_ans(message)
+
+    def fail_pending(self, err):
+        # При потере соединения ожидающие запросы завершаются ошибкой, а не по таймауту.
+        with self.pending_lock:
+            pending, self.pending = self.pending, dict()
+        for future in pending.values():
+            future.set_exception(ConnectionResetError(errno.ECONNRESET, f'Потеряно соединение с сервером: {err}'))
@@ -0,0 +1,112 @@
+import base64
+import hashlib
+import os
+import sys
+from Crypto.Cipher import ChaCha20_Poly1305, PKCS1_OAEP
+from Crypto.PublicKey import RSA
+
+sys.path.append('../')
+from common.variables import *
+from common.utils import key_fingerprint
+
+# Шифрование сообщений пользователей. Режимы (MESSAGE_ENCRYPTION):
+#     rsa - текст шифруется PKCS1_OAEP открытым ключом получателя. На ключе 2048 бит сообщение не длиннее
+#         190 байт, получатель выполняет операцию закрытым ключом на каждое сообщение;
+#     hybrid - для переписки с собеседником создаётся ключ 256 бит, он шифруется ключом RSA получателя один раз
+#         и передаётся в каждом сообщении (SESSION_KEY), текст - ChaCha20-Poly1305 со случайным nonce
+#         (на коротких сообщениях в pycryptodome в 2 раза быстрее AES-GCM, на 16 КиБ - наравне).
+#         Получатель расшифровывает ключ переписки при первом сообщении и хранит его в базе клиента.
+# Ключи переписок хранятся в базе клиента (ClientDatabase или MemoryClientDatabase) вместе с отпечатком
+# ключа получателя: после смены ключа собеседника создаётся новый ключ переписки.
+# Принимаются сообщения в обоих режимах, режим определяется по наличию SESSION_KEY.
+
+# Размеры nonce и тега ChaCha20-Poly1305, байт
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+
+def to_bytes(value):
+    # Двоичные поля от JSON собеседника приходят строкой base64
+    return base64.b64decode(value) if isinstance(value, str) else bytes(value)
+
+
+def session_key_id(wrapped):
+    # Идентификатор ключа переписки - хэш его зашифрованного вида, одинаковый у отправителя и получателя
+    return hashlib.sha256(wrapped).hexdigest()[:32]
+
+
+class MessageCipher:
+    def __init__(self, username, keys, database, mode=MESSAGE_ENCRYPTION):
+        if mode not in ENCRYPTION_MODES:
+            raise ValueError(f'Неизвестный режим шифрования: {mode}')
+        self.username = username
+        self.database = database
+        self.mode = mode
+        # Дешифровщик с закрытым ключом пользователя
+        self.decrypter = PKCS1_OAEP.new(keys)
+        # Объекты шифрования по отпечаткам ключей собеседников: ключ импортируется один раз за сеанс
+        self.encryptors = dict()
+        # Ключи переписок, уже прочитанные из базы: {(собеседник, отпечаток его ключа): (ключ, ключ под RSA)}
+        # для исходящих и {(собеседник, идентификатор): ключ} для входящих
+        self.outgoing = dict()
+        self.incoming = dict()
+
+    def rsa_encryptor(self, pubkey):
+        # Объект шифрования открытым ключом собеседника и отпечаток ключа
+        fingerprint = key_fingerprint(pubkey)
+        if fingerprint not in self.encryptors:
+            self.encryptors[fingerprint] = PKCS1_OAEP.new(RSA.import_key(pubkey))
+        return fingerprint, self.encryptors[fingerprint]
+
+    @staticmethod
+    def associated_data(sender, recipient):
+        # Имена отправителя и получателя защищены тегом: сообщение нельзя выдать за отправленное другим
+        return f'{sender}\n{recipient}'.encode(ENCODING)
+
+    def encrypt(self, contact, pubkey, text):
+        # Текст (байты) для собеседника -> (шифротекст, ключ переписки под RSA или None в режиме rsa).
+        # ValueError - текст слишком длинный для режима rsa.
+        fingerprint, encryptor = self.rsa_encryptor(pubkey)
+        if self.mode == 'rsa':
+            return encryptor.encrypt(text), None
+        key, wrapped = self.session_key(contact, fingerprint, encryptor)
+        nonce = os.urandom(NONCE_SIZE)
+        cipher = ChaCha20_Poly1305.new(key=key, nonce=nonce)
+        cipher.update(self.associated_data(self.username, contact))
+        ciphertext, tag = cipher.encrypt_and_digest(text)
+        return nonce + ciphertext + tag, wrapped
+
+    def session_key(self, contact, fingerprint, encryptor):
+        # Ключ переписки с собеседником для его текущего ключа RSA, при отсутствии - новый
+        session = self.outgoing.get((contact, fingerprint))
+        if session is None:
+            session = self.database.get_session_key(contact, fingerprint)
+        if session is None:
+            key = os.urandom(32)
+            wrapped = encryptor.encrypt(key)
+            self.database.save_session_key(contact, 'out', session_key_id(wrapped), key, wrapped, fingerprint)
+            session = (key, wrapped)
+        self.outgoing[(contact, fingerprint)] = session
+        return session
+
+    def decrypt(self, message):
+        # Сообщение собеседника -> текст (байты).
+        # ValueError - сообщение не для нашего ключа, повреждено или подделано.
+        ciphertext = to_bytes(message[MESSAGE_TEXT])
+        if SESSION_KEY not in message:
+            return self.decrypter.decrypt(ciphertext)
+        sender = message[SENDER]
+        wrapped = to_bytes(message[SESSION_KEY])
+        key_id = session_key_id(wrapped)
+        key = self.incoming.get((sender, key_id))
+        if key is None:
+            key = self.database.find_session_key(sender, key_id)
+        if key is None:
+            key = self.decrypter.decrypt(wrapped)
+            self.database.save_session_key(sender, 'in', key_id, key)
+        self.incoming[(sender, key_id)] = key
+        if len(ciphertext) < NONCE_SIZE + TAG_SIZE:
+            raise ValueError('Сообщение повреждено.')
+        cipher = ChaCha20_Poly1305.new(key=key, nonce=ciphertext[:NONCE_SIZE])
+        cipher.update(self.associated_data(sender, self.username))
+        return cipher.decrypt_and_verify(ciphertext[NONCE_SIZE:-TAG_SIZE], ciphertext[-TAG_SIZE:])
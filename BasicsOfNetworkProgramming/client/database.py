@@ -2,9 +2,11 @@ import datetime
 import sys
 
 sys.path.append('../')
-from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime
+from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime, Boolean, \
+    LargeBinary
 from sqlalchemy.orm import mapper, sessionmaker
 import os
+from common.utils import key_fingerprint
 
 
 class ClientDatabase:
@@ -14,6 +16,12 @@ class ClientDatabase:
             self.id = None
             self.username = user
 
+    class UsersVersion:
+        # Отображение для таблицы версии справочника пользователей, полученной с сервера
+        def __init__(self, version):
+            self.id = None
+            self.version = version
+
     class MessageStat:
         # Отображение для таблицы статистики переданных сообщений
         def __init__(self, contact, direction, message):
@@ -29,6 +37,26 @@ class ClientDatabase:
             self.id = None
             self.name = contact
 
+    class PublicKeys:
+        # Отображение для таблицы кэша открытых ключей собеседников
+        def __init__(self, user, pubkey):
+            self.id = None
+            self.username = user
+            self.pubkey = pubkey
+            self.fingerprint = key_fingerprint(pubkey)
+            self.valid = True
+
+    class SessionKeys:
+        # Отображение для таблицы ключей переписок (гибридное шифрование сообщений)
+        def __init__(self, contact, direction, key_id, session_key, wrapped, fingerprint):
+            self.id = None
+            self.contact = contact
+            self.direction = direction
+            self.key_id = key_id
+            self.session_key = session_key
+            self.wrapped = wrapped
+            self.fingerprint = fingerprint
+
     # Конструктор класса:
     def __init__(self, name):
         # Создаём движок базы данных, поскольку разрешено несколько клиентов одновременно, каждый должен иметь свою БД
@@ -44,9 +72,15 @@ class ClientDatabase:
         # Создаём таблицу известных пользователей
         users = Table('known_users', self.metadata,
                       Column('id', Integer, primary_key=True),
-                      Column('username', String)
+                      Column('username', String, index=True)
                       )
 
+        # Создаём таблицу версии справочника известных пользователей (одна запись)
+        users_version = Table('known_users_version', self.metadata,
+                              Column('id', Integer, primary_key=True),
+                              Column('version', Integer)
+                              )
+
         # Создаём таблицу истории сообщений
         history = Table('message_history', self.metadata,
                         Column('id', Integer, primary_key=True),
@@ -62,13 +96,38 @@ class ClientDatabase:
                          Column('name', String, unique=True)
                          )
 
+        # Создаём таблицу кэша открытых ключей. Ключ, о смене которого сообщил сервер, помечается недействительным,
+        # отпечаток остаётся - по нему видно, что новый ключ отличается от прежнего.
+        pubkeys = Table('public_keys', self.metadata,
+                        Column('id', Integer, primary_key=True),
+                        Column('username', String, unique=True),
+                        Column('pubkey', Text),
+                        Column('fingerprint', String),
+                        Column('valid', Boolean)
+                        )
+
+        # Создаём таблицу ключей переписок: исходящие (с ключом под RSA и отпечатком ключа получателя)
+        # и входящие (по идентификатору, который приходит с сообщением)
+        session_keys = Table('session_keys', self.metadata,
+                             Column('id', Integer, primary_key=True),
+                             Column('contact', String, index=True),
+                             Column('direction', String),
+                             Column('key_id', String),
+                             Column('session_key', LargeBinary),
+                             Column('wrapped', LargeBinary),
+                             Column('fingerprint', String)
+                             )
+
         # Создаём таблицы
         self.metadata.create_all(self.database_engine)
 
         # Создаём отображения
         mapper(self.KnownUsers, users)
+        mapper(self.UsersVersion, users_version)
         mapper(self.MessageStat, history)
         mapper(self.Contacts, contacts)
+        mapper(self.PublicKeys, pubkeys)
+        mapper(self.SessionKeys, session_keys)
 
         # Создаём сессию
         session = sessionmaker(bind=self.database_engine)
@@ -95,12 +154,73 @@ class ClientDatabase:
         self.session.query(self.Contacts).filter_by(name=contact).delete()
         self.session.commit()
 
-    def add_users(self, users_list):
-        # Заполняем таблицу известных пользователей
+    def add_users(self, users_list, version=0):
+        # Заполняем таблицу известных пользователей полным списком (одной пакетной вставкой)
         self.session.query(self.KnownUsers).delete()
-        for user in users_list:
-            user_row = self.KnownUsers(user)
-            self.session.add(user_row)
+        self.session.bulk_insert_mappings(self.KnownUsers, [{'username': user} for user in users_list])
+        self.set_users_version(version)
+        self.session.commit()
+
+    def update_users(self, added, removed, version):
+        # Применяем изменения справочника, полученные с сервера
+        if removed:
+            self.session.query(self.KnownUsers).filter(self.KnownUsers.username.in_(removed)).delete(
+                synchronize_session=False)
+        if added:
+            known = {row.username for row in
+                     self.session.query(self.KnownUsers.username).filter(self.KnownUsers.username.in_(added))}
+            self.session.bulk_insert_mappings(self.KnownUsers,
+                                              [{'username': user} for user in added if user not in known])
+        self.set_users_version(version)
+        self.session.commit()
+
+    def set_users_version(self, version):
+        self.session.query(self.UsersVersion).delete()
+        self.session.add(self.UsersVersion(version))
+
+    def users_version(self):
+        # Версия справочника, 0 - справочник ещё не загружался
+        row = self.session.query(self.UsersVersion.version).first()
+        return row.version if row else 0
+
+    def get_pubkey(self, user):
+        # Действительный ключ собеседника из кэша или None
+        row = self.session.query(self.PublicKeys.pubkey).filter_by(username=user, valid=True).first()
+        return row.pubkey if row else None
+
+    def pubkey_fingerprint(self, user):
+        # Отпечаток последнего известного ключа собеседника (в том числе недействительного) или None
+        row = self.session.query(self.PublicKeys.fingerprint).filter_by(username=user).first()
+        return row.fingerprint if row else None
+
+    def save_pubkey(self, user, pubkey):
+        # Сохраняем полученный с сервера ключ
+        self.session.query(self.PublicKeys).filter_by(username=user).delete()
+        self.session.add(self.PublicKeys(user, pubkey))
+        self.session.commit()
+
+    def invalidate_pubkeys(self, users=None):
+        # Сервер сообщил об изменении пользователей - их ключи запрашиваются заново (None - все ключи)
+        query = self.session.query(self.PublicKeys)
+        if users is not None:
+            query = query.filter(self.PublicKeys.username.in_(users))
+        query.update({self.PublicKeys.valid: False}, synchronize_session=False)
+        self.session.commit()
+
+    def get_session_key(self, contact, fingerprint):
+        # Ключ переписки для отправки собеседнику с ключом RSA fingerprint: (ключ, ключ под RSA) или None
+        row = self.session.query(self.SessionKeys.session_key, self.SessionKeys.wrapped).filter_by(
+            contact=contact, direction='out', fingerprint=fingerprint).order_by(self.SessionKeys.id.desc()).first()
+        return (row.session_key, row.wrapped) if row else None
+
+    def find_session_key(self, contact, key_id):
+        # Ключ переписки, которым собеседник шифрует сообщения нам, или None
+        row = self.session.query(self.SessionKeys.session_key).filter_by(
+            contact=contact, direction='in', key_id=key_id).first()
+        return row.session_key if row else None
+
+    def save_session_key(self, contact, direction, key_id, session_key, wrapped=None, fingerprint=None):
+        self.session.add(self.SessionKeys(contact, direction, key_id, session_key, wrapped, fingerprint))
         self.session.commit()
 
     def save_message(self, contact, direction, message):
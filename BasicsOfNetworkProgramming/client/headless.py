@@ -0,0 +1,214 @@
+import asyncio
+import itertools
+import logging
+import sys
+
+sys.path.append('../')
+from common.variables import *
+from common.utils import encode_message, MessageDecoder, CODECS, JSON_CODEC
+from common.errors import ServerError, ProtocolError
+from client.protocol import *
+
+logger = logging.getLogger('client_dist')
+
+
+class AsyncClient:
+    # Клиент без GUI на asyncio: для ботов, скриптов и нагрузочных тестов.
+    # Авторизация как у ClientTransport, затем конвейерные запросы с номерами.
+    # Входящие сообщения пользователей складываются в очередь, их читают через
+    #     async for message in client.messages(): ...
+    # или задают функцию обратного вызова on_message.
+    def __init__(self, username, passwd=None, passwd_hash=None, pubkey=None, on_message=None, codecs=None):
+        self.username = username
+        # Можно передать готовый хэш пароля, чтобы не считать pbkdf2 на каждое подключение
+        self.passwd_hash = passwd_hash if passwd_hash is not None else password_hash(username, passwd)
+        self.pubkey = pubkey
+        self.on_message = on_message
+        self.reader = None
+        self.writer = None
+        self.decoder = MessageDecoder()
+        # Форматы тела пакетов, предлагаемые серверу
+        self.codecs = list(codecs) if codecs is not None else list(CODECS)
+        # Ожидающие ответа запросы {номер запроса: Future}
+        self.pending = dict()
+        self.request_counter = 0
+        self.reader_task = None
+        self.inbox = asyncio.Queue()
+        # Справочники и кэш открытых ключей, кэш сбрасывается по 205
+        self.contacts = []
+        self.users = []
+        self.users_version = 0
+        self.pubkeys = dict()
+        self.connected = False
+        # Токен возобновления сессии: повторный connect входит без 511
+        self.token = None
+
+    async def recv(self):
+        # Получение одного целого пакета от сервера
+        message = self.decoder.next_message()
+        while message is None:
+            data = await self.reader.read(MAX_PACKAGE_LENGTH)
+            if not data:
+                raise ConnectionResetError('Сервер закрыл соединение.')
+            self.decoder.feed(data)
+            message = self.decoder.next_message()
+        return message
+
+    async def send(self, message):
+        # Запись ждёт, пока буфер сокета не опустится ниже верхней границы:
+        # сервер, не читающий запросы, приостанавливает отправителя, а не раздувает его память
+        self.writer.write(encode_message(message, self.decoder.framed, self.decoder.codec))
+        await self.writer.drain()
+
+    async def connect(self, address, port):
+        # Подключение и авторизация: PRESENCE -> 511 -> HMAC -> 200, по токену - PRESENCE -> 200
+        # При наличии токена сервер отвечает сразу 200
+        self.reader, self.writer = await asyncio.open_connection(address, port)
+        self.decoder = MessageDecoder()
+        token = self.token
+        await self.send(create_presence(self.username, self.pubkey, codecs=self.codecs, token=token))
+        ans = await self.recv()
+        if ans.get(RESPONSE) == 511:
+            await self.send(create_auth_answer(self.passwd_hash, ans[DATA], self.pubkey if token else None))
+            ans = await self.recv()
+        if ans.get(RESPONSE) != 200:
+            raise ServerError(ans.get(ERROR, f'Неожиданный ответ сервера: {ans}'))
+        self.token = ans.get(TOKEN)
+        self.decoder.framed = FRAMING in ans and ans[FRAMING]
+        if self.decoder.framed:
+            self.decoder.codec = CODECS.get(ans.get(CODEC), JSON_CODEC)
+        if not (PIPELINING in ans and ans[PIPELINING]):
+            raise ServerError('Сервер не поддерживает конвейерные запросы.')
+        self.connected = True
+        self.reader_task = asyncio.get_running_loop().create_task(self.read_loop())
+        logger.debug(f'Клиент {self.username} подключён к {address}:{port}')
+
+    async def read_loop(self):
+        # Приёмник: ответы раздаются ожидающим запросам, сообщения - в очередь
+        try:
+            while True:
+                self.dispatch(await self.recv())
+        except (OSError, ValueError, ProtocolError) as err:
+            logger.debug(f'Потеряно соединение с сервером.', exc_info=err)
+        finally:
+            self.connected = False
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionResetError('Потеряно соединение с сервером.'))
+            self.pending.clear()
+            # Сигнал окончания для messages()
+            self.inbox.put_nowait(None)
+
+    def dispatch(self, message):
+        if RESPONSE in message and REQUEST_ID in message:
+            future = self.pending.pop(message[REQUEST_ID], None)
+            if future and not future.done():
+                future.set_result(message)
+        elif RESPONSE in message and message[RESPONSE] == 205:
+            # Изменения справочника от известной версии применяем сразу, иначе их получит следующий get_users
+            if message.get(DELTA) and message.get(PREVIOUS_VERSION) == self.users_version:
+                self.update_users(message[LIST_INFO], message[REMOVED], message[DIRECTORY_VERSION])
+            else:
+                self.pubkeys.clear()
+        elif ACTION in message and message[ACTION] == MESSAGE and message.get(DESTINATION) == self.username:
+            if self.on_message:
+                self.on_message(message)
+            else:
+                self.inbox.put_nowait(message)
+
+    async def messages(self):
+        # Асинхронный итератор входящих сообщений, завершается при потере соединения
+        while True:
+            message = await self.inbox.get()
+            if message is None:
+                return
+            yield message
+
+    async def request(self, message):
+        # Запрос с номером, ответ приходит в Future через приёмник
+        if not self.connected:
+            raise ConnectionResetError('Нет соединения с сервером.')
+        self.request_counter += 1
+        message[REQUEST_ID] = self.request_counter
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.request_counter] = future
+        try:
+            await self.send(message)
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        finally:
+            self.pending.pop(message[REQUEST_ID], None)
+
+    async def send_message(self, to, text):
+        ans = await self.request(create_message(self.username, to, text))
+        if ans.get(RESPONSE) != 200:
+            raise ServerError(ans.get(ERROR, 'Сообщение не доставлено.'))
+        return ans
+
+    async def get_contacts(self):
+        ans = await self.request(create_contacts_request(self.username))
+        if ans.get(RESPONSE) == 202:
+            self.contacts = ans[LIST_INFO]
+        return self.contacts
+
+    async def get_users(self):
+        # Изменения справочника после известной версии или полный справочник постранично
+        ans = await self.request(create_users_request(self.username, version=self.users_version))
+        if ans.get(RESPONSE) != 202:
+            return self.users
+        version = ans.get(DIRECTORY_VERSION, 0)
+        if ans.get(DELTA):
+            self.update_users(ans[LIST_INFO], ans[REMOVED], version)
+            return self.users
+        users = list(ans[LIST_INFO])
+        while ans.get(NEXT_PAGE):
+            ans = await self.request(create_users_request(self.username, after=ans[NEXT_PAGE]))
+            if ans.get(RESPONSE) != 202:
+                return self.users
+            users.extend(ans[LIST_INFO])
+        # Полный справочник: неизвестно, чьи ключи сменились, кэш ключей сбрасывается
+        self.users = users
+        self.users_version = version
+        self.pubkeys.clear()
+        return self.users
+
+    def update_users(self, added, removed, version):
+        # Применение изменений справочника: удалённые пользователи убираются из контактов,
+        # ключи удалённых и изменившихся (новый пользователь или смена ключа) - из кэша ключей
+        removed = set(removed)
+        self.users = [user for user in self.users if user not in removed]
+        self.users.extend(user for user in added if user not in self.users)
+        self.contacts = [contact for contact in self.contacts if contact not in removed]
+        for user in itertools.chain(added, removed):
+            self.pubkeys.pop(user, None)
+        self.users_version = version
+
+    async def key_request(self, user):
+        # Открытый ключ собеседника, повторные запросы - из кэша
+        if user in self.pubkeys:
+            return self.pubkeys[user]
+        ans = await self.request(create_key_request(user))
+        if ans.get(RESPONSE) == 511:
+            self.pubkeys[user] = ans[DATA]
+            return ans[DATA]
+
+    async def add_contact(self, contact):
+        ans = await self.request(create_contact_change(ADD_CONTACT, self.username, contact))
+        if ans.get(RESPONSE) != 200:
+            raise ServerError(ans.get(ERROR, 'Не удалось добавить контакт.'))
+
+    async def remove_contact(self, contact):
+        ans = await self.request(create_contact_change(REMOVE_CONTACT, self.username, contact))
+        if ans.get(RESPONSE) != 200:
+            raise ServerError(ans.get(ERROR, 'Не удалось удалить контакт.'))
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            if self.connected:
+                await self.send(create_exit(self.username))
+        except OSError:
+            pass
+        if self.reader_task:
+            self.reader_task.cancel()
+        self.writer.close()
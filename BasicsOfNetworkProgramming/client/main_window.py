@@ -1,17 +1,15 @@
 from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, QListView
 from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
 from PyQt5.QtCore import pyqtSlot, QEvent, Qt
-from Crypto.Cipher import PKCS1_OAEP
-from Crypto.PublicKey import RSA
 import json
 import logging
-import base64
 import sys
 
 sys.path.append('../')
 from client.main_window_conv import Ui_MainClientWindow
 from client.add_contact import AddContactDialog
 from client.del_contact import DelContactDialog
+from client.crypto import MessageCipher
 from common.errors import ServerError
 from common.variables import *
 
@@ -24,8 +22,8 @@ class ClientMainWindow(QMainWindow):
         self.database = database
         self.transport = transport
 
-        # объект - дешифорвщик сообщений с предзагруженным ключём
-        self.decrypter = PKCS1_OAEP.new(keys)
+        # Шифрование и расшифровка сообщений (режим MESSAGE_ENCRYPTION), ключи переписок хранятся в базе клиента
+        self.cipher = MessageCipher(transport.username, keys, database)
 
         # Загружаем конфигурацию окна из дизайнера
         self.ui = Ui_MainClientWindow()
@@ -47,7 +45,6 @@ class ClientMainWindow(QMainWindow):
         self.messages = QMessageBox()
         self.current_chat = None
         self.current_chat_key = None
-        self.encryptor = None
         self.ui.list_messages.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
         self.ui.list_messages.setWordWrap(True)
 
@@ -70,7 +67,6 @@ class ClientMainWindow(QMainWindow):
         self.ui.btn_send.setDisabled(True)
         self.ui.text_message.setDisabled(True)
 
-        self.encryptor = None
         self.current_chat = None
         self.current_chat_key = None
 
@@ -112,15 +108,14 @@ class ClientMainWindow(QMainWindow):
 
     def set_active_user(self):
         # Активация чата с собеседником
-        # Запрашиваем публичный ключ пользователя и создаём объект шифрования
+        # Запрашиваем публичный ключ пользователя и создаём объект шифрования (один раз на ключ)
         try:
             self.current_chat_key = self.transport.key_request(self.current_chat)
             logger.debug(f'Загружен открытый ключ для {self.current_chat}')
             if self.current_chat_key:
-                self.encryptor = PKCS1_OAEP.new(RSA.import_key(self.current_chat_key))
+                self.cipher.rsa_encryptor(self.current_chat_key)
         except (OSError, json.JSONDecodeError):
             self.current_chat_key = None
-            self.encryptor = None
             logger.debug(f'Не удалось получить ключ для {self.current_chat}')
 
         # Если ключа нет, то ошибка, что не удалось начать чат с пользователем
@@ -217,16 +212,19 @@ class ClientMainWindow(QMainWindow):
         self.ui.text_message.clear()
         if not message_text:
             return
-        # Шифруем сообщение ключом получателя и упаковываем в base64.
-        message_text_encrypted = self.encryptor.encrypt(
-            message_text.encode('utf8'))
-        message_text_encrypted_base64 = base64.b64encode(
-            message_text_encrypted)
+        # Шифруем сообщение для получателя. Шифротекст и ключ переписки передаются байтами:
+        # в двоичном формате обмена как есть, в JSON - строкой base64.
         try:
-            self.transport.send_message(
+            message_text_encrypted, session_key = self.cipher.encrypt(
+                self.current_chat, self.current_chat_key, message_text.encode('utf8'))
+        except ValueError:
+            self.messages.critical(self, 'Ошибка', 'Сообщение слишком длинное для шифрования ключом получателя.')
+            return
+        try:
+            sent = self.transport.send_message(
                 self.current_chat,
-                message_text_encrypted_base64.decode('ascii'))
-            pass
+                message_text_encrypted,
+                session_key)
         except ServerError as err:
             self.messages.critical(self, 'Ошибка', err.text)
         except OSError as err:
@@ -240,6 +238,8 @@ class ClientMainWindow(QMainWindow):
                 self, 'Ошибка', 'Потеряно соединение с сервером!')
             self.close()
         else:
+            if not sent:
+                self.ui.statusBar.showMessage('Нет связи с сервером, сообщение будет отправлено после переподключения.')
             self.database.save_message(self.current_chat, 'out', message_text)
             logger.debug(
                 f'Отправлено сообщение для {self.current_chat}: {message_text}')
@@ -249,12 +249,10 @@ class ClientMainWindow(QMainWindow):
     def message(self, message):
         # Слот обрабатывает поступаемые сообщения. Запрос пользователя если сообщение не от текущего собеседника
 
-        # Получаем строку байтов
-        encrypted_message = base64.b64decode(message[MESSAGE_TEXT])
-        # Декодируем строку, при ошибке выдаём сообщение и завершаем функцию
+        # Расшифровываем сообщение (в любом из режимов), при ошибке выдаём сообщение и завершаем функцию
         try:
-            decrypted_message = self.decrypter.decrypt(encrypted_message)
-        except (ValueError, TypeError):
+            decrypted_message = self.cipher.decrypt(message)
+        except (ValueError, TypeError, KeyError):
             self.messages.warning(
                 self, 'Ошибка', 'Не удалось декодировать сообщение.')
             return
@@ -295,6 +293,17 @@ class ClientMainWindow(QMainWindow):
                         self.current_chat, 'in', decrypted_message.decode('utf8'))
                     self.set_active_user()
 
+    @pyqtSlot()
+    def connection_restoring(self):
+        # Связь прервалась, транспорт переподключается сам: окно остаётся открытым
+        self.ui.statusBar.showMessage('Потеряно соединение с сервером, переподключение...')
+
+    @pyqtSlot()
+    def connection_restored(self):
+        # Справочники обновлены после переподключения
+        self.ui.statusBar.showMessage('Соединение с сервером восстановлено.', 5000)
+        self.sig_205()
+
     @pyqtSlot()
     def connection_lost(self):
         self.messages.warning(
@@ -320,4 +329,6 @@ class ClientMainWindow(QMainWindow):
         # Соединение сигналов и слотов
         trans_obj.new_message.connect(self.message)
         trans_obj.connection_lost.connect(self.connection_lost)
+        trans_obj.connection_restoring.connect(self.connection_restoring)
+        trans_obj.connection_restored.connect(self.connection_restored)
         trans_obj.message_205.connect(self.sig_205)
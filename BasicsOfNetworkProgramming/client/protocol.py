@@ -0,0 +1,125 @@
+import binascii
+import hashlib
+import hmac
+import random
+import time
+import sys
+
+sys.path.append('../')
+from common.variables import *
+
+
+# Формирование пакетов протокола на стороне клиента.
+# Общие для клиента с GUI (ClientCore / ClientTransport) и клиента без GUI на asyncio (AsyncClient).
+
+def password_hash(username, password):
+    # Хэш пароля, в качестве соли - логин в нижнем регистре (так же хэширует диалог регистрации на сервере)
+    passwd_hash = hashlib.pbkdf2_hmac('sha512', password.encode('utf-8'), username.lower().encode('utf-8'), 10000)
+    return binascii.hexlify(passwd_hash)
+
+
+def reconnect_delay(attempt, delay=RECONNECT_DELAY):
+    # Задержка перед попыткой подключения с номером attempt (с нуля): случайное время от нуля
+    # до delay * 2^attempt, но не больше RECONNECT_MAX_DELAY
+    return random.uniform(0, min(RECONNECT_MAX_DELAY, delay * 2 ** attempt))
+
+
+def create_presence(username, pubkey, framing=True, pipelining=True, codecs=None, token=None):
+    # Приветствие серверу. Предлагаем пакеты с заголовком длины, конвейерную обработку запросов
+    # и форматы тела пакетов (codecs - имена в порядке предпочтения).
+    # token - токен из прошлого ответа 200: сервер примет вход без 511, ключ при этом не передаётся
+    # (если токен уже недействителен, ключ уходит в ответе на 511).
+    presence = {
+        ACTION: PRESENCE,
+        TIME: time.time(),
+        USER: {
+            ACCOUNT_NAME: username
+        },
+        FRAMING: framing,
+        PIPELINING: pipelining
+    }
+    if token:
+        presence[TOKEN] = token
+    else:
+        presence[USER][PUBLIC_KEY] = pubkey
+    if codecs:
+        presence[CODEC] = list(codecs)
+    return presence
+
+
+def create_auth_answer(passwd_hash, challenge, pubkey=None):
+    # Ответ на 511: HMAC случайной строки сервера на ключе - хэше пароля.
+    # pubkey - открытый ключ, если он не был передан в PRESENCE (вход по недействительному токену)
+    digest = hmac.new(passwd_hash, challenge.encode('utf-8'), 'MD5').digest()
+    answer = {
+        RESPONSE: 511,
+        DATA: binascii.b2a_base64(digest).decode('ascii')
+    }
+    if pubkey is not None:
+        answer[PUBLIC_KEY] = pubkey
+    return answer
+
+
+def create_message(username, to, message, session_key=None):
+    # session_key - ключ переписки под RSA получателя, если текст зашифрован ключом переписки
+    message_dict = {
+        ACTION: MESSAGE,
+        SENDER: username,
+        DESTINATION: to,
+        TIME: time.time(),
+        MESSAGE_TEXT: message
+    }
+    if session_key is not None:
+        message_dict[SESSION_KEY] = session_key
+    return message_dict
+
+
+def create_contacts_request(username):
+    return {
+        ACTION: GET_CONTACTS,
+        TIME: time.time(),
+        USER: username
+    }
+
+
+def create_users_request(username, version=None, after=None, limit=None):
+    # version - известная клиенту версия справочника (ответ - изменения после неё),
+    # after и limit - страница справочника. Без параметров сервер возвращает весь справочник.
+    request = {
+        ACTION: USERS_REQUEST,
+        TIME: time.time(),
+        ACCOUNT_NAME: username
+    }
+    if version is not None:
+        request[DIRECTORY_VERSION] = version
+    if after is not None:
+        request[PAGE_AFTER] = after
+    if limit is not None:
+        request[PAGE_SIZE] = limit
+    return request
+
+
+def create_key_request(user):
+    return {
+        ACTION: PUBLIC_KEY_REQUEST,
+        TIME: time.time(),
+        ACCOUNT_NAME: user
+    }
+
+
+def create_contact_change(action, username, contact):
+    # Добавление (ADD_CONTACT) или удаление (REMOVE_CONTACT) контакта
+    return {
+        ACTION: action,
+        TIME: time.time(),
+        USER: username,
+        ACCOUNT_NAME: contact
+    }
+
+
+def create_exit(username):
+    return {
+        ACTION: EXIT,
+        TIME: time.time(),
+        ACCOUNT_NAME: username
+    }
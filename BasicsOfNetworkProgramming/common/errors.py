@@ -3,4 +3,13 @@ class ServerError(Exception):
         self.text = text
 
     def __str__(self):
-        return self.text
\ No newline at end of file
+        return self.text
+
+
+class ProtocolError(Exception):
+    # Нарушение формата обмена (например, превышен размер пакета)
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        return self.text
@@ -1,22 +1,244 @@
+import binascii
+import errno
+import hashlib
 import json
+import struct
 import sys
-from common.variables import MAX_PACKAGE_LENGTH, ENCODING
+from common.variables import MAX_PACKAGE_LENGTH, MAX_FRAME_LENGTH, ENCODING, REQUEST_ID, RESPONSE_200, RESPONSE_205
 sys.path.append('../')
 from common.decos import log
+from common.errors import ProtocolError
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
-@log
-def get_message(client):
-    encoded_response = client.recv(MAX_PACKAGE_LENGTH)
-    json_response = encoded_response.decode(ENCODING)
-    response = json.loads(json_response)
+# Заголовок пакета в режиме с разметкой: длина тела, 4 байта, сетевой порядок.
+FRAME_HEADER = struct.Struct('!I')
+
+
+def json_default(value):
+    # Байты (шифротекст) в JSON передаются строкой base64, получатель принимает и строку, и байты
+    if isinstance(value, (bytes, bytearray)):
+        return binascii.b2a_base64(value, newline=False).decode('ascii')
+    raise TypeError(f'Тип {type(value).__name__} не сериализуется в JSON')
+
+
+class JsonCodec:
+    # Формат по умолчанию и единственный формат до окончания авторизации
+    name = 'json'
+
+    def __init__(self):
+        self.encoder = json.JSONEncoder(default=json_default)
+
+    def dumps(self, message):
+        return self.encoder.encode(message).encode(ENCODING)
+
+    def loads(self, data):
+        return json.loads(bytes(data).decode(ENCODING))
+
+
+class MsgpackCodec:
+    # Двоичный формат: компактнее JSON, байты передаются как есть, без base64.
+    # Не разделяет пакеты сам, поэтому используется только вместе с заголовком длины.
+    name = 'msgpack'
+
+    def dumps(self, message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    def loads(self, data):
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except ValueError as err:
+            raise ProtocolError(f'Некорректный пакет msgpack: {err}')
+
+
+# Доступные кодеки в порядке предпочтения (двоичный - если установлен msgpack).
+# Клиент предлагает их при PRESENCE, сервер выбирает первый известный ему.
+JSON_CODEC = JsonCodec()
+CODECS = {codec.name: codec for codec in ([MsgpackCodec()] if msgpack else []) + [JSON_CODEC]}
+
+
+def choose_codec(offered):
+    # Первый из предложенных клиентом кодеков, который поддерживает эта сторона
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return JSON_CODEC
+
+
+class EncodedReply:
+    # Постоянный ответ, закодированный один раз: готовые пакеты в обоих форматах обмена.
+    # Номер запроса (конвейерный режим) дописывается к готовому телу без повторной сериализации.
+    # Для других кодеков ответ без номера запроса кодируется при первом использовании и тоже сохраняется.
+    def __init__(self, message):
+        self.message = dict(message)
+        body = json.dumps(self.message).encode(ENCODING)
+        self.plain = body
+        self.framed = FRAME_HEADER.pack(len(body)) + body
+        # Тело без закрывающей скобки и начало поля номера запроса
+        self.prefix = body[:-1] + b', ' + json.dumps(REQUEST_ID).encode(ENCODING) + b': '
+        self.encoded = dict()
+
+    def encode(self, framed=False, request_id=None, codec=None):
+        if codec is not None and codec is not JSON_CODEC:
+            if request_id is not None:
+                return encode_message(dict(self.message, **{REQUEST_ID: request_id}), framed, codec)
+            key = (codec.name, framed)
+            if key not in self.encoded:
+                self.encoded[key] = encode_message(self.message, framed, codec)
+            return self.encoded[key]
+        if request_id is None:
+            return self.framed if framed else self.plain
+        # Номер запроса клиента - целое число, его запись в JSON совпадает со str()
+        if type(request_id) is int:
+            body = b'%s%d}' % (self.prefix, request_id)
+        else:
+            body = self.prefix + json.dumps(request_id).encode(ENCODING) + b'}'
+        if framed:
+            return FRAME_HEADER.pack(len(body)) + body
+        return body
+
+
+# Готовые постоянные ответы сервера
+REPLY_200 = EncodedReply(RESPONSE_200)
+REPLY_205 = EncodedReply(RESPONSE_205)
+
+
+def key_fingerprint(pubkey):
+    # Отпечаток открытого ключа: одинаково считается сервером (токены) и клиентом (кэш ключей)
+    return hashlib.sha256(pubkey.encode(ENCODING)).hexdigest()[:32] if pubkey else ''
+
+
+def encode_message(message, framed=False, codec=None):
+    # Словарь -> байты для отправки. В режиме с разметкой перед телом ставится заголовок длины.
+    # codec - согласованный с собеседником формат тела (по умолчанию JSON).
+    # Заранее закодированный ответ отдаётся готовыми байтами.
+    if isinstance(message, EncodedReply):
+        return message.encode(framed, codec=codec)
+    if not isinstance(message, dict):
+        raise TypeError
+    encoded_message = (codec or JSON_CODEC).dumps(message)
+    if framed:
+        return FRAME_HEADER.pack(len(encoded_message)) + encoded_message
+    return encoded_message
+
+
+def decode_message(encoded_message, codec=None):
+    # Байты тела пакета -> словарь
+    response = (codec or JSON_CODEC).loads(encoded_message)
     if isinstance(response, dict):
         return response
     else:
         raise TypeError
 
+
+def json_closed(text, start):
+    # Закрыт ли первый объект (массив) JSON в text: скобки считаются вне строк
+    if text[start] not in '{[':
+        return True
+    depth = 0
+    in_string = escaped = False
+    for char in text[start:]:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            depth += 1
+        elif char in '}]':
+            depth -= 1
+            if depth == 0:
+                return True
+    return False
+
+
+class MessageDecoder:
+    # Потоковый разборщик входящих данных одного соединения.
+    # Копит неполные пакеты между вызовами recv и отдаёт все целые пакеты из буфера.
+    # framed = False - старый формат (голый JSON), True - пакеты с заголовком длины.
+    # Режим можно переключить в любой момент, остаток буфера будет разобран уже в новом формате.
+    # codec - формат тела пакетов с заголовком длины, старый формат - всегда JSON.
+    def __init__(self, framed=False, codec=None):
+        self.framed = framed
+        self.codec = codec or JSON_CODEC
+        self.buffer = bytearray()
+        self.json_decoder = json.JSONDecoder()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_message(self):
+        # Следующий целый пакет из буфера или None, если данных пока недостаточно.
+        if self.framed:
+            if len(self.buffer) < FRAME_HEADER.size:
+                return None
+            length, = FRAME_HEADER.unpack_from(self.buffer)
+            if length > MAX_FRAME_LENGTH:
+                raise ProtocolError(f'Слишком большой пакет: {length} байт.')
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end:
+                return None
+            payload = bytes(self.buffer[FRAME_HEADER.size:end])
+            del self.buffer[:end]
+            return decode_message(payload, self.codec)
+        # Старый формат: выделяем первый JSON объект, остаток (склеенные TCP пакеты) оставляем в буфере.
+        # surrogateescape - за JSON могут идти уже бинарные данные нового формата.
+        text = self.buffer.decode(ENCODING, 'surrogateescape')
+        start = len(text) - len(text.lstrip())
+        if start == len(text):
+            self.buffer.clear()
+            return None
+        try:
+            response, end = self.json_decoder.raw_decode(text, start)
+        except json.JSONDecodeError:
+            # Объект, разрезанный TCP, ждёт продолжения; ошибкой считается только некорректный закрытый объект
+            if not json_closed(text, start):
+                if len(self.buffer) > MAX_FRAME_LENGTH:
+                    raise ProtocolError(f'Слишком большой пакет: {len(self.buffer)} байт.')
+                return None
+            raise
+        del self.buffer[:len(text[:end].encode(ENCODING, 'surrogateescape'))]
+        if isinstance(response, dict):
+            return response
+        else:
+            raise TypeError
+
+    def messages(self):
+        # Все целые пакеты, накопленные в буфере.
+        message = self.next_message()
+        while message is not None:
+            yield message
+            message = self.next_message()
+
+
 @log
-def send_message(sock, message):
-    js_message = json.dumps(message)
-    encoded_message = js_message.encode(ENCODING)
-    sock.send(encoded_message)
+def get_message(client, decoder=None):
+    # Без разборщика - старое поведение: один recv, один пакет.
+    if decoder is None:
+        encoded_response = client.recv(MAX_PACKAGE_LENGTH)
+        return decode_message(encoded_response)
+    # С разборщиком читаем, пока не наберётся целый пакет.
+    response = decoder.next_message()
+    while response is None:
+        data = client.recv(MAX_PACKAGE_LENGTH)
+        if not data:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение закрыто.')
+        decoder.feed(data)
+        response = decoder.next_message()
+    return response
+
+
+@log
+def send_message(sock, message, framed=False, codec=None):
+    encoded_message = encode_message(message, framed, codec)
+    if framed:
+        sock.sendall(encoded_message)
+    else:
+        sock.send(encoded_message)
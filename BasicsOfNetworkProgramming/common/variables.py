@@ -1,12 +1,74 @@
 import logging
+from types import MappingProxyType
 
 DEFAULT_PORT = 7777
 DEFAULT_IP_ADDRESS = '127.0.0.1'
-MAX_CONNECTIONS = 5
+# Очередь ожидающих приёма подключений (backlog слушающего сокета). При переполнении ядро отбрасывает
+# SYN и клиент повторяет попытку только через секунду, поэтому очередь рассчитана на волну переподключений.
+MAX_CONNECTIONS = 4096
 MAX_PACKAGE_LENGTH = 10240
+# Максимальный размер пакета в режиме с заголовком длины
+MAX_FRAME_LENGTH = 1048576
+# Время ожидания ответа сервера на запрос клиента, секунд
+REQUEST_TIMEOUT = 5
 ENCODING = 'utf-8'
 LOGGING_LEVEL = logging.DEBUG
+# Очередь записи логов: размер (при переполнении записи отбрасываются), формат JSON lines
+# и выборочная запись {имя логгера: писать каждую N-ю запись ниже WARNING}
+LOG_QUEUE_SIZE = 10000
+LOG_JSON = False
+LOG_SAMPLING = {}
+# Трассировка вызовов функций, отмеченных декоратором log (дополнительно требует уровень DEBUG)
+TRACE_CALLS = True
 SERVER_CONFIG = 'server_dist+++.ini'
+# Пакетная запись статистики сообщений: интервал сброса (секунд) и порог количества сообщений
+STATS_FLUSH_INTERVAL = 1
+STATS_FLUSH_COUNT = 1000
+# Очередь сообщений для пользователей не в сети: максимум сообщений на получателя и срок хранения, секунд
+OFFLINE_QUEUE_LIMIT = 500
+OFFLINE_MESSAGE_TTL = 7 * 24 * 3600
+# Буфер исходящих данных соединения, байт: выше верхней границы чтение от клиента приостанавливается,
+# ниже нижней - возобновляется, при превышении максимума клиент отключается
+WRITE_BUFFER_HIGH = 262144
+WRITE_BUFFER_LOW = 65536
+WRITE_BUFFER_LIMIT = 4194304
+# Профиль хранилища сервера по умолчанию (переопределяется в server.ini): режим журнала, уровень синхронизации,
+# кэш страниц (отрицательное значение - в КиБ), соединений в пуле, ожидание блокировки записи, секунд
+DATABASE_PROFILE = {
+    # Хранилище: sqlite (файл из настроек), sql (сетевая СУБД по url), memory (в памяти, для тестов)
+    'backend': 'sqlite',
+    'url': '',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16384,
+    'pool_size': 5,
+    'busy_timeout': 5,
+}
+# Справочник пользователей: максимум имён в одном ответе (страница или список изменений)
+USERS_PAGE_SIZE = 1000
+# Окно накопления изменений справочника перед рассылкой 205, секунд
+UPDATE_DEBOUNCE = 0.5
+# Авторизация: потоков для записи входа в хранилище (0 - в сетевом потоке)
+# и время на ответ клиента на 511, секунд. SQLite допускает одного пишущего, остальные потоки
+# ждут блокировку, поэтому для файловой базы один поток быстрее нескольких.
+AUTH_WORKERS = 1
+AUTH_TIMEOUT = 10
+# Срок действия токена возобновления сессии, секунд. Токен разовый: каждый вход выдаёт новый, прежние гаснут
+SESSION_TOKEN_TTL = 900
+# Подключение клиента: попыток при запуске и при восстановлении потерянного соединения,
+# начальная и максимальная задержка между попытками, секунд (задержка удваивается с каждой попыткой,
+# клиент ждёт случайное время до неё, чтобы после перезапуска сервера клиенты не подключались разом)
+CONNECT_ATTEMPTS = 5
+RECONNECT_ATTEMPTS = 12
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+# Шифрование сообщений пользователей (client/crypto.py): rsa - каждое сообщение ключом RSA получателя,
+# hybrid - ключ переписки, переданный под RSA, и ChaCha20-Poly1305 для каждого сообщения
+ENCRYPTION_MODES = ('rsa', 'hybrid')
+MESSAGE_ENCRYPTION = 'hybrid'
+# Доступные движки сервера
+SERVER_ENGINES = ('select', 'asyncio')
+DEFAULT_ENGINE = 'select'
 
 ACTION = 'action'
 TIME = 'time'
@@ -16,32 +78,56 @@ SENDER = 'from'
 DESTINATION = 'to'
 DATA = 'bin'
 PUBLIC_KEY = 'pubkey'
+# Флаг поддержки пакетов с заголовком длины (согласуется при PRESENCE)
+FRAMING = 'framing'
+# Флаг конвейерной обработки запросов и номер запроса для сопоставления ответов
+PIPELINING = 'pipelining'
+# Формат тела пакетов: в PRESENCE - список поддерживаемых клиентом, в ответе 200 - выбранный сервером
+CODEC = 'codec'
+# Токен возобновления сессии: в ответе 200 - новый токен, в PRESENCE - вход без 511 и передачи ключа
+TOKEN = 'token'
+REQUEST_ID = 'req_id'
 
 PRESENCE = 'presence'
 RESPONSE = 'response'
 ERROR = 'error'
 MESSAGE = 'message'
 MESSAGE_TEXT = 'mess_text'
+# Ключ переписки, зашифрованный открытым ключом получателя (гибридное шифрование сообщений)
+SESSION_KEY = 'session_key'
 EXIT = 'exit'
 GET_CONTACTS = 'get_contacts'
 LIST_INFO = 'data_list'
 REMOVE_CONTACT = 'remove'
 ADD_CONTACT = 'add'
 USERS_REQUEST = 'get_users'
+# Справочник пользователей: версия справочника, постраничная выдача (имя, после которого начинается страница,
+# размер страницы, начало следующей страницы) и изменения с известной клиенту версии (признак и удалённые имена).
+# Рассылка 205 несёт те же поля изменений, что и ответ на запрос справочника.
+DIRECTORY_VERSION = 'version'
+PAGE_AFTER = 'after'
+PAGE_SIZE = 'limit'
+NEXT_PAGE = 'next'
+DELTA = 'delta'
+REMOVED = 'removed'
+# Версия справочника, от которой отсчитаны изменения в рассылке 205
+PREVIOUS_VERSION = 'since'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
 
-RESPONSE_200 = {RESPONSE: 200}
-RESPONSE_202 = {RESPONSE: 202,
-                LIST_INFO: None
-                }
-RESPONSE_400 = {
+# Шаблоны ответов общие для всех потоков, поэтому только для чтения:
+# ответ собирается в копии (RESPONSE_400.copy()), постоянные ответы отправляются готовыми байтами (common.utils)
+RESPONSE_200 = MappingProxyType({RESPONSE: 200})
+RESPONSE_202 = MappingProxyType({RESPONSE: 202,
+                                 LIST_INFO: None
+                                 })
+RESPONSE_400 = MappingProxyType({
     RESPONSE: 400,
     ERROR: None
-}
-RESPONSE_205 = {
+})
+RESPONSE_205 = MappingProxyType({
     RESPONSE: 205
-}
-RESPONSE_511 = {
+})
+RESPONSE_511 = MappingProxyType({
     RESPONSE: 511,
     DATA: None
-}
+})
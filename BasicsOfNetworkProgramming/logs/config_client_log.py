@@ -3,7 +3,8 @@ import os
 
 sys.path.insert(0, os.path.join(os.getcwd(), '..'))
 import logging.handlers
-from common.variables import LOGGING_LEVEL
+from common.variables import LOGGING_LEVEL, LOG_QUEUE_SIZE, LOG_JSON, LOG_SAMPLING
+from logs.pipeline import setup_logging, JsonFormatter
 
 client_formatter = logging.Formatter('%(asctime)s %(levelname)s %(filename)s %(message)s')
 path = os.path.dirname(os.path.abspath(__file__))
@@ -14,12 +15,13 @@ path = os.path.join(path, 'client.log')
 # logstream.setLevel(logging.DEBUG)
 
 logfile = logging.handlers.TimedRotatingFileHandler(path, encoding='utf-8', interval=1, when='D')
-logfile.setFormatter(client_formatter)
+logfile.setFormatter(JsonFormatter() if LOG_JSON else client_formatter)
 
+# Файл пишет отдельный поток, логгеры только ставят записи в очередь.
+# client_dist - логгер модулей client/, пишется в тот же файл.
+queue_handler, listener = setup_logging(('client', 'client_dist'), logfile, LOGGING_LEVEL, LOG_QUEUE_SIZE, LOG_SAMPLING)
 logger = logging.getLogger('client')
 # logger.addHandler(logstream)
-logger.addHandler(logfile)
-logger.setLevel(LOGGING_LEVEL)
 
 if __name__ == '__main__':
     logger.debug('debug message')
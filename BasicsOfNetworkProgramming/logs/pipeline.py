@@ -0,0 +1,137 @@
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+
+
+# Асинхронная запись логов: логгеры кладут записи в ограниченную очередь,
+# отдельный поток QueueListener форматирует их и пишет в файл.
+# При переполнении очереди запись отбрасывается и учитывается в счётчике,
+# сетевой поток никогда не ждёт диск.
+# Процесс, порождённый через fork (обработчики шардированного сервера), наследует обработчики очереди,
+# но не потоки записи: в дочернем процессе очереди пересоздаются и потоки запускаются заново.
+# Дочерние процессы multiprocessing завершаются без atexit, поэтому перед выходом вызывают flush_logs.
+
+# Запущенные пары (обработчик очереди, QueueListener)
+listeners = []
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    # Обработчик с неблокирующей постановкой в очередь и подсчётом отброшенных записей
+    def __init__(self, maxsize):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        # Отброшено с момента последнего предупреждения в лог
+        self.unreported = 0
+        self.drop_lock = threading.Lock()
+
+    def prepare(self, record):
+        # Форматирование откладывается до потока записи: в очередь уходит сама запись.
+        # Исключение превращаем в текст сразу, пока жив стек.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.drop_lock:
+                self.dropped += 1
+                self.unreported += 1
+            return
+        if self.unreported:
+            # Очередь освободилась - сообщаем в лог, сколько записей потеряно
+            with self.drop_lock:
+                count, self.unreported = self.unreported, 0
+            warning = logging.makeLogRecord({
+                'name': record.name, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': 'Очередь логов переполнена, отброшено записей: %s', 'args': (count,)})
+            try:
+                self.queue.put_nowait(warning)
+            except queue.Full:
+                with self.drop_lock:
+                    self.unreported += count
+
+
+class SamplingFilter(logging.Filter):
+    # Выборочная запись: для логгеров из словаря {имя: N} пишется каждая N-я запись уровня ниже WARNING.
+    # Предупреждения и ошибки пишутся всегда.
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self.counters = dict()
+
+    def filter(self, record):
+        rate = self.rates.get(record.name)
+        if not rate or rate <= 1 or record.levelno >= logging.WARNING:
+            return True
+        count = self.counters.get(record.name, 0)
+        self.counters[record.name] = count + 1
+        return count % rate == 0
+
+
+class JsonFormatter(logging.Formatter):
+    # Структурированный вывод: одна запись - одна строка JSON
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'file': record.filename,
+            'message': record.getMessage(),
+        }
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False)
+
+
+def setup_logging(names, handler, level, queue_size, sampling=None):
+    # Подключение логгеров names к очереди, запись в handler выполняет отдельный поток.
+    # Возвращает обработчик очереди (счётчик dropped) и запущенный QueueListener.
+    queue_handler = BoundedQueueHandler(queue_size)
+    if sampling:
+        queue_handler.addFilter(SamplingFilter(sampling))
+    for name in names:
+        logger = logging.getLogger(name)
+        logger.addHandler(queue_handler)
+        logger.setLevel(level)
+    listener = logging.handlers.QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    listener.start()
+    listeners.append((queue_handler, listener))
+    # При завершении процесса дописываем всё, что осталось в очереди
+    atexit.register(stop_listener, listener)
+    return queue_handler, listener
+
+
+def stop_listener(listener):
+    # Остановка потока записи, повторный вызов ничего не делает
+    if listener._thread is not None:
+        listener.stop()
+
+
+def flush_logs():
+    # Запись всех накопленных записей и остановка потоков записи текущего процесса
+    for _, listener in listeners:
+        stop_listener(listener)
+
+
+def restart_after_fork():
+    # Вызывается в дочернем процессе: записи родителя в унаследованной очереди уже не его,
+    # очередь заменяется новой, поток записи запускается заново
+    for queue_handler, listener in listeners:
+        if listener._thread is None:
+            continue
+        queue_handler.queue = listener.queue = queue.Queue(queue_handler.queue.maxsize)
+        queue_handler.drop_lock = threading.Lock()
+        queue_handler.dropped = queue_handler.unreported = 0
+        listener._thread = None
+        listener.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=restart_after_fork)
@@ -9,7 +9,9 @@ from common.variables import *
 from common.utils import *
 from common.decos import log
 from server.core import MessageProcessor
-from server.database import ServerStorage
+from server.async_core import AsyncMessageProcessor
+from server.cluster import ShardedServer
+from server.storage import create_storage
 from server.main_window import MainWindow
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtCore import Qt
@@ -18,18 +20,22 @@ logger = logging.getLogger('server_dist')
 
 
 @log
-def arg_parser(default_port, default_address):
+def arg_parser(default_port, default_address, default_engine, default_workers):
     logger.debug(f'Инициализация парсера аргументов командной строки: {sys.argv}')
     parser = argparse.ArgumentParser()
     parser.add_argument('-p', default=default_port, type=int, nargs='?')
     parser.add_argument('-a', default=default_address, nargs='?')
     parser.add_argument('--no_gui', action='store_true')
+    parser.add_argument('--engine', default=default_engine, choices=SERVER_ENGINES)
+    parser.add_argument('--workers', default=default_workers, type=int)
     namespace = parser.parse_args(sys.argv[1:])
     listen_address = namespace.a
     listen_port = namespace.p
     gui_flag = namespace.no_gui
+    engine = namespace.engine
+    workers = namespace.workers
     logger.debug('Аргументы успешно загружены.')
-    return listen_address, listen_port, gui_flag
+    return listen_address, listen_port, gui_flag, engine, workers
 
 
 @log
@@ -47,6 +53,12 @@ def config_load():
         config.set('SETTINGS', 'Listen_Address', '')
         config.set('SETTINGS', 'Database_path', '')
         config.set('SETTINGS', 'Database_file', 'server_database.db3')
+        config.set('SETTINGS', 'Engine', DEFAULT_ENGINE)
+        config.set('SETTINGS', 'Workers', '1')
+        # Профиль хранилища
+        config.add_section('DATABASE')
+        for key, value in DATABASE_PROFILE.items():
+            config.set('DATABASE', key, str(value))
         return config
 
 
@@ -55,15 +67,34 @@ def main():
     # Загрузка файла конфигурации сервера
     config = config_load()
     # Загрузка параметров командной строки, если нет параметров, то задаём значения по умолчанию.
-    listen_address, listen_port, gui_flag = arg_parser(
-        config['SETTINGS']['Default_port'], config['SETTINGS']['Listen_Address'])
+    listen_address, listen_port, gui_flag, engine, workers = arg_parser(
+        config['SETTINGS']['Default_port'], config['SETTINGS']['Listen_Address'],
+        config['SETTINGS'].get('Engine', DEFAULT_ENGINE), config['SETTINGS'].get('Workers', '1'))
 
-    database = ServerStorage(
-        os.path.join(
-            config['SETTINGS']['Database_path'],
-            config['SETTINGS']['Database_file']))
+    database_path = os.path.join(
+        config['SETTINGS']['Database_path'],
+        config['SETTINGS']['Database_file'])
+    # Профиль хранилища (вид хранилища, WAL, синхронизация, кэш, пул), недостающие параметры - по умолчанию
+    database_profile = dict(config['DATABASE']) if 'DATABASE' in config else None
 
-    server = MessageProcessor(listen_address, listen_port, database)
+    # Шардированный режим: несколько процессов-обработчиков на одном порту, без графической оболочки.
+    if workers > 1:
+        cluster = ShardedServer(listen_address, listen_port, database_path, workers, database_profile)
+        cluster.start()
+        while True:
+            command = input('Введите exit для завершения работы сервера.')
+            if command == 'exit':
+                cluster.stop()
+                break
+        return
+
+    database = create_storage(database_path, database_profile)
+
+    # Выбор движка сервера: select (по умолчанию) или asyncio
+    if engine == 'asyncio':
+        server = AsyncMessageProcessor(listen_address, listen_port, database)
+    else:
+        server = MessageProcessor(listen_address, listen_port, database)
     server.daemon = True
     server.start()
 
@@ -83,6 +114,10 @@ def main():
         server_app.exec_()
 
         server.running = False
+        server.join()
+
+    # Дописываем в БД накопленную статистику сообщений
+    database.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import errno
+import json
+import sys
+import time
+
+sys.path.append('../')
+from common.variables import *
+from common.utils import MessageDecoder
+from common.errors import ProtocolError
+from server.core import MessageProcessor
+
+logger = logging.getLogger('server_dist')
+
+
+class ClientConnection:
+    # Соединение с клиентом для asyncio движка.
+    # Повторяет интерфейс сокета, который использует MessageProcessor (send, getpeername, close),
+    # поэтому обработчики сообщений базового класса работают с ним без изменений.
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        # Разборщик входящего потока (буфер неполных пакетов и формат обмена)
+        self.decoder = MessageDecoder()
+        # Очередь исходящих пакетов, её разбирает задача-писатель соединения.
+        self.outbox = asyncio.Queue()
+        # Объём неотправленных данных и событие "буфер ниже нижней границы"
+        self.buffered = 0
+        self.drained = asyncio.Event()
+        self.drained.set()
+        # Соединение, освобождения буфера которого ждёт чтение этого клиента
+        self.blocked_by = None
+        self.writer_task = asyncio.get_running_loop().create_task(self.write_loop())
+        self.closed = False
+
+    def send(self, data):
+        # Не блокирует цикл событий: пакет уходит в очередь задачи-писателя.
+        # Клиент, не успевающий принимать данные, отключается (OSError, как при обрыве связи).
+        if self.closed:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение закрыто.')
+        if self.buffered + len(data) > WRITE_BUFFER_LIMIT:
+            raise ConnectionAbortedError(errno.ECONNABORTED, 'Клиент не успевает принимать данные.')
+        self.buffered += len(data)
+        if self.buffered > WRITE_BUFFER_HIGH:
+            self.drained.clear()
+        self.outbox.put_nowait(data)
+        return len(data)
+
+    sendall = send
+
+    async def write_loop(self):
+        # Задача-писатель: отправляет пакеты из очереди, ожидая освобождения буфера сокета.
+        try:
+            while True:
+                data = await self.outbox.get()
+                if data is None:
+                    break
+                self.writer.write(data)
+                await self.writer.drain()
+                self.buffered -= len(data)
+                if self.buffered <= WRITE_BUFFER_LOW:
+                    self.drained.set()
+        except (OSError, asyncio.CancelledError):
+            pass
+        finally:
+            self.closed = True
+            self.drained.set()
+            self.writer.close()
+
+    async def wait_writable(self):
+        # Ожидание, пока буферы этого соединения и соединения, которому оно пишет, не освободятся
+        await self.drained.wait()
+        if self.blocked_by is not None:
+            await self.blocked_by.drained.wait()
+            self.blocked_by = None
+
+    async def recv(self):
+        # Получение одного целого пакета от клиента (аналог get_message).
+        message = self.decoder.next_message()
+        while message is None:
+            data = await self.reader.read(MAX_PACKAGE_LENGTH)
+            if not data:
+                raise ConnectionResetError('Клиент закрыл соединение.')
+            self.decoder.feed(data)
+            message = self.decoder.next_message()
+        return message
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')[:2]
+
+    def close(self):
+        # Закрываем после отправки уже поставленных в очередь пакетов.
+        if not self.closed:
+            self.closed = True
+            self.drained.set()
+            self.outbox.put_nowait(None)
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    # Альтернативный движок сервера на asyncio.
+    # Один цикл событий, на каждое соединение задача-читатель и задача-писатель.
+    # Протокол и вызовы ServerStorage те же, что и у MessageProcessor.
+    def __init__(self, listen_address, listen_port, database):
+        super().__init__(listen_address, listen_port, database)
+        self.loop = None
+        self.server = None
+        # Отложенная рассылка 205
+        self.updates_handle = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        logger.info(
+            f'Запущен сервер (asyncio), порт для подключений: {self.port} , '
+            f'адрес с которого принимаются подключения: {self.addr}.')
+        self.server = await self.start_server()
+        # Флаг running выставляется из другого потока, поэтому периодически его проверяем.
+        while self.running:
+            await asyncio.sleep(0.5)
+        self.server.close()
+        await self.server.wait_closed()
+        for client in list(self.clients):
+            self.remove_client(client)
+
+    async def start_server(self):
+        # Слушающий сокет сервера
+        return await asyncio.start_server(self.handle_connection, self.addr or None, self.port,
+                                          reuse_address=True, backlog=MAX_CONNECTIONS)
+
+    async def handle_connection(self, reader, writer):
+        # Задача-читатель соединения.
+        client = ClientConnection(reader, writer)
+        logger.info(f'Установлено соедение с ПК {client.getpeername()}')
+        self.clients.append(client)
+        try:
+            while self.running and client in self.clients:
+                # Пока клиент не читает ответы или его получатель не успевает, новые запросы не читаем
+                await client.wait_writable()
+                message = await client.recv()
+                if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
+                    await self.autorize_user_async(message, client)
+                else:
+                    self.process_client_message(message, client)
+        except (OSError, asyncio.TimeoutError, json.JSONDecodeError, TypeError, UnicodeDecodeError, ProtocolError) as err:
+            logger.debug(f'Getting data from client exception.', exc_info=err)
+            if client in self.clients:
+                self.remove_client(client)
+
+    def remove_client(self, client):
+        # Из GUI потока (удаление пользователя) перекладываем работу в цикл событий.
+        if self.loop and not self.in_loop():
+            self.loop.call_soon_threadsafe(self.remove_client, client)
+            return
+        if client in self.clients:
+            super().remove_client(client)
+
+    def in_loop(self):
+        # Вызов из цикла событий сервера
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    def client_decoder(self, client):
+        return client.decoder
+
+    def wire_format(self, client):
+        return client.decoder.framed, client.decoder.codec
+
+    def write(self, client, data):
+        client.send(data)
+
+    def service_update_lists(self):
+        # Вызывается из GUI потока, рассылка выполняется в цикле событий по окончании окна накопления.
+        super().service_update_lists()
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.schedule_updates)
+
+    def schedule_updates(self):
+        deadline = self.updates_deadline
+        if self.updates_handle is None and deadline is not None:
+            self.updates_handle = self.loop.call_later(max(deadline - time.monotonic(), 0),
+                                                       self.send_scheduled_updates)
+
+    def send_scheduled_updates(self):
+        self.updates_handle = None
+        self.send_updates()
+        # Таймер мог сработать чуть раньше срока - тогда откладываем ещё раз
+        self.schedule_updates()
+
+    def buffer_size(self, client):
+        return client.buffered
+
+    def pause_reading(self, client, blocker):
+        # Задача-читатель отправителя ждёт события drained получателя
+        client.blocked_by = blocker
+
+    def login_stored(self, handler, *args):
+        # Результат записи входа обрабатывается в цикле событий
+        try:
+            self.loop.call_soon_threadsafe(handler, *args)
+        except RuntimeError:
+            # Цикл событий уже остановлен
+            pass
+
+    async def claim_name_async(self, username, client):
+        # Закрепление имени из задачи соединения (в шардированном режиме - с обращением к общему словарю)
+        return self.claim_name(username, client)
+
+    async def autorize_user_async(self, message, client):
+        # Авторизация без блокировки остальных соединений: ответ на 511 ждём через await.
+        logger.debug(f'Start auth process for {message[USER]}')
+        username = message[USER][ACCOUNT_NAME]
+        if self.user_online(username):
+            self.reject_client(client, 'Имя пользователя уже занято.')
+            return
+        if not self.database.check_user(username):
+            self.reject_client(client, 'Пользователь не зарегистрирован.')
+            return
+        expected = self.check_token(message) if TOKEN in message else None
+        if expected is not None:
+            # Действительный токен - вход без 511, если номер токена удалось заменить новым (в пуле потоков)
+            nonce = self.create_nonce()
+            try:
+                swapped = await self.loop.run_in_executor(self.auth_pool, self.database.swap_token, username,
+                                                          expected, nonce)
+            except Exception as err:
+                logger.error(f'Не удалось проверить токен пользователя {username}: {err}')
+                swapped = False
+            if client not in self.clients:
+                # Клиент отключился, пока заменялся номер
+                return
+            if swapped:
+                if not await self.claim_name_async(username, client):
+                    self.reject_client(client, 'Имя пользователя уже занято.')
+                    return
+                self.accept_session(message, client, None, nonce)
+                return
+        logger.debug('Correct username, starting passwd check.')
+        message_auth, digest = self.create_challenge(username)
+        self.send(client, message_auth)
+        # Не ответивший вовремя клиент отключается
+        ans = await asyncio.wait_for(client.recv(), self.auth_timeout)
+        if self.check_digest(ans, digest):
+            # Пока ждали ответ, имя мог занять другой клиент.
+            if not await self.claim_name_async(username, client):
+                self.reject_client(client, 'Имя пользователя уже занято.')
+                return
+            self.accept_session(message, client, message[USER].get(PUBLIC_KEY, ans.get(PUBLIC_KEY)))
+        else:
+            self.reject_client(client, 'Неверный пароль.')
@@ -0,0 +1,382 @@
+import asyncio
+import multiprocessing
+import errno
+import tempfile
+import threading
+import logging
+import time
+import socket
+import json
+import os
+import sys
+
+sys.path.append('../')
+from common.variables import *
+from common.utils import encode_message, decode_message
+from server.async_core import AsyncMessageProcessor
+from logs.pipeline import flush_logs
+
+logger = logging.getLogger('server_dist')
+
+# Служебные пакеты между процессами (по тем же Unix-сокетам, что и пересылаемые сообщения):
+# имя закреплено за процессом SHARD / освобождено им
+ROUTE_CLAIM = 'shard_claim'
+ROUTE_RELEASE = 'shard_release'
+SHARD = 'shard'
+# в очереди сообщений не в сети есть сообщения для подключённого к процессу пользователя
+ROUTE_DELIVER = 'shard_deliver'
+# Наибольший пересылаемый пакет, байт: меньше размера буфера Unix-сокета по умолчанию.
+# Сообщение больше передаётся через очередь сообщений не в сети.
+ROUTE_DATAGRAM_LIMIT = 65536
+# Период проверки версии справочника пользователей, секунд: регистрации и смены ключей в других процессах
+USERS_REFRESH_INTERVAL = 1
+# Период проверки процессов-обработчиков, секунд
+SUPERVISE_INTERVAL = 1
+# Период сверки локальной копии присутствия с общим словарем, секунд: исправляет копию,
+# если служебный пакет всё же не дошёл (процесс-получатель перезапускался или не разбирал очередь)
+PRESENCE_RESYNC_INTERVAL = 1
+# Очередь Unix-сокета получателя ограничена (net.unix.max_dgram_qlen, по умолчанию 10 пакетов).
+# При переполнении служебный пакет отправляется повторно, пока получатель разбирает очередь,
+# но не дольше ROUTE_SEND_TIMEOUT секунд
+ROUTE_SEND_TIMEOUT = 0.5
+ROUTE_SEND_RETRY_DELAY = 0.005
+
+
+def route_path(route_dir, shard_id):
+    # Адрес Unix-сокета процесса-обработчика
+    return os.path.join(route_dir, f'shard_{shard_id}.sock')
+
+
+class ShardWorker(AsyncMessageProcessor):
+    # Процесс-обработчик шардированного сервера.
+    # Все процессы слушают один порт (SO_REUSEPORT), ядро распределяет между ними соединения.
+    # Каждый процесс владеет своей частью подключённых пользователей, сообщения для пользователей
+    # других процессов пересылаются через локальные Unix-сокеты.
+    # Присутствие (какой пользователь к какому процессу подключён) хранится в общем словаре,
+    # поэтому проверка "имя занято" действует на весь сервер. Общий словарь - объект Manager,
+    # каждое обращение к нему - запрос к процессу менеджера, поэтому:
+    #     имя закрепляется в общем словаре в потоке пула, цикл событий обращения не ждёт;
+    #     для маршрутизации каждый процесс ведёт локальную копию присутствия пользователей других процессов,
+    #     процессы рассылают друг другу изменения служебными пакетами.
+    def __init__(self, listen_address, listen_port, database, shard_id, presence, presence_lock, route_dir,
+                 shards):
+        super().__init__(listen_address, listen_port, database)
+        self.shard_id = shard_id
+        self.shards = shards
+        # Общие для всех процессов словарь {имя: номер процесса} и блокировка к нему
+        self.presence = presence
+        self.presence_lock = presence_lock
+        # Локальная копия: пользователи других процессов {имя: номер процесса}
+        self.remote = dict()
+        # Изменения присутствия, полученные во время сверки с общим словарём (None - сверки нет)
+        self.resync_updates = None
+        self.route_dir = route_dir
+        self.route_sock = None
+
+    def route_path(self, shard_id):
+        return route_path(self.route_dir, shard_id)
+
+    async def start_server(self):
+        # Сокет для приёма сообщений от других процессов
+        self.route_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # Сокет мог остаться от завершившегося аварийно предшественника
+        if os.path.exists(self.route_path(self.shard_id)):
+            os.remove(self.route_path(self.shard_id))
+        self.route_sock.bind(self.route_path(self.shard_id))
+        self.route_sock.setblocking(False)
+        self.loop.add_reader(self.route_sock, self.process_routed)
+        # Начальная копия присутствия. Сокет уже принимает пакеты, поэтому изменения после копирования не теряются.
+        self.remote = {name: shard_id for name, shard_id in self.presence.items() if shard_id != self.shard_id}
+        self.loop.create_task(self.refresh_users())
+        self.loop.create_task(self.resync_presence())
+        logger.info(f'Запущен обработчик №{self.shard_id}')
+        # Слушающий сокет с SO_REUSEPORT: один порт на все процессы
+        return await asyncio.start_server(self.handle_connection, self.addr or None, self.port,
+                                          reuse_address=True, reuse_port=True, backlog=MAX_CONNECTIONS)
+
+    async def refresh_users(self):
+        # Справочник пользователей общий для процессов, кэш каждого процесса сверяется с версией в базе.
+        # Изменение, сделанное другим процессом, - рассылка 205 своим клиентам.
+        while self.running:
+            await asyncio.sleep(USERS_REFRESH_INTERVAL)
+            try:
+                if await self.loop.run_in_executor(None, self.database.refresh_users):
+                    self.service_update_lists()
+            except Exception as err:
+                logger.error(f'Не удалось обновить справочник пользователей: {err}')
+
+    async def resync_presence(self):
+        # Сверка локальной копии присутствия с общим словарём.
+        # Пакеты, пришедшие, пока запрашивался словарь, могут быть новее копии из него - применяются поверх.
+        while self.running:
+            await asyncio.sleep(PRESENCE_RESYNC_INTERVAL)
+            self.resync_updates = []
+            try:
+                presence = await self.loop.run_in_executor(None, self.presence.copy)
+            except Exception as err:
+                logger.error(f'Не удалось сверить присутствие пользователей: {err}')
+                continue
+            finally:
+                updates, self.resync_updates = self.resync_updates, None
+            self.remote = {name: shard_id for name, shard_id in presence.items() if shard_id != self.shard_id}
+            for message in updates:
+                self.update_remote(message)
+
+    def update_remote(self, message):
+        # Применение служебного пакета об изменении присутствия к локальной копии
+        if message[ACTION] == ROUTE_CLAIM:
+            self.remote[message[ACCOUNT_NAME]] = message[SHARD]
+        # Имя могло быть уже закреплено другим процессом, пакет о котором пришёл раньше
+        elif self.remote.get(message[ACCOUNT_NAME]) == message[SHARD]:
+            del self.remote[message[ACCOUNT_NAME]]
+
+    def process_routed(self):
+        # Доставка сообщений, пересланных другими процессами, и изменения присутствия
+        while True:
+            try:
+                data = self.route_sock.recv(MAX_FRAME_LENGTH)
+            except BlockingIOError:
+                return
+            try:
+                message = decode_message(data)
+            except (json.JSONDecodeError, TypeError, UnicodeDecodeError) as err:
+                logger.error(f'Некорректный пакет от другого обработчика: {err}')
+                continue
+            if message.get(ACTION) in (ROUTE_CLAIM, ROUTE_RELEASE):
+                self.update_remote(message)
+                if self.resync_updates is not None:
+                    self.resync_updates.append(message)
+            elif message.get(ACTION) == ROUTE_DELIVER:
+                if message[ACCOUNT_NAME] in self.names:
+                    self.deliver_offline(message[ACCOUNT_NAME], self.names[message[ACCOUNT_NAME]])
+            else:
+                super().process_message(message)
+
+    def send_route(self, data, shard_id):
+        # Отправка служебного пакета с повтором при переполненной очереди получателя
+        deadline = time.monotonic() + ROUTE_SEND_TIMEOUT
+        while True:
+            try:
+                self.route_sock.sendto(data, self.route_path(shard_id))
+                return
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(ROUTE_SEND_RETRY_DELAY)
+
+    def announce(self, action, name):
+        # Рассылка изменения присутствия остальным процессам
+        data = encode_message({ACTION: action, ACCOUNT_NAME: name, SHARD: self.shard_id})
+        for shard_id in range(self.shards):
+            if shard_id != self.shard_id:
+                try:
+                    self.send_route(data, shard_id)
+                except OSError as err:
+                    logger.warning(f'Обработчик №{shard_id} не получил изменение присутствия: {err}')
+
+    def user_online(self, name):
+        return name in self.names or name in self.remote
+
+    def reserve_name(self, username):
+        # Закрепление имени в общем словаре, выполняется в потоке пула
+        with self.presence_lock:
+            if username in self.presence:
+                return False
+            self.presence[username] = self.shard_id
+        return True
+
+    def release_name(self, username):
+        with self.presence_lock:
+            if self.presence.get(username) == self.shard_id:
+                del self.presence[username]
+
+    async def claim_name_async(self, username, client):
+        # Имя закрепляется атомарно во всём кластере. Решает общий словарь, а не локальная копия:
+        # запись в копии может быть устаревшей.
+        if username in self.names or not await self.loop.run_in_executor(None, self.reserve_name, username):
+            return False
+        self.remote.pop(username, None)
+        if client not in self.clients:
+            # Клиент отключился, пока закреплялось имя
+            self.loop.run_in_executor(None, self.release_name, username)
+            return False
+        self.start_session(username, client)
+        self.announce(ROUTE_CLAIM, username)
+        return True
+
+    def end_session(self, client):
+        name = super().end_session(client)
+        if name is not None and name not in self.names:
+            # Остальным процессам сообщаем после освобождения имени в общем словаре:
+            # иначе сверка копии со словарём могла бы вернуть уже освобождённое имя
+            self.loop.run_in_executor(None, self.release_name, name).add_done_callback(
+                lambda future: self.announce(ROUTE_RELEASE, name))
+        return name
+
+    def process_message(self, message):
+        # Получатель подключён к этому процессу - отправляем сами, иначе пересылаем его процессу.
+        if message[DESTINATION] in self.names:
+            super().process_message(message)
+            return
+        shard_id = self.remote.get(message[DESTINATION])
+        if shard_id is None:
+            # Получателя нет в локальной копии: пакет о его подключении мог ещё не дойти - решает общий словарь
+            self.loop.create_task(self.route_unknown(message))
+            return
+        self.forward(message, shard_id)
+
+    async def route_unknown(self, message):
+        try:
+            shard_id = await self.loop.run_in_executor(None, self.presence.get, message[DESTINATION])
+        except Exception as err:
+            logger.error(f'Не удалось проверить присутствие пользователя {message[DESTINATION]}: {err}')
+            shard_id = None
+        if message[DESTINATION] in self.names:
+            # Получатель подключился к этому процессу, пока шла проверка
+            super().process_message(message)
+        elif shard_id is None or shard_id == self.shard_id:
+            # Получатель отключился - в общую очередь, её разберёт тот процесс, к которому он подключится
+            self.store_offline(message)
+        else:
+            # В копию не записываем: пакет об отключении получателя мог прийти раньше ответа словаря.
+            # Если получатель уже отключился, его процесс сохранит сообщение в очередь сам.
+            self.forward(message, shard_id)
+
+    def forward(self, message, shard_id):
+        # Пересылка сообщения процессу получателя
+        data = encode_message(message)
+        try:
+            if len(data) > ROUTE_DATAGRAM_LIMIT:
+                raise OSError(errno.EMSGSIZE, 'Слишком большой пакет для пересылки.')
+            self.route_sock.sendto(data, self.route_path(shard_id))
+            return
+        except OSError as err:
+            logger.warning(f'Не удалось переслать сообщение обработчику №{shard_id}: {err}')
+        # Отправителю уже ответили 200: сообщение сохраняется в общую очередь,
+        # процесс получателя доставит его по служебному пакету или при следующем подключении
+        self.store_offline(message)
+        try:
+            self.send_route(encode_message({ACTION: ROUTE_DELIVER, ACCOUNT_NAME: message[DESTINATION]}), shard_id)
+        except OSError as err:
+            logger.error(f'Обработчик №{shard_id} не получил уведомление об отложенном сообщении: {err}')
+
+
+def run_worker(shard_id, shards, listen_address, listen_port, database_path, presence, presence_lock, route_dir,
+               stop_event, database_profile=None):
+    # Точка входа процесса-обработчика
+    from server.storage import create_storage
+    # Список активных пользователей очищен при запуске сервера, обработчик (в том числе перезапущенный) его не трогает
+    database = create_storage(database_path, database_profile, reset_active=False)
+    worker = ShardWorker(listen_address, listen_port, database, shard_id, presence, presence_lock, route_dir,
+                         shards)
+    worker.daemon = True
+    worker.start()
+    # Остановка ожидается опросом: процесс, завершённый аварийно внутри stop_event.wait(),
+    # оставил бы событие в состоянии, при котором stop_event.set() не возвращает управление
+    while not stop_event.is_set():
+        time.sleep(SUPERVISE_INTERVAL)
+    worker.running = False
+    worker.join()
+    database.close()
+    # Процесс завершается без atexit: дописываем лог явно
+    flush_logs()
+
+
+class ShardedServer:
+    # Запуск и остановка процессов шардированного сервера.
+    # Поток надзора перезапускает аварийно завершившиеся обработчики, предварительно освобождая
+    # имена их пользователей: иначе эти пользователи считались бы подключёнными до остановки сервера.
+    def __init__(self, listen_address, listen_port, database_path, workers, database_profile=None):
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+            raise OSError('Шардированный режим требует SO_REUSEPORT и Unix-сокетов.')
+        if database_profile and database_profile.get('backend') == 'memory':
+            raise ValueError('Процессы шардированного сервера должны работать с общим хранилищем.')
+        self.addr = listen_address
+        self.port = listen_port
+        self.database_path = database_path
+        self.database_profile = database_profile
+        self.workers = workers
+        self.database = None
+        self.manager = None
+        self.presence = None
+        self.presence_lock = None
+        self.processes = []
+        self.stop_event = None
+        self.route_dir = None
+        self.supervisor = None
+
+    def start(self):
+        # Схема базы и очистка активных пользователей - один раз до запуска обработчиков
+        from server.storage import create_storage
+        self.database = create_storage(self.database_path, self.database_profile)
+        self.manager = multiprocessing.Manager()
+        self.presence = self.manager.dict()
+        self.presence_lock = self.manager.Lock()
+        self.stop_event = multiprocessing.Event()
+        self.route_dir = tempfile.mkdtemp(prefix='messenger_shards_')
+        self.processes = [self.start_worker(shard_id) for shard_id in range(self.workers)]
+        self.supervisor = threading.Thread(target=self.supervise, daemon=True)
+        self.supervisor.start()
+        logger.info(f'Запущен шардированный сервер: {self.workers} обработчиков, порт {self.port}.')
+
+    def start_worker(self, shard_id):
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=(shard_id, self.workers, self.addr, self.port, self.database_path, self.presence,
+                  self.presence_lock, self.route_dir, self.stop_event, self.database_profile),
+            daemon=True)
+        process.start()
+        return process
+
+    def supervise(self):
+        # Поток надзора за обработчиками
+        while not self.stop_event.wait(SUPERVISE_INTERVAL):
+            for shard_id, process in enumerate(self.processes):
+                if process.is_alive() or self.stop_event.is_set():
+                    continue
+                logger.error(f'Обработчик №{shard_id} завершился с кодом {process.exitcode}, перезапуск.')
+                try:
+                    self.purge_shard(shard_id)
+                except Exception as err:
+                    logger.error(f'Не удалось освободить имена пользователей обработчика №{shard_id}: {err}')
+                self.processes[shard_id] = self.start_worker(shard_id)
+
+    def purge_shard(self, shard_id):
+        # Пользователи завершившегося обработчика: освобождение имён, отметка выхода, уведомление остальных
+        with self.presence_lock:
+            names = [name for name, owner in self.presence.items() if owner == shard_id]
+            for name in names:
+                del self.presence[name]
+        self.database.refresh_users()
+        for name in names:
+            try:
+                self.database.user_logout(name)
+            except KeyError:
+                pass
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as route_sock:
+            # Ждём места в очереди обработчика, но не бесконечно: пропущенное исправит сверка с общим словарём
+            route_sock.settimeout(ROUTE_SEND_TIMEOUT)
+            for name in names:
+                data = encode_message({ACTION: ROUTE_RELEASE, ACCOUNT_NAME: name, SHARD: shard_id})
+                for other in range(self.workers):
+                    if other == shard_id:
+                        continue
+                    try:
+                        route_sock.sendto(data, route_path(self.route_dir, other))
+                    except OSError as err:
+                        logger.warning(f'Обработчик №{other} не получил изменение присутствия: {err}')
+        logger.info(f'Освобождены имена пользователей обработчика №{shard_id}: {len(names)}.')
+
+    def stop(self):
+        # Обработчики дописывают статистику и завершаются, затем убираем общие ресурсы.
+        self.stop_event.set()
+        self.supervisor.join()
+        for process in self.processes:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.manager.shutdown()
+        self.database.close()
+        for name in os.listdir(self.route_dir):
+            os.remove(os.path.join(self.route_dir, name))
+        os.rmdir(self.route_dir)
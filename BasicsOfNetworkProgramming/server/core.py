@@ -1,18 +1,24 @@
 import threading
+import collections
 import logging
-import select
+import selectors
+import errno
 import socket
 import json
 import hmac
 import binascii
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
 
 sys.path.append('../')
 from common.descryptors import Port
 from common.variables import *
-from common.utils import send_message, get_message
+from common.utils import encode_message, MessageDecoder, EncodedReply, REPLY_200, REPLY_205, \
+    CODECS, JSON_CODEC, choose_codec, key_fingerprint
 from common.decos import login_required
+from common.errors import ProtocolError
 
 logger = logging.getLogger('server_dist')
 
@@ -21,6 +27,31 @@ class MessageProcessor(threading.Thread):
     # Принимает соединения, словари - пакеты от клиентов, обрабатывает поступающие сообщения.
     # Работает в качестве отдельного потока.
     port = Port()
+    # Потоков для записи входа пользователя в хранилище (0 - запись в сетевом потоке)
+    auth_workers = AUTH_WORKERS
+    # Время на ответ клиента на 511, секунд
+    auth_timeout = AUTH_TIMEOUT
+    # Обработчики запросов клиентов {ACTION: (обработчик, обязательные поля, поле с именем отправителя)}.
+    # Обработчик - имя метода (его можно переопределить в наследнике) или функция handler(processor, message, client).
+    # Поле с именем отправителя сверяется с именем, за которым закреплено соединение (None - не сверяется).
+    handlers = {
+        PRESENCE: ('autorize_user', (TIME, USER), None),
+        MESSAGE: ('handle_message', (DESTINATION, TIME, SENDER, MESSAGE_TEXT), SENDER),
+        EXIT: ('handle_exit', (ACCOUNT_NAME,), ACCOUNT_NAME),
+        GET_CONTACTS: ('handle_get_contacts', (USER,), USER),
+        ADD_CONTACT: ('handle_add_contact', (ACCOUNT_NAME, USER), USER),
+        REMOVE_CONTACT: ('handle_remove_contact', (ACCOUNT_NAME, USER), USER),
+        USERS_REQUEST: ('handle_users_request', (ACCOUNT_NAME,), ACCOUNT_NAME),
+        PUBLIC_KEY_REQUEST: ('handle_key_request', (ACCOUNT_NAME,), None),
+    }
+
+    @classmethod
+    def register_handler(cls, action, handler, required=(), owner=None):
+        # Подключение обработчика нового запроса (или замена существующего) для класса и его наследников.
+        # Таблица копируется, чтобы регистрация в наследнике не меняла родительский класс.
+        if 'handlers' not in cls.__dict__:
+            cls.handlers = dict(cls.handlers)
+        cls.handlers[action] = (handler, tuple(required), owner)
 
     def __init__(self, listen_address, listen_port, database):
         self.addr = listen_address
@@ -28,14 +59,51 @@ class MessageProcessor(threading.Thread):
         self.database = database
         self.sock = None
         self.clients = []
-        # Сокеты
-        self.listen_sockets = None
-        self.error_sockets = None
+        # Сокеты, готовые к записи (по результату последнего опроса)
+        self.listen_sockets = []
+        # Опрос сокетов через selectors (epoll/kqueue, где есть): select.select ограничен FD_SETSIZE (1024)
+        # и при дескрипторе больше этого числа завершался ValueError.
+        # Подписки меняются, только когда меняется нужный сокету набор событий {сокет: события}.
+        self.selector = None
+        self.registered = dict()
         # Флаг продолжения работы
         self.running = True
         # Словарь содержащий сопоставленные имена и соответствующие им сокеты.
         # {'test1': <socket.socket fd=25, family=AddressFamily.AF_INET, type=SocketKind.SOCK_STREAM, proto=0, laddr=('127.0.0.1', 7777), raddr=('127.0.0.1', 52420)>}
         self.names = dict()
+        # Обратный словарь {сокет: имя} для проверки авторизации запроса без перебора names.
+        # Оба словаря меняются только через start_session / end_session.
+        self.sessions = dict()
+        # Счётчики обработки запросов {ACTION: [количество, суммарное время, максимальное время]}
+        self.action_stats = dict()
+        # Адреса клиентов, запомненные при подключении {сокет: (адрес, порт)}:
+        # у сокета, сброшенного клиентом, getpeername уже недоступен
+        self.addresses = dict()
+        # Разборщики входящего потока для каждого сокета (буфер неполных пакетов и формат обмена)
+        self.decoders = dict()
+        # Буферы исходящих данных {сокет: bytearray}. Сокет дописывается, когда опрос сообщит о готовности к записи.
+        self.write_buffers = dict()
+        # Клиенты, чтение от которых приостановлено {сокет: сокет, буфер которого ждём}.
+        # Клиент, не читающий ответы, ждёт свой буфер; отправитель сообщений медленному получателю - буфер получателя.
+        self.paused = dict()
+        # Рассылка 205: момент отправки накопленных изменений справочника (None - изменений нет)
+        # и версия справочника, разосланная клиентам последней
+        self.updates_lock = threading.Lock()
+        self.updates_deadline = None
+        self.broadcast_version = database.directory_version() if database else 0
+        # Авторизация не ждёт ответа клиента: выданные вызовы 511 {сокет: (presence, ожидаемый HMAC, срок ответа)}.
+        # Ответ приходит следующим пакетом сокета и разбирается в check_auth_answer.
+        self.challenges = dict()
+        self.challenges_checked = 0
+        # Запись входа в хранилище выполняется в пуле потоков. Завершённые записи забирает сетевой поток,
+        # пул будит его через пару сокетов (создаётся в init_socket).
+        self.auth_pool = ThreadPoolExecutor(self.auth_workers, thread_name_prefix='auth') \
+            if self.auth_workers else None
+        self.completed_logins = collections.deque()
+        # Ключ подписи токенов возобновления сессии
+        self.token_secret = database.session_secret() if database else os.urandom(32)
+        self.wakeup_recv = None
+        self.wakeup_send = None
         super().__init__()
 
     def run(self):
@@ -43,48 +111,288 @@ class MessageProcessor(threading.Thread):
         self.init_socket()
         # Основной цикл программы сервера
         while self.running:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
-            try:
-                client, client_address = self.sock.accept()
-            except OSError:
-                pass
-            else:
-                logger.info(f'Установлено соедение с ПК {client_address}')
-                client.settimeout(5)
-                self.clients.append(client)
-
+            # Ждём новых подключений, входящих данных и готовности к записи тех сокетов,
+            # у которых есть неотправленные данные. Чтение приостановленных клиентов не ожидаем.
             recv_data_lst = []
-            send_data_lst = []
-            err_lst = []
-            # Проверяем на наличие ждущих клиентов
+            self.listen_sockets = []
+            timeout = 0.5
+            if self.updates_deadline is not None:
+                timeout = min(timeout, max(self.updates_deadline - time.monotonic(), 0))
+            for client in list(self.clients):
+                try:
+                    self.watch(client, (0 if client in self.paused else selectors.EVENT_READ) |
+                               (selectors.EVENT_WRITE if self.write_buffers.get(client) else 0))
+                except (OSError, ValueError) as err:
+                    # Сокет, который нельзя опрашивать, исключаем, а не роняем весь цикл
+                    logger.error(f'Ошибка подписки сокета на опрос: {err}')
+                    self.remove_client(client)
             try:
-                if self.clients:
-                    recv_data_lst, self.listen_sockets, self.error_sockets = select.select(self.clients, self.clients,
-                                                                                           [], 0)
-            except OSError as err:
-                logger.error(f'Ошибка работы с сокетами: {err.errno}')
-            # принимаем сообщения и если ошибка, исключаем клиента.
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
+                for key, events in self.selector.select(timeout):
+                    if events & selectors.EVENT_READ:
+                        recv_data_lst.append(key.fileobj)
+                    if events & selectors.EVENT_WRITE:
+                        self.listen_sockets.append(key.fileobj)
+            except (OSError, ValueError) as err:
+                logger.error(f'Ошибка работы с сокетами: {err}')
+
+            # Рассылаем изменения справочника, если окно накопления истекло
+            self.send_updates()
+            # Завершаем входы, записанные пулом, и отключаем клиентов, не ответивших на 511
+            self.finish_logins()
+            self.expire_challenges()
+
+            # Дописываем буферы готовых к записи клиентов
+            for client in self.listen_sockets:
+                if client in self.clients:
                     try:
-                        self.process_client_message(
-                            get_message(client_with_message), client_with_message)
-                    except (OSError, json.JSONDecodeError, TypeError) as err:
-                        logger.debug(f'Getting data from client exception.', exc_info=err)
+                        self.flush(client)
+                    except OSError as err:
+                        logger.debug(f'Sending data to client exception.', exc_info=err)
+                        self.remove_client(client)
+
+            # принимаем сообщения и если ошибка, исключаем клиента.
+            for client_with_message in recv_data_lst:
+                if client_with_message is self.sock:
+                    self.accept_client()
+                    continue
+                if client_with_message is self.wakeup_recv:
+                    self.drain_wakeup()
+                    continue
+                try:
+                    self.read_client(client_with_message)
+                except (OSError, json.JSONDecodeError, TypeError, ProtocolError) as err:
+                    logger.debug(f'Getting data from client exception.', exc_info=err)
+                    if client_with_message in self.clients:
                         self.remove_client(client_with_message)
 
+        if self.auth_pool:
+            self.auth_pool.shutdown(wait=False)
+
+    def watch(self, client, events):
+        # Подписка сокета на события опроса (0 - отписка)
+        current = self.registered.get(client, 0)
+        if events == current:
+            return
+        if not events:
+            self.selector.unregister(client)
+            del self.registered[client]
+        elif current:
+            self.selector.modify(client, events)
+            self.registered[client] = events
+        else:
+            self.selector.register(client, events)
+            self.registered[client] = events
+
+    def accept_client(self):
+        # Приём нового подключения
+        try:
+            client, client_address = self.sock.accept()
+        except OSError:
+            return
+        logger.info(f'Установлено соедение с ПК {client_address}')
+        # Сокет сразу работает без ожидания: авторизация тоже идёт по сигналам опроса
+        client.setblocking(False)
+        self.clients.append(client)
+        self.addresses[client] = client_address
+        self.decoders[client] = MessageDecoder()
+        self.write_buffers[client] = bytearray()
+
+    def read_client(self, client):
+        # Читаем всё, что пришло в сокет, и обрабатываем каждый целый пакет.
+        # Неполный пакет остаётся в буфере разборщика до следующего чтения.
+        try:
+            data = client.recv(MAX_PACKAGE_LENGTH)
+        except BlockingIOError:
+            return
+        if not data:
+            raise ConnectionResetError('Клиент закрыл соединение.')
+        decoder = self.decoders[client]
+        decoder.feed(data)
+        while client in self.clients:
+            message = decoder.next_message()
+            if message is None:
+                break
+            if client in self.challenges:
+                self.check_auth_answer(message, client)
+            else:
+                self.process_client_message(message, client)
+
+    def client_decoder(self, client):
+        # Разборщик входящего потока соединения
+        return self.decoders[client]
+
+    def wire_format(self, client):
+        # Согласованный с клиентом формат обмена: (пакеты с заголовком длины, кодек тела пакета)
+        decoder = self.decoders.get(client)
+        if decoder is None:
+            return False, JSON_CODEC
+        return decoder.framed, decoder.codec
+
+    def send(self, client, message):
+        # Отправка пакета (словаря или готового ответа EncodedReply) в согласованном с клиентом формате
+        self.write(client, encode_message(message, *self.wire_format(client)))
+
+    def send_bulk(self, client, messages):
+        # Отправка нескольких пакетов одной записью в сокет
+        framed, codec = self.wire_format(client)
+        self.write(client, b''.join(encode_message(message, framed, codec) for message in messages))
+
+    def write(self, client, data):
+        # Данные добавляются в буфер клиента и отправляются, сколько примет сокет, остаток - по готовности к записи.
+        # Клиент, не успевающий принимать данные, отключается (OSError, как при обрыве связи).
+        buffer = self.write_buffers.get(client)
+        if buffer is None:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение закрыто.')
+        if len(buffer) + len(data) > WRITE_BUFFER_LIMIT:
+            raise ConnectionAbortedError(errno.ECONNABORTED, 'Клиент не успевает принимать данные.')
+        buffer += data
+        self.flush(client)
+        # Клиент не читает ответы - не читаем и его запросы, пока буфер не освободится
+        if len(buffer) > WRITE_BUFFER_HIGH:
+            self.paused[client] = client
+
+    def flush(self, client):
+        # Запись буфера в сокет без ожидания
+        buffer = self.write_buffers[client]
+        if buffer:
+            try:
+                sent = client.send(buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            del buffer[:sent]
+        if len(buffer) <= WRITE_BUFFER_LOW:
+            # Возобновляем чтение клиентов, ожидавших этот буфер
+            for waiting in [waiting for waiting, blocker in self.paused.items() if blocker is client]:
+                del self.paused[waiting]
+
+    def buffer_size(self, client):
+        # Объём неотправленных клиенту данных
+        buffer = self.write_buffers.get(client)
+        return len(buffer) if buffer is not None else 0
+
+    def pause_reading(self, client, blocker):
+        # Чтение от client возобновится, когда буфер blocker опустится ниже нижней границы
+        self.paused[client] = blocker
+
+    def store_offline(self, message):
+        # Сообщение, которое не удалось доставить, сохраняется до подключения получателя
+        message = message.copy()
+        message.pop(REQUEST_ID, None)
+        if self.database.store_offline(message[DESTINATION], message):
+            logger.info('Сообщение для %s от %s сохранено до подключения получателя.',
+                        message[DESTINATION], message[SENDER])
+        else:
+            logger.error(
+                f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере, отправка сообщения невозможна.')
+
+    def deliver_offline(self, username, client):
+        # Сразу после авторизации отправляем накопленные сообщения одним пакетом.
+        # Если отправить не удалось, возвращаем их в очередь.
+        messages = self.database.pop_offline(username)
+        if not messages:
+            return
+        try:
+            self.send_bulk(client, messages)
+            logger.info(f'Пользователю {username} доставлено {len(messages)} отложенных сообщений.')
+        except OSError:
+            for message in messages:
+                self.database.store_offline(username, message)
+            self.remove_client(client)
+
+    def reply(self, client, request, response):
+        # Ответ на запрос клиента. Номер запроса возвращается клиенту,
+        # чтобы он мог сопоставить ответ при нескольких запросах в полёте.
+        # Готовый ответ не сериализуется заново, номер запроса дописывается к его байтам.
+        if isinstance(response, EncodedReply):
+            framed, codec = self.wire_format(client)
+            self.write(client, response.encode(framed, request.get(REQUEST_ID), codec))
+            return
+        if REQUEST_ID in request:
+            response = response.copy()
+            response[REQUEST_ID] = request[REQUEST_ID]
+        self.send(client, response)
+
+    def create_login_response(self, message):
+        # Ответ 200 на успешную авторизацию с подтверждением возможностей, которые предложил клиент:
+        # пакеты с заголовком длины и, поверх них, конвейерная обработка запросов и формат тела пакетов.
+        response = {RESPONSE: 200}
+        if FRAMING in message and message[FRAMING]:
+            response[FRAMING] = True
+            if PIPELINING in message and message[PIPELINING]:
+                response[PIPELINING] = True
+            if CODEC in message:
+                response[CODEC] = choose_codec(message[CODEC]).name
+        return response
+
+    def switch_format(self, decoder, response):
+        # Переход на подтверждённый в ответе 200 формат, начиная со следующего пакета в обе стороны
+        if FRAMING in response:
+            decoder.framed = True
+            decoder.codec = CODECS.get(response.get(CODEC), JSON_CODEC)
+
     def remove_client(self, client):
         # Метод обработчик клиента с которым прервана связь.
         # Ищет клиента и удаляет его из списков и базы:
-        logger.info(f'Клиент {client.getpeername()} отключился от сервера.')
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
+        logger.info(f'Клиент {self.peer_address(client)} отключился от сервера.')
+        username = self.end_session(client)
+        # Имя уже занято новым соединением того же пользователя - его запись активного подключения не трогаем
+        if username is not None and username not in self.names:
+            self.database.user_logout(username)
+        self.drop_client(client)
+
+    def peer_address(self, client):
+        # Адрес клиента для журнала и записи входа
+        address = self.addresses.get(client)
+        if address is None:
+            try:
+                address = client.getpeername()
+            except OSError:
+                address = ('', 0)
+        return address
+
+    def start_session(self, username, client):
+        # Закрепление имени за соединением после успешной авторизации
+        self.names[username] = client
+        self.sessions[client] = username
+
+    def end_session(self, client):
+        # Снятие закрепления. Возвращает имя пользователя или None, если соединение не было авторизовано.
+        username = self.sessions.pop(client, None)
+        if username is not None and self.names.get(username) is client:
+            del self.names[username]
+        return username
+
+    def drop_client(self, client):
+        # Закрытие соединения и очистка всех связанных с ним буферов
         self.clients.remove(client)
+        self.decoders.pop(client, None)
+        self.addresses.pop(client, None)
+        self.challenges.pop(client, None)
+        self.write_buffers.pop(client, None)
+        self.paused.pop(client, None)
+        for waiting in [waiting for waiting, blocker in self.paused.items() if blocker is client]:
+            del self.paused[waiting]
+        if self.registered.pop(client, None):
+            try:
+                self.selector.unregister(client)
+            except (KeyError, ValueError, OSError):
+                pass
         client.close()
 
+    def reject_client(self, client, error):
+        # Отказ в подключении: ответ 400 с причиной и закрытие соединения
+        response = RESPONSE_400.copy()
+        response[ERROR] = error
+        try:
+            self.send(client, response)
+        except OSError:
+            pass
+        self.drop_client(client)
+
+    def user_online(self, name):
+        # Подключён ли пользователь к серверу
+        return name in self.names
+
     def init_socket(self):
         # Инициализатор сокета
         logger.info(
@@ -93,197 +401,440 @@ class MessageProcessor(threading.Thread):
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         transport.bind((self.addr, self.port))
-        transport.settimeout(0.5)
+        transport.setblocking(False)
         # Начинаем слушать сокет.
         self.sock = transport
         self.sock.listen(MAX_CONNECTIONS)
+        # Пара сокетов, через которую пул авторизации будит опрос сокетов
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+
+    def drain_wakeup(self):
+        try:
+            while self.wakeup_recv.recv(MAX_PACKAGE_LENGTH):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
 
     def process_message(self, message):
-        # Отправка сообщения клиенту
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]] in self.listen_sockets:
+        # Отправка сообщения клиенту. Сообщение ставится в буфер получателя.
+        if message[DESTINATION] in self.names:
+            recipient = self.names[message[DESTINATION]]
             try:
-                send_message(self.names[message[DESTINATION]], message)
-                logger.info(
-                    f'Отправлено сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]}.')
+                self.send(recipient, message)
+                logger.info('Отправлено сообщение пользователю %s от пользователя %s.',
+                            message[DESTINATION], message[SENDER])
             except OSError:
-                self.remove_client(message[DESTINATION])
-        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in self.listen_sockets:
-            logger.error(
-                f'Связь с клиентом {message[DESTINATION]} была потеряна. Соединение закрыто, доставка невозможна.')
-            self.remove_client(self.names[message[DESTINATION]])
+                logger.error(
+                    f'Связь с клиентом {message[DESTINATION]} была потеряна. Соединение закрыто, сообщение отложено.')
+                # Сначала сохраняем сообщение: ошибка при закрытии соединения не должна его потерять
+                self.store_offline(message)
+                self.remove_client(recipient)
+                return
+            # Получатель не успевает - приостанавливаем чтение от отправителя до освобождения буфера получателя
+            sender = self.names.get(message[SENDER])
+            if sender is not None and sender is not recipient and self.buffer_size(recipient) > WRITE_BUFFER_HIGH:
+                self.pause_reading(sender, recipient)
         else:
-            logger.error(
-                f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере, отправка сообщения невозможна.')
+            self.store_offline(message)
 
     @login_required
     def process_client_message(self, message, client):
-        # Обработка поступающих сообщений
-        logger.debug(f'Разбор сообщения от клиента : {message}')
-        # Если это сообщение о присутствии, принимаем и отвечаем
-        if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
-            # Если сообщение о присутствии, то вызываем функцию авторизации.
-            self.autorize_user(message, client)
-        # Если это сообщение, то отправляем его получателю.
-        elif ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message and TIME in message \
-                and SENDER in message and MESSAGE_TEXT in message and self.names[message[SENDER]] == client:
-            if message[DESTINATION] in self.names:
-                self.database.process_message(message[SENDER], message[DESTINATION])
-                self.process_message(message)
-                try:
-                    send_message(client, RESPONSE_200)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Пользователь не зарегистрирован на сервере.'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    pass
-            return
-
-        # Если клиент выходит
-        elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message and self.names[
-            message[ACCOUNT_NAME]] == client:
+        # Обработка поступающих сообщений: обработчик выбирается по ACTION из таблицы handlers.
+        # Форматирование записи откладывается до потока записи логов
+        logger.debug('Разбор сообщения от клиента : %s', message)
+        action = message.get(ACTION)
+        if action in self.handlers:
+            handler, required, owner = self.handlers[action]
+            # Все обязательные поля на месте и запрос пришёл от пользователя, за которым закреплено соединение
+            if all(field in message for field in required) and \
+                    (owner is None or self.sessions.get(client) == message[owner]):
+                start = time.perf_counter()
+                if isinstance(handler, str):
+                    getattr(self, handler)(message, client)
+                else:
+                    handler(self, message, client)
+                self.count_action(action, time.perf_counter() - start)
+                return
+        # Иначе отдаём Bad request
+        response = RESPONSE_400.copy()
+        response[ERROR] = 'Запрос некорректен.'
+        try:
+            self.reply(client, message, response)
+        except OSError:
             self.remove_client(client)
-        # Если это запрос контакт-листа
-        elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and self.names[
-            message[USER]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
 
-        # Если это добавление контакта
-        elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
+    def count_action(self, action, elapsed):
+        # Счётчики обработки запросов: количество, суммарное и максимальное время, с
+        stats = self.action_stats.get(action)
+        if stats is None:
+            self.action_stats[action] = [1, elapsed, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            if elapsed > stats[2]:
+                stats[2] = elapsed
 
-        # Если это удаление контакта
-        elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+    def action_timings(self):
+        # Сводка счётчиков по запросам: {ACTION: {'count', 'total_ms', 'avg_us', 'max_us'}}
+        return {action: {'count': count, 'total_ms': round(total * 1000, 3),
+                         'avg_us': round(total / count * 1000000, 3), 'max_us': round(longest * 1000000, 3)}
+                for action, (count, total, longest) in list(self.action_stats.items())}
+
+    def handle_message(self, message, client):
+        # Сообщение пользователю. Получатель не в сети - сообщение ставится в его очередь
+        # и будет доставлено при подключении.
+        if self.user_online(message[DESTINATION]) or self.database.check_user(message[DESTINATION]):
+            self.database.process_message(message[SENDER], message[DESTINATION])
+            # Номер запроса отправителя получателю не пересылается (подтверждение уходит по оригиналу)
+            relayed = message.copy()
+            relayed.pop(REQUEST_ID, None)
+            if self.user_online(message[DESTINATION]):
+                self.process_message(relayed)
+            else:
+                self.store_offline(relayed)
             try:
-                send_message(client, RESPONSE_200)
+                self.reply(client, message, REPLY_200)
             except OSError:
                 self.remove_client(client)
-
-        # Если это запрос известных пользователей
-        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message and self.names[
-            message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0] for user in self.database.users_list()]
+        else:
+            response = RESPONSE_400.copy()
+            response[ERROR] = 'Пользователь не зарегистрирован на сервере.'
             try:
-                send_message(client, response)
+                self.reply(client, message, response)
             except OSError:
-                self.remove_client(client)
+                pass
 
-        # Если это запрос публичного ключа пользователя
-        elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
-            response = RESPONSE_511
-            response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
-            # может быть, что ключа ещё нет (пользователь никогда не логинился,
-            # тогда шлём 400)
-            if response[DATA]:
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Нет публичного ключа для данного пользователя'
-                try:
-                    send_message(client, response)
-                except OSError:
-                    self.remove_client(client)
+    def handle_exit(self, message, client):
+        # Клиент выходит
+        self.remove_client(client)
 
-        # Иначе отдаём Bad request
+    def handle_get_contacts(self, message, client):
+        # Запрос контакт-листа
+        response = RESPONSE_202.copy()
+        response[LIST_INFO] = self.database.get_contacts(message[USER])
+        try:
+            self.reply(client, message, response)
+        except OSError:
+            self.remove_client(client)
+
+    def handle_add_contact(self, message, client):
+        self.database.add_contact(message[USER], message[ACCOUNT_NAME])
+        try:
+            self.reply(client, message, REPLY_200)
+        except OSError:
+            self.remove_client(client)
+
+    def handle_remove_contact(self, message, client):
+        self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+        try:
+            self.reply(client, message, REPLY_200)
+        except OSError:
+            self.remove_client(client)
+
+    def handle_users_request(self, message, client):
+        # Запрос известных пользователей
+        response = self.users_response(message)
+        try:
+            self.reply(client, message, response)
+        except OSError:
+            self.remove_client(client)
+
+    def handle_key_request(self, message, client):
+        # Запрос публичного ключа пользователя
+        response = RESPONSE_511.copy()
+        response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
+        # может быть, что ключа ещё нет (пользователь никогда не логинился,
+        # тогда шлём 400)
+        if not response[DATA]:
+            response = RESPONSE_400.copy()
+            response[ERROR] = 'Нет публичного ключа для данного пользователя'
+        try:
+            self.reply(client, message, response)
+        except OSError:
+            self.remove_client(client)
+
+    def users_response(self, message):
+        # Ответ на запрос справочника пользователей.
+        # Клиент с версией справочника получает только изменения после неё, если они известны и их немного.
+        # Иначе - страница по алфавиту (PAGE_AFTER, PAGE_SIZE), начало следующей страницы в NEXT_PAGE.
+        # Запрос без версии и страницы (старые клиенты) - весь справочник одним ответом.
+        response = {RESPONSE: 202, DIRECTORY_VERSION: self.database.directory_version()}
+        limit = min(message.get(PAGE_SIZE) or USERS_PAGE_SIZE, USERS_PAGE_SIZE)
+        if DIRECTORY_VERSION in message and PAGE_AFTER not in message:
+            changes = self.database.directory_changes(message[DIRECTORY_VERSION], limit)
+            if changes is not None:
+                response[DELTA] = True
+                response[LIST_INFO], response[REMOVED] = changes
+                return response
+        if DIRECTORY_VERSION in message or PAGE_AFTER in message or PAGE_SIZE in message:
+            names = self.database.users_page(message.get(PAGE_AFTER), limit + 1)
+            response[LIST_INFO] = names[:limit]
+            response[NEXT_PAGE] = names[limit - 1] if len(names) > limit else None
         else:
-            response = RESPONSE_400
-            response[ERROR] = 'Запрос некорректен.'
-            try:
-                send_message(client, response)
-            except OSError:
-                self.remove_client(client)
+            response[LIST_INFO] = [user[0] for user in self.database.users_list()]
+        return response
 
     def autorize_user(self, message, sock):
-        # Если имя пользователя уже занято, то возвращаем 400
+        # Первый шаг авторизации: проверка имени и вызов 511.
+        # Ответ клиента не ожидается, остальные соединения обслуживаются, пока клиент считает HMAC.
+        username = message[USER][ACCOUNT_NAME]
         logger.debug(f'Start auth process for {message[USER]}')
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
-            response = RESPONSE_400
-            response[ERROR] = 'Имя пользователя уже занято.'
-            try:
-                logger.debug(f'Username busy, sending {response}')
-                send_message(sock, response)
-            except OSError:
-                logger.debug('OS Error')
-                pass
-            self.clients.remove(sock)
-            sock.close()
+        # Если имя пользователя уже занято, то возвращаем 400
+        if username in self.names:
+            logger.debug(f'Username busy')
+            self.reject_client(sock, 'Имя пользователя уже занято.')
         # Проверяем что пользователь зарегистрирован на сервере.
-        elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
-            response = RESPONSE_400
-            response[ERROR] = 'Пользователь не зарегистрирован.'
+        elif not self.database.check_user(username):
+            logger.debug(f'Unknown username')
+            self.reject_client(sock, 'Пользователь не зарегистрирован.')
+        else:
+            # Действительный токен - вход без 511, если токен ещё не использован
+            expected = self.check_token(message) if TOKEN in message else None
+            if expected is not None:
+                logger.debug('Session token accepted.')
+                self.resume_session(message, sock, expected)
+            else:
+                self.send_challenge(message, sock)
+
+    def send_challenge(self, message, sock):
+        logger.debug('Correct username, starting passwd check.')
+        message_auth, digest = self.create_challenge(message[USER][ACCOUNT_NAME])
+        logger.debug(f'Auth message = {message_auth}')
+        try:
+            self.send(sock, message_auth)
+        except OSError as err:
+            logger.debug('Error in auth, data:', exc_info=err)
+            self.drop_client(sock)
+            return
+        self.challenges[sock] = (message, digest, time.monotonic() + self.auth_timeout)
+
+    def resume_session(self, message, client, expected):
+        # Вход по токену. Погашение предъявленного токена и выдача нового - одна условная замена номера
+        # в пуле потоков, сетевой поток её не ждёт. Имя закрепляется и ответ 200 отправляется после неё.
+        nonce = self.create_nonce()
+        future = self.submit_login(self.database.swap_token, message[USER][ACCOUNT_NAME], expected, nonce)
+        future.add_done_callback(lambda future: self.login_stored(self.token_swapped, message, client, nonce, future))
+
+    def token_swapped(self, message, client, nonce, future):
+        # Результат замены номера токена (в сетевом потоке)
+        username = message[USER][ACCOUNT_NAME]
+        if client not in self.clients:
+            return
+        if future.exception() is not None:
+            logger.error(f'Не удалось проверить токен пользователя {username}: {future.exception()}')
+        if future.exception() is not None or not future.result():
+            # Токен уже использован или после него выдан новый - вход через 511
+            self.send_challenge(message, client)
+        elif not self.claim_name(username, client):
+            # Пока заменялся номер, имя занял другой клиент
+            self.reject_client(client, 'Имя пользователя уже занято.')
+        else:
+            self.accept_session(message, client, None, nonce)
+
+    def check_auth_answer(self, answer, sock):
+        # Второй шаг: ответ клиента на 511. При верном ответе имя закрепляется за сокетом,
+        # клиент получает 200 и отложенные сообщения, а запись входа уходит в пул потоков.
+        message, digest, deadline = self.challenges.pop(sock)
+        username = message[USER][ACCOUNT_NAME]
+        if not self.check_digest(answer, digest):
+            self.reject_client(sock, 'Неверный пароль.')
+        elif not self.claim_name(username, sock):
+            # Пока ждали ответ, имя занял другой клиент
+            self.reject_client(sock, 'Имя пользователя уже занято.')
+        else:
+            # Клиент, предлагавший токен, ключ в PRESENCE не передаёт - он приходит в ответе на 511
+            self.accept_session(message, sock, message[USER].get(PUBLIC_KEY, answer.get(PUBLIC_KEY)))
+
+    def claim_name(self, username, client):
+        # Закрепление имени за соединением после успешной авторизации
+        if username in self.names:
+            return False
+        self.start_session(username, client)
+        return True
+
+    def accept_session(self, message, client, pubkey, nonce=None):
+        # Имя уже закреплено за соединением: ответ 200 с новым токеном, запись входа
+        # и доставка отложенных сообщений. pubkey None - ключ не меняется.
+        # nonce - номер нового токена, уже записанный при входе по токену.
+        username = message[USER][ACCOUNT_NAME]
+        # Если клиент поддерживает пакеты с заголовком длины, подтверждаем это в ответе 200
+        # и со следующего пакета переходим на новый формат в обе стороны.
+        response = self.create_login_response(message)
+        # Новый токен с новым разовым номером: номер записывается вместе со входом, прежние токены гаснут
+        resumed = nonce is not None
+        if not resumed:
+            nonce = self.create_nonce()
+        response[TOKEN] = self.create_token(username, pubkey if pubkey is not None else
+                                            self.database.get_pubkey(username), nonce)
+        try:
+            self.send(client, response)
+        except OSError:
+            self.remove_client(client)
+            return
+        self.switch_format(self.client_decoder(client), response)
+        # добавляем пользователя в список активных и,
+        # если у него изменился открытый ключ, то сохраняем новый
+        self.login(username, client, pubkey, nonce, resumed)
+        # Отправляем сообщения, накопленные пока пользователь был не в сети
+        self.deliver_offline(username, client)
+
+    @staticmethod
+    def create_nonce():
+        return binascii.hexlify(os.urandom(16)).decode('ascii')
+
+    def create_token(self, username, pubkey, nonce):
+        # Токен возобновления сессии: срок действия, разовый номер, отпечаток открытого ключа и имя,
+        # подписанные HMAC-SHA256
+        payload = f'{int(time.time()) + SESSION_TOKEN_TTL}:{nonce}:{key_fingerprint(pubkey)}:{username}'
+        signature = hmac.new(self.token_secret, payload.encode(ENCODING), 'sha256').hexdigest()
+        return f'{payload}.{signature}'
+
+    def check_token(self, message):
+        # Токен из PRESENCE действителен: подпись сервера, срок не истёк, имя совпадает,
+        # ключ, для которого выдан токен, и сейчас хранится на сервере. Возвращает номер токена или None.
+        # Токен разовый: номер сверяется с последним выданным и заменяется новым в resume_session,
+        # перехваченный токен повторно не примется.
+        token = message[TOKEN]
+        if not isinstance(token, str) or '.' not in token:
+            return None
+        payload, signature = token.rsplit('.', 1)
+        expected = hmac.new(self.token_secret, payload.encode(ENCODING), 'sha256').hexdigest()
+        if not hmac.compare_digest(signature.encode(ENCODING), expected.encode(ENCODING)):
+            return None
+        expires, nonce, fingerprint, username = payload.split(':', 3)
+        if username != message[USER][ACCOUNT_NAME] or int(expires) <= time.time() or \
+                fingerprint != key_fingerprint(self.database.get_pubkey(username)):
+            return None
+        return nonce
+
+    def create_challenge(self, username):
+        # Вызов 511: случайная строка в hex (байты в словарь нельзя, json.dumps -> TypeError)
+        # и серверная версия ответа - HMAC строки на хэше пароля
+        message_auth = RESPONSE_511.copy()
+        random_str = binascii.hexlify(os.urandom(64))
+        message_auth[DATA] = random_str.decode('ascii')
+        digest = hmac.new(self.database.get_hash(username), random_str, 'MD5').digest()
+        return message_auth, digest
+
+    @staticmethod
+    def check_digest(answer, digest):
+        # Проверка ответа клиента на 511
+        if RESPONSE not in answer or answer[RESPONSE] != 511 or DATA not in answer:
+            return False
+        try:
+            client_digest = binascii.a2b_base64(answer[DATA])
+        except (ValueError, TypeError):
+            return False
+        return hmac.compare_digest(digest, client_digest)
+
+    def expire_challenges(self):
+        # Клиенты, не ответившие на 511 за auth_timeout, отключаются. Проверка - не чаще раза в секунду.
+        now = time.monotonic()
+        if not self.challenges or now - self.challenges_checked < 1:
+            return
+        self.challenges_checked = now
+        for client in [client for client, (_, _, deadline) in self.challenges.items() if deadline < now]:
+            logger.debug(f'Клиент {self.peer_address(client)} не ответил на запрос авторизации.')
+            self.reject_client(client, 'Время авторизации истекло.')
+
+    def login(self, username, client, pubkey, nonce, resumed=False):
+        # Запись входа в хранилище: активные пользователи, история входов, новый открытый ключ,
+        # при входе по токену - только отметка активного подключения; номер выданного токена.
+        # Запись выполняется в пуле потоков, сетевой поток тем временем обслуживает остальные соединения.
+        # При входе по токену номер нового токена уже записан в resume_session.
+        client_ip, client_port = self.peer_address(client)
+        if resumed:
+            future = self.submit_login(self.database.user_resume, username, client_ip, client_port)
+        else:
+            future = self.submit_login(self.store_login, username, nonce, username, client_ip, client_port, pubkey)
+        future.add_done_callback(lambda future: self.login_stored(self.login_finished, username, client, future))
+
+    def store_login(self, username, nonce, *args):
+        # Токен, выданный до записи номера, не примется - клиент войдёт через 511
+        result = self.database.user_login(*args)
+        self.database.swap_token(username, None, nonce)
+        return result
+
+    def submit_login(self, function, *args):
+        # Запись в хранилище в пуле потоков, без пула - сразу
+        if self.auth_pool is not None:
+            return self.auth_pool.submit(function, *args)
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except Exception as err:
+            future.set_exception(err)
+        return future
+
+    def login_stored(self, handler, *args):
+        # Вызывается в потоке пула: обработка результата handler(*args) передаётся сетевому потоку
+        self.completed_logins.append((handler, args))
+        if self.wakeup_send is not None:
             try:
-                logger.debug(f'Unknown username, sending {response}')
-                send_message(sock, response)
+                self.wakeup_send.send(b'\0')
             except OSError:
                 pass
-            self.clients.remove(sock)
-            sock.close()
-        else:
-            logger.debug('Correct username, starting passwd check.')
-            # Иначе отвечаем 511 и проводим процедуру авторизации
-            # Словарь - заготовка
-            message_auth = RESPONSE_511
-            # Набор байтов в hex представлении
-            random_str = binascii.hexlify(os.urandom(64))
-            # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
-            message_auth[DATA] = random_str.decode('ascii')
-            # Создаём хэш пароля и связки с рандомной строкой, сохраняем серверную версию ключа
-            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
-            digest = hash.digest()
-            logger.debug(f'Auth message = {message_auth}')
-            try:
-                # Обмен с клиентом
-                send_message(sock, message_auth)
-                ans = get_message(sock)
-            except OSError as err:
-                logger.debug('Error in auth, data:', exc_info=err)
-                sock.close()
-                return
-            client_digest = binascii.a2b_base64(ans[DATA])
-            # Если ответ клиента корректный, то сохраняем его в список пользователей.
-            if RESPONSE in ans and ans[RESPONSE] == 511 and hmac.compare_digest(digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
-                try:
-                    send_message(sock, RESPONSE_200)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-                # добавляем пользователя в список активных и,
-                # если у него изменился открытый ключ, то сохраняем новый
-                self.database.user_login(message[USER][ACCOUNT_NAME], client_ip, client_port, message[USER][PUBLIC_KEY])
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Неверный пароль.'
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
-                self.clients.remove(sock)
-                sock.close()
+
+    def finish_logins(self):
+        while self.completed_logins:
+            handler, args = self.completed_logins.popleft()
+            handler(*args)
+
+    def login_finished(self, username, client, future):
+        # Вход записан. Если клиент отключился раньше, чем закончилась запись, отмечаем и выход
+        # (если имя не занято уже новым соединением).
+        # Сменившийся открытый ключ - изменение справочника: клиенты сбросят его в своих кэшах по 205.
+        if future.exception() is not None:
+            logger.error(f'Не удалось записать вход пользователя {username}: {future.exception()}')
+            return
+        if future.result():
+            self.service_update_lists()
+        if self.sessions.get(client) != username and username not in self.names \
+                and self.database.check_user(username):
+            self.database.user_logout(username)
 
     def service_update_lists(self):
-        # Отправка сервисного сообщения 205 клиентам
-        for client in self.names:
+        # Справочник пользователей изменился (вызывается из GUI потока).
+        # Рассылка 205 откладывается на UPDATE_DEBOUNCE: серия регистраций даёт одно уведомление.
+        with self.updates_lock:
+            if self.updates_deadline is None:
+                self.updates_deadline = time.monotonic() + UPDATE_DEBOUNCE
+
+    def send_updates(self):
+        # Рассылка 205 по окончании окна накопления.
+        # Пакет содержит изменения справочника с версии прошлой рассылки, клиент с этой версией применяет их
+        # без запросов к серверу. Если изменения неизвестны или их слишком много - 205 без изменений,
+        # клиенты запрашивают справочники сами.
+        with self.updates_lock:
+            if self.updates_deadline is None or time.monotonic() < self.updates_deadline:
+                return
+            self.updates_deadline = None
+        version = self.database.directory_version()
+        message = REPLY_205
+        changes = self.database.directory_changes(self.broadcast_version)
+        if changes is not None:
+            message = RESPONSE_205.copy()
+            message[DELTA] = True
+            message[PREVIOUS_VERSION] = self.broadcast_version
+            message[DIRECTORY_VERSION] = version
+            message[LIST_INFO], message[REMOVED] = changes
+        self.broadcast_version = version
+        self.broadcast(message)
+
+    def broadcast(self, message):
+        # Отправка одного пакета всем авторизованным клиентам.
+        # Пакет кодируется один раз для каждого формата обмена, всем клиентам пишутся готовые байты.
+        encoded = dict()
+        for client in list(self.names.values()):
+            wire_format = self.wire_format(client)
+            if wire_format not in encoded:
+                encoded[wire_format] = encode_message(message, *wire_format)
             try:
-                send_message(self.names[client], RESPONSE_205)
+                self.write(client, encoded[wire_format])
             except OSError:
-                self.remove_client(self.names[client])
+                self.remove_client(client)
@@ -1,9 +1,24 @@
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text
-from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text, inspect, \
+    event, LargeBinary, Boolean, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import mapper, sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool, StaticPool
+from contextlib import contextmanager
 import datetime
+import json
+import os
+import sys
 
+sys.path.append('../')
+from common.variables import OFFLINE_QUEUE_LIMIT, OFFLINE_MESSAGE_TTL, DATABASE_PROFILE, USERS_PAGE_SIZE
+from server.stats_writer import MessageStatsWriter
+from server.migrations import apply_migrations
+from server.storage import StorageBackend
+from common.utils import json_default
 
-class ServerStorage:
+
+class ServerStorage(StorageBackend):
+    # SQL хранилище. path - файл SQLite, ':memory:' или URL сетевой СУБД (postgresql://...).
     class AllUsers:
         def __init__(self, username, passwd_hash):
             self.name = username
@@ -41,10 +56,57 @@ class ServerStorage:
             self.sent = 0
             self.accepted = 0
 
-    def __init__(self, path):
-        # Создаём движок базы данных
-        self.database_engine = create_engine(f'sqlite:///{path}', echo=False, pool_recycle=7200,
-                                             connect_args={'check_same_thread': False})
+    class OfflineMessages:
+        def __init__(self, recipient, message):
+            self.id = None
+            self.recipient = recipient
+            self.created = datetime.datetime.now()
+            self.message = message
+
+    class DirectoryChanges:
+        # Последнее изменение справочника по каждому имени, номер записи - версия справочника
+        def __init__(self, name, removed):
+            self.id = None
+            self.name = name
+            self.removed = removed
+
+    class CachedUser:
+        # Запись справочника пользователей в памяти: всё, что нужно серверу без обращения к БД
+        def __init__(self, user_id, passwd_hash, pubkey, history_id):
+            self.id = user_id
+            self.passwd_hash = passwd_hash
+            self.pubkey = pubkey
+            self.history_id = history_id
+
+    # Допустимые значения параметров профиля (подставляются в PRAGMA)
+    JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+    SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+    def __init__(self, path, offline_limit=OFFLINE_QUEUE_LIMIT, offline_ttl=OFFLINE_MESSAGE_TTL, profile=None,
+                 reset_active=True):
+        # Профиль работы SQLite: журнал, уровень синхронизации, кэш страниц, пул соединений
+        self.profile = self.load_profile(profile)
+        # Создаём движок базы данных.
+        # Файл: пул соединений, у каждого потока своё соединение (WAL - чтение не блокирует запись).
+        # База в памяти существует в рамках одного соединения, поэтому оно общее для всех потоков.
+        if path.startswith('sqlite:///'):
+            # URL файла SQLite - тот же файл, что и по пути
+            path = path[len('sqlite:///'):] or ':memory:'
+        if '://' in path:
+            # Сетевая СУБД: пул соединений с проверкой соединения перед выдачей
+            self.database_engine = create_engine(path, echo=False, pool_recycle=7200, pool_pre_ping=True,
+                                                 pool_size=self.profile['pool_size'],
+                                                 max_overflow=self.profile['pool_size'])
+        elif path == ':memory:':
+            self.database_engine = create_engine(f'sqlite:///{path}', echo=False, poolclass=StaticPool,
+                                                 connect_args={'check_same_thread': False})
+        else:
+            self.database_engine = create_engine(
+                f'sqlite:///{path}', echo=False, pool_recycle=7200, poolclass=QueuePool,
+                pool_size=self.profile['pool_size'], max_overflow=self.profile['pool_size'],
+                connect_args={'check_same_thread': False, 'timeout': self.profile['busy_timeout']})
+        if self.database_engine.dialect.name == 'sqlite':
+            event.listen(self.database_engine, 'connect', self.configure_connection)
         # Создаём объект MetaData
         self.metadata = MetaData()
         # Создаём таблицу пользователей
@@ -52,7 +114,7 @@ class ServerStorage:
                             Column('id', Integer, primary_key=True),
                             Column('name', String, unique=True),
                             Column('last_login', DateTime),
-                            Column('passwd_hash', String),
+                            Column('passwd_hash', LargeBinary),
                             Column('pubkey', Text)
                             )
         # Создаём таблицу активных пользователей
@@ -84,48 +146,189 @@ class ServerStorage:
                                     Column('sent', Integer),
                                     Column('accepted', Integer)
                                     )
+        # Создаём таблицу сообщений, ожидающих подключения получателя
+        offline_messages_table = Table('Offline_messages', self.metadata,
+                                       Column('id', Integer, primary_key=True),
+                                       Column('recipient', ForeignKey('Users.id'), index=True),
+                                       Column('created', DateTime),
+                                       Column('message', Text)
+                                       )
+        # Создаём таблицу изменений справочника пользователей: одна запись на имя, при изменении
+        # запись заменяется новой. Номера не используются повторно (AUTOINCREMENT), поэтому версия только растёт.
+        directory_table = Table('Directory', self.metadata,
+                                Column('id', Integer, primary_key=True),
+                                Column('name', String, unique=True),
+                                Column('removed', Boolean),
+                                sqlite_autoincrement=True
+                                )
+        # Создаём таблицу служебных ключей (ключ подписи токенов возобновления сессии)
+        self.secrets_table = Table('Secrets', self.metadata,
+                                   Column('name', String, primary_key=True),
+                                   Column('value', LargeBinary)
+                                   )
+        self.secret = None
+        # Создаём таблицу разовых номеров токенов возобновления сессии: номер действующего токена пользователя
+        self.tokens_table = Table('Session_tokens', self.metadata,
+                                  Column('user', ForeignKey('Users.id'), primary_key=True),
+                                  Column('nonce', String)
+                                  )
         # Создаём таблицы
         self.metadata.create_all(self.database_engine)
+        # Доводим схему до текущей версии (индексы, ограничения)
+        self.schema_version = apply_migrations(self.database_engine)
 
-        # Создаём отображения
-        mapper(self.AllUsers, users_table)
-        mapper(self.ActiveUsers, active_users_table)
-        mapper(self.LoginHistory, user_login_history)
-        mapper(self.UsersContacts, contacts)
-        mapper(self.UsersHistory, users_history_table)
+        # Создаём отображения. Классы отображаются один раз на процесс,
+        # следующие экземпляры хранилища (тесты, бенчмарки) используют те же отображения.
+        if inspect(self.AllUsers, raiseerr=False) is None:
+            mapper(self.AllUsers, users_table)
+            mapper(self.ActiveUsers, active_users_table)
+            mapper(self.LoginHistory, user_login_history)
+            mapper(self.UsersContacts, contacts)
+            mapper(self.UsersHistory, users_history_table)
+            mapper(self.OfflineMessages, offline_messages_table)
+            mapper(self.DirectoryChanges, directory_table)
 
-        # Создаём сессию
-        session = sessionmaker(bind=self.database_engine)
-        self.session = session()
+        # Фабрика сессий: у каждого потока (сетевой, GUI) своя сессия, см. свойство session
+        self.Session = scoped_session(sessionmaker(bind=self.database_engine))
 
-        # Если в таблице активных пользователей есть записи, то их необходимо удалить
-        self.session.query(self.ActiveUsers).delete()
-        self.session.commit()
+        # Если в таблице активных пользователей есть записи, то их необходимо удалить.
+        # Процессы шардированного сервера работают с общей базой: её очищает только запускающий процесс.
+        if reset_active:
+            self.session.query(self.ActiveUsers).delete()
+            self.session.commit()
+
+        # Ограничения очереди сообщений для пользователей не в сети, просроченные сообщения удаляем сразу
+        self.offline_limit = offline_limit
+        self.offline_ttl = datetime.timedelta(seconds=offline_ttl)
+        self.evict_offline()
+
+        # Фоновая пакетная запись статистики сообщений.
+        # База в памяти работает через одно общее соединение, поэтому для неё поток не запускается:
+        # счётчики записываются из вызывающего потока (по порогу, в message_history и close).
+        self.stats_writer = MessageStatsWriter(self.database_engine, users_history_table)
+        if path != ':memory:':
+            self.stats_writer.start()
+
+        # Справочник пользователей {имя: CachedUser}. Загружается один раз при старте
+        # и обновляется вместе с БД в add_user / remove_user / user_login.
+        # Изменения, сделанные другим процессом с той же базой, подхватывает refresh_users.
+        self.users = dict()
+        self.users_version = 0
+        self.load_users()
+
+    @classmethod
+    def load_profile(cls, profile):
+        # Профиль по умолчанию, дополненный значениями из конфигурации, с проверкой значений
+        result = dict(DATABASE_PROFILE)
+        if profile:
+            result.update({key: value for key, value in profile.items() if value not in (None, '')})
+        result['journal_mode'] = str(result['journal_mode']).upper()
+        result['synchronous'] = str(result['synchronous']).upper()
+        if result['journal_mode'] not in cls.JOURNAL_MODES:
+            raise ValueError(f'Недопустимый режим журнала: {result["journal_mode"]}')
+        if result['synchronous'] not in cls.SYNCHRONOUS_LEVELS:
+            raise ValueError(f'Недопустимый уровень синхронизации: {result["synchronous"]}')
+        for key in ('cache_size', 'pool_size'):
+            result[key] = int(result[key])
+        result['busy_timeout'] = float(result['busy_timeout'])
+        return result
+
+    def configure_connection(self, dbapi_connection, connection_record):
+        # Настройка каждого нового соединения SQLite по профилю
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f'PRAGMA journal_mode={self.profile["journal_mode"]}')
+        cursor.execute(f'PRAGMA synchronous={self.profile["synchronous"]}')
+        cursor.execute(f'PRAGMA cache_size={self.profile["cache_size"]}')
+        cursor.close()
+
+    @property
+    def session(self):
+        # Сессия текущего потока
+        return self.Session()
+
+    @contextmanager
+    def transaction(self):
+        # Транзакция сессии текущего потока. При ошибке сессия откатывается: иначе все следующие
+        # запросы этого потока (например, потока пула входов) завершались бы PendingRollbackError.
+        session = self.session
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    def load_users(self):
+        # Загрузка справочника пользователей одним запросом.
+        # Версия справочника читается раньше: изменение во время загрузки будет подхвачено следующей проверкой.
+        self.users_version = self.directory_version()
+        query = self.session.query(self.AllUsers.name, self.AllUsers.id, self.AllUsers.passwd_hash,
+                                   self.AllUsers.pubkey, self.UsersHistory.id).outerjoin(
+            self.UsersHistory, self.UsersHistory.user == self.AllUsers.id)
+        self.users = {name: self.CachedUser(user_id, passwd_hash, pubkey, history_id)
+                      for name, user_id, passwd_hash, pubkey, history_id in query.all()}
+
+    def refresh_users(self):
+        # Справочник перечитывается, если его версия в базе изменилась
+        if self.directory_version() == self.users_version:
+            return False
+        self.load_users()
+        return True
 
     def user_login(self, username, ip_address, port, key):
         # Записывает в БД факт входа и обновляет публичный ключ при изменении
-        # Запрос в таблицу пользователей на наличие там пользователя с таким именем
-        rez = self.session.query(self.AllUsers).filter_by(name=username)
-        # Если имя пользователя уже присутствует в таблице, обновляем время последнего входа
-        # и проверяем корректность ключа. Если клиент прислал новый ключ, сохраняем его.
-        if rez.count():
-            user = rez.first()
-            user.last_login = datetime.datetime.now()
-            if user.pubkey != key:
-                user.pubkey = key
-        # Если нет, то генерируем исключение
-        else:
+        # Пользователь ищется в справочнике, если его нет, то генерируем исключение
+        user = self.users.get(username)
+        if not user:
             raise ValueError('Пользователь не зарегистрирован.')
-        # Теперь можно создать запись в таблицу активных пользователей о факте входа.
-        new_active_user = self.ActiveUsers(
-            user.id, ip_address, port, datetime.datetime.now())
-        self.session.add(new_active_user)
-        # и сохранить в историю входов
-        history = self.LoginHistory(
-            user.id, datetime.datetime.now(), ip_address, port)
-        self.session.add(history)
-        # Сохраняем изменения
-        self.session.commit()
+        # Обновляем время последнего входа и, если клиент прислал новый ключ, сохраняем его.
+        changes = {self.AllUsers.last_login: datetime.datetime.now()}
+        key_changed = key is not None and user.pubkey is not None and user.pubkey != key
+        if key is not None and user.pubkey != key:
+            changes[self.AllUsers.pubkey] = key
+        with self.transaction() as session:
+            if key_changed:
+                # Клиенты, сохранившие прежний ключ, узнают о смене из изменений справочника
+                self.directory_change(username, False)
+            session.query(self.AllUsers).filter_by(id=user.id).update(changes, synchronize_session=False)
+            # Теперь можно создать запись в таблицу активных пользователей о факте входа.
+            self.set_active(session, user, ip_address, port)
+            # и сохранить в историю входов
+            history = self.LoginHistory(
+                user.id, datetime.datetime.now(), ip_address, port)
+            session.add(history)
+        if key is not None:
+            user.pubkey = key
+        return key_changed
+
+    def user_resume(self, username, ip_address, port):
+        # Возобновление сессии: одна запись в таблицу активных пользователей
+        user = self.users.get(username)
+        if not user:
+            raise ValueError('Пользователь не зарегистрирован.')
+        with self.transaction() as session:
+            self.set_active(session, user, ip_address, port)
+
+    def set_active(self, session, user, ip_address, port):
+        # Запись активного подключения заменяет прежнюю: запись переподключившегося клиента
+        # может попасть в базу раньше, чем удалена запись его оборванного соединения.
+        session.query(self.ActiveUsers).filter_by(user=user.id).delete()
+        session.add(self.ActiveUsers(user.id, ip_address, port, datetime.datetime.now()))
+
+    def session_secret(self):
+        # Ключ создаётся при первом обращении. Если его одновременно создал другой процесс, читаем его ключ.
+        if self.secret is None:
+            query = select(self.secrets_table.c.value).where(self.secrets_table.c.name == 'session')
+            value = self.session.execute(query).scalar()
+            if value is None:
+                try:
+                    self.session.execute(self.secrets_table.insert().values(name='session', value=os.urandom(32)))
+                    self.session.commit()
+                except IntegrityError:
+                    self.session.rollback()
+                value = self.session.execute(query).scalar()
+            self.secret = value
+        return self.secret
 
     def add_user(self, name, passwd_hash):
         # Регистрация пользователя. Принимает имя и хэш пароля, создаёт запись в таблице статистики.
@@ -134,59 +337,129 @@ class ServerStorage:
         self.session.commit()
         history_row = self.UsersHistory(user_row.id)
         self.session.add(history_row)
+        self.directory_change(name, False)
         self.session.commit()
+        self.users[name] = self.CachedUser(user_row.id, passwd_hash, None, history_row.id)
 
     def remove_user(self, name):
         # Удаление пользователя из БД
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
+        user = self.users.pop(name)
         self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
         self.session.query(self.LoginHistory).filter_by(name=user.id).delete()
         self.session.query(self.UsersContacts).filter_by(user=user.id).delete()
         self.session.query(self.UsersContacts).filter_by(contact=user.id).delete()
         self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
-        self.session.query(self.AllUsers).filter_by(name=name).delete()
+        self.session.query(self.OfflineMessages).filter_by(recipient=user.id).delete()
+        self.session.execute(self.tokens_table.delete().where(self.tokens_table.c.user == user.id))
+        self.session.query(self.AllUsers).filter_by(id=user.id).delete()
+        self.directory_change(name, True)
         self.session.commit()
 
+    def directory_change(self, name, removed):
+        # Запись изменения справочника (в транзакции вызывающего метода)
+        self.session.query(self.DirectoryChanges).filter_by(name=name).delete()
+        self.session.add(self.DirectoryChanges(name, removed))
+
     def get_hash(self, name):
         # Получение хеша пароля пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.passwd_hash
+        return self.users[name].passwd_hash
 
     def get_pubkey(self, name):
         # Получение публичного ключа пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.pubkey
+        user = self.users.get(name)
+        if user and user.pubkey is None:
+            # Первый ключ не меняет версию справочника: его мог сохранить другой процесс
+            user.pubkey = self.session.query(self.AllUsers.pubkey).filter_by(id=user.id).scalar()
+        return user.pubkey if user else None
 
     def check_user(self, name):
         # Проверка существования пользователя
-        if self.session.query(self.AllUsers).filter_by(name=name).count():
-            return True
-        else:
+        return name in self.users
+
+    def swap_token(self, username, expected, nonce):
+        # Замена номера токена условным UPDATE: из двух процессов, предъявивших один токен, его примет один
+        user = self.users.get(username)
+        if not user:
             return False
+        table = self.tokens_table
+        with self.transaction() as session:
+            if expected is None:
+                session.execute(table.delete().where(table.c.user == user.id))
+                session.execute(table.insert().values(user=user.id, nonce=nonce))
+                return True
+            result = session.execute(table.update().where(table.c.user == user.id, table.c.nonce == expected)
+                                     .values(nonce=nonce))
+            return result.rowcount == 1
 
     def user_logout(self, username):
         # Отключение пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=username).first()
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
-        self.session.commit()
+        user = self.users[username]
+        with self.transaction() as session:
+            session.query(self.ActiveUsers).filter_by(user=user.id).delete()
 
     def process_message(self, sender, recipient):
         # Записываем в таблицу статистики факт передачи сообщения
-        # Получаем ID отправителя и получателя
-        sender = self.session.query(self.AllUsers).filter_by(name=sender).first().id
-        recipient = self.session.query(self.AllUsers).filter_by(name=recipient).first().id
-        # Запрашиваем строки из истории и увеличиваем счётчики
-        sender_row = self.session.query(self.UsersHistory).filter_by(user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(self.UsersHistory).filter_by(user=recipient).first()
-        recipient_row.accepted += 1
+        # Строки статистики берём из справочника, счётчики копятся в памяти и пишутся в БД пакетно.
+        self.stats_writer.add(self.users[sender].history_id, self.users[recipient].history_id)
+
+    def store_offline(self, recipient, message):
+        # Сохранение сообщения для пользователя не в сети.
+        # Если очередь получателя переполнена, удаляются самые старые сообщения.
+        # Двоичный текст сообщения (кодек msgpack) хранится строкой base64, как его получил бы JSON клиент.
+        user = self.users.get(recipient)
+        if not user:
+            return False
+        self.session.add(self.OfflineMessages(user.id, json.dumps(message, default=json_default)))
+        self.session.flush()
+        query = self.session.query(self.OfflineMessages.id).filter_by(recipient=user.id)
+        overflow = query.count() - self.offline_limit
+        if overflow > 0:
+            oldest = [row.id for row in query.order_by(self.OfflineMessages.id).limit(overflow)]
+            self.session.query(self.OfflineMessages).filter(
+                self.OfflineMessages.id.in_(oldest)).delete(synchronize_session=False)
+        self.session.commit()
+        return True
+
+    def pop_offline(self, username):
+        # Выборка и удаление всех ожидающих сообщений пользователя одним запросом, в порядке поступления
+        user = self.users.get(username)
+        if not user:
+            return []
+        self.evict_offline()
+        query = self.session.query(self.OfflineMessages.message).filter_by(recipient=user.id).order_by(
+            self.OfflineMessages.id)
+        messages = [json.loads(row.message) for row in query.all()]
+        if messages:
+            self.session.query(self.OfflineMessages).filter_by(recipient=user.id).delete()
+            self.session.commit()
+        return messages
+
+    def offline_count(self, username):
+        # Количество сообщений, ожидающих подключения пользователя
+        user = self.users.get(username)
+        if not user:
+            return 0
+        return self.session.query(self.OfflineMessages).filter_by(recipient=user.id).count()
+
+    def evict_offline(self):
+        # Удаление сообщений, срок хранения которых истёк
+        deadline = datetime.datetime.now() - self.offline_ttl
+        self.session.query(self.OfflineMessages).filter(self.OfflineMessages.created < deadline).delete()
         self.session.commit()
 
+    def stats_flush_lag(self):
+        # Задержка записи статистики сообщений в БД, секунд
+        return self.stats_writer.flush_lag()
+
+    def close(self):
+        # Завершение работы: дописываем накопленную статистику
+        self.stats_writer.stop()
+
     def add_contact(self, user, contact):
         # Добавление контакта для пользователя
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(name=contact).first()
+        user = self.users[user]
+        contact = self.users.get(contact)
         # Проверяем что не дубль и что контакт может существовать (полю пользователь мы доверяем)
         if not contact or self.session.query(self.UsersContacts).filter_by(user=user.id, contact=contact.id).count():
             return
@@ -197,8 +470,8 @@ class ServerStorage:
     def remove_contact(self, user, contact):
         # Удаление контакта из БД
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(self.AllUsers).filter_by(name=contact).first()
+        user = self.users[user]
+        contact = self.users.get(contact)
         # Проверяем что контакт может существовать (полю пользователь мы доверяем)
         if not contact:
             return
@@ -214,6 +487,29 @@ class ServerStorage:
                                    )
         return query.all()
 
+    def users_page(self, after=None, limit=USERS_PAGE_SIZE):
+        # Страница справочника по уникальному индексу имени, без перебора предыдущих страниц
+        query = self.session.query(self.AllUsers.name)
+        if after is not None:
+            query = query.filter(self.AllUsers.name > after)
+        return [row.name for row in query.order_by(self.AllUsers.name).limit(limit)]
+
+    def directory_version(self):
+        # Справочник общий для всех процессов кластера, поэтому версия читается из БД
+        return self.session.query(func.max(self.DirectoryChanges.id)).scalar() or 0
+
+    def directory_changes(self, version, limit=USERS_PAGE_SIZE):
+        current = self.directory_version()
+        if version <= 0 or version > current:
+            return None
+        query = self.session.query(self.DirectoryChanges.name, self.DirectoryChanges.removed).filter(
+            self.DirectoryChanges.id > version, self.DirectoryChanges.id <= current).order_by(
+            self.DirectoryChanges.id).limit(limit + 1)
+        rows = query.all()
+        if len(rows) > limit:
+            return None
+        return [row.name for row in rows if not row.removed], [row.name for row in rows if row.removed]
+
     def active_users_list(self):
         # Запрашиваем соединение таблиц и собираем кортежи имя, адрес, порт, время.
         query = self.session.query(self.AllUsers.name, self.ActiveUsers.ip_address, self.ActiveUsers.port,
@@ -222,7 +518,7 @@ class ServerStorage:
 
     def login_history(self, username=None):
         # Запрашиваем историю входа
-        query = self.session.query(self.AllUsers.name, self.LoginHistory.date_timeself.LoginHistory.ip,
+        query = self.session.query(self.AllUsers.name, self.LoginHistory.date_time, self.LoginHistory.ip,
                                    self.LoginHistory.port).join(self.AllUsers)
         if username:
             query = query.filter(self.AllUsers.name == username)
@@ -231,13 +527,15 @@ class ServerStorage:
     def get_contacts(self, username):
         # Список контактов пользователя
         # Запрашиваем указанного пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=username).one()
+        user = self.users[username]
         query = self.session.query(self.UsersContacts, self.AllUsers.name).filter_by(user=user.id).join(self.AllUsers,
                                                                                                         self.UsersContacts.contact == self.AllUsers.id)
         # выбираем только имена пользователей и возвращаем их.
         return [contact[1] for contact in query.all()]
 
     def message_history(self):
+        # Перед чтением статистики дописываем накопленные счётчики
+        self.stats_writer.flush()
         query = self.session.query(self.AllUsers.name, self.AllUsers.last_login, self.UsersHistory.sent,
                                    self.UsersHistory.accepted).join(self.AllUsers)
         return query.all()
@@ -6,6 +6,7 @@ from server.stat_window import StatWindow
 from server.config_window import ConfigWindow
 from server.add_user import RegisterUser
 from server.remove_user import DelUserDialog
+from logs.config_server_log import queue_handler as log_queue
 
 
 class MainWindow(QMainWindow):
@@ -53,6 +54,7 @@ class MainWindow(QMainWindow):
         # Таймер, обновляющий список клиентов 1 раз в секунду
         self.timer = QTimer()
         self.timer.timeout.connect(self.create_users_model)
+        self.timer.timeout.connect(self.update_status)
         self.timer.start(1000)
         # Связываем кнопки с процедурами
         self.refresh_button.triggered.connect(self.create_users_model)
@@ -84,6 +86,12 @@ class MainWindow(QMainWindow):
         self.active_clients_table.resizeColumnsToContents()
         self.active_clients_table.resizeRowsToContents()
 
+    def update_status(self):
+        # Статусбар: задержка записи статистики сообщений в БД и потери очереди логов
+        self.statusBar().showMessage(f'Server Working. Задержка записи статистики: '
+                                     f'{self.database.stats_flush_lag():.1f} с. '
+                                     f'Отброшено записей лога: {log_queue.dropped}')
+
     def show_statistics(self):
         global stat_window
         stat_window = StatWindow(self.database)
@@ -0,0 +1,200 @@
+import collections
+import datetime
+import threading
+import os
+import copy
+import sys
+
+sys.path.append('../')
+from common.variables import OFFLINE_QUEUE_LIMIT, OFFLINE_MESSAGE_TTL, USERS_PAGE_SIZE
+from server.storage import StorageBackend
+
+
+class MemoryStorage(StorageBackend):
+    # Хранилище в памяти процесса: для тестов и бенчмарков, данные теряются при остановке.
+    # Доступ из сетевого потока и GUI защищён блокировкой.
+    class User:
+        def __init__(self, name, passwd_hash):
+            self.name = name
+            self.passwd_hash = passwd_hash
+            self.pubkey = None
+            self.last_login = datetime.datetime.now()
+            self.sent = 0
+            self.accepted = 0
+            self.contacts = []
+
+    def __init__(self, offline_limit=OFFLINE_QUEUE_LIMIT, offline_ttl=OFFLINE_MESSAGE_TTL):
+        self.lock = threading.RLock()
+        self.users = dict()
+        # {имя: (адрес, порт, время входа)}
+        self.active = dict()
+        # [(имя, время, адрес, порт)]
+        self.history = []
+        # {имя: deque[(время поступления, сообщение)]}
+        self.offline = dict()
+        # Изменения справочника {имя: (версия, удалён)} в порядке возрастания версии
+        self.directory = dict()
+        self.version = 0
+        self.offline_limit = offline_limit
+        self.offline_ttl = datetime.timedelta(seconds=offline_ttl)
+        self.secret = os.urandom(32)
+        # Номера действующих токенов возобновления сессии {имя: номер}
+        self.tokens = dict()
+
+    def add_user(self, name, passwd_hash):
+        with self.lock:
+            self.users[name] = self.User(name, passwd_hash)
+            self.directory_change(name, False)
+
+    def remove_user(self, name):
+        with self.lock:
+            self.users.pop(name)
+            self.active.pop(name, None)
+            self.offline.pop(name, None)
+            self.tokens.pop(name, None)
+            self.history = [row for row in self.history if row[0] != name]
+            for user in self.users.values():
+                if name in user.contacts:
+                    user.contacts.remove(name)
+            self.directory_change(name, True)
+
+    def directory_change(self, name, removed):
+        # Повторное изменение имени переносит его в конец словаря
+        self.version += 1
+        self.directory.pop(name, None)
+        self.directory[name] = (self.version, removed)
+
+    def check_user(self, name):
+        return name in self.users
+
+    def get_hash(self, name):
+        return self.users[name].passwd_hash
+
+    def get_pubkey(self, name):
+        user = self.users.get(name)
+        return user.pubkey if user else None
+
+    def users_list(self):
+        with self.lock:
+            return [(user.name, user.last_login) for user in self.users.values()]
+
+    def users_page(self, after=None, limit=USERS_PAGE_SIZE):
+        with self.lock:
+            names = sorted(name for name in self.users if after is None or name > after)
+        return names[:limit]
+
+    def directory_version(self):
+        return self.version
+
+    def directory_changes(self, version, limit=USERS_PAGE_SIZE):
+        with self.lock:
+            if version <= 0 or version > self.version:
+                return None
+            changes = []
+            for name in reversed(self.directory):
+                change_version, removed = self.directory[name]
+                if change_version <= version:
+                    break
+                if len(changes) == limit:
+                    return None
+                changes.append((name, removed))
+        changes.reverse()
+        return [name for name, removed in changes if not removed], [name for name, removed in changes if removed]
+
+    def user_login(self, username, ip_address, port, key):
+        with self.lock:
+            user = self.users.get(username)
+            if not user:
+                raise ValueError('Пользователь не зарегистрирован.')
+            now = datetime.datetime.now()
+            user.last_login = now
+            key_changed = key is not None and user.pubkey is not None and user.pubkey != key
+            if key is not None:
+                user.pubkey = key
+            if key_changed:
+                self.directory_change(username, False)
+            self.active[username] = (ip_address, port, now)
+            self.history.append((username, now, ip_address, port))
+            return key_changed
+
+    def user_resume(self, username, ip_address, port):
+        with self.lock:
+            if username not in self.users:
+                raise ValueError('Пользователь не зарегистрирован.')
+            self.active[username] = (ip_address, port, datetime.datetime.now())
+
+    def session_secret(self):
+        return self.secret
+
+    def swap_token(self, username, expected, nonce):
+        with self.lock:
+            if username not in self.users or expected is not None and self.tokens.get(username) != expected:
+                return False
+            self.tokens[username] = nonce
+            return True
+
+    def user_logout(self, username):
+        with self.lock:
+            self.active.pop(username, None)
+
+    def active_users_list(self):
+        with self.lock:
+            return [(name, ip, port, login_time) for name, (ip, port, login_time) in self.active.items()]
+
+    def login_history(self, username=None):
+        with self.lock:
+            return [row for row in self.history if username is None or row[0] == username]
+
+    def add_contact(self, user, contact):
+        with self.lock:
+            contacts = self.users[user].contacts
+            if contact in self.users and contact not in contacts:
+                contacts.append(contact)
+
+    def remove_contact(self, user, contact):
+        with self.lock:
+            contacts = self.users[user].contacts
+            if contact in contacts:
+                contacts.remove(contact)
+
+    def get_contacts(self, username):
+        with self.lock:
+            return list(self.users[username].contacts)
+
+    def process_message(self, sender, recipient):
+        with self.lock:
+            self.users[sender].sent += 1
+            self.users[recipient].accepted += 1
+
+    def message_history(self):
+        with self.lock:
+            return [(user.name, user.last_login, user.sent, user.accepted) for user in self.users.values()]
+
+    def store_offline(self, recipient, message):
+        with self.lock:
+            if recipient not in self.users:
+                return False
+            queue = self.offline.setdefault(recipient, collections.deque())
+            queue.append((datetime.datetime.now(), copy.deepcopy(message)))
+            while len(queue) > self.offline_limit:
+                queue.popleft()
+            return True
+
+    def pop_offline(self, username):
+        with self.lock:
+            self.evict_offline()
+            queue = self.offline.pop(username, None)
+            return [message for created, message in queue] if queue else []
+
+    def offline_count(self, username):
+        with self.lock:
+            return len(self.offline.get(username, ()))
+
+    def evict_offline(self):
+        with self.lock:
+            deadline = datetime.datetime.now() - self.offline_ttl
+            for name, queue in list(self.offline.items()):
+                while queue and queue[0][0] < deadline:
+                    queue.popleft()
+                if not queue:
+                    del self.offline[name]
@@ -0,0 +1,54 @@
+import logging
+import sys
+
+sys.path.append('../')
+from sqlalchemy import text
+
+logger = logging.getLogger('server_dist')
+
+# Версионированные изменения схемы базы сервера.
+# Таблицы создаёт ServerStorage (metadata.create_all), миграции добавляют к ним индексы и ограничения.
+# Номер применённой версии хранится в таблице Schema_version, при старте применяются только новые миграции.
+# Новая миграция - новая запись в конец списка, уже выпущенные миграции не меняются.
+# Имена таблиц в кавычках: они в смешанном регистре, а SQL должен работать и на сетевых СУБД.
+MIGRATIONS = [
+    (1, 'Индексы по столбцам фильтрации и уникальный контакт', [
+        # Дубликаты контактов (могли появиться до ограничения) удаляем, оставляя первую запись
+        'DELETE FROM "Contacts" WHERE id NOT IN (SELECT MIN(id) FROM "Contacts" GROUP BY "user", contact)',
+        # Уникальный индекс (user, contact) используется и для выборки контактов пользователя
+        'CREATE UNIQUE INDEX IF NOT EXISTS ux_contacts_user_contact ON "Contacts" ("user", contact)',
+        'CREATE INDEX IF NOT EXISTS ix_contacts_contact ON "Contacts" (contact)',
+        'CREATE INDEX IF NOT EXISTS ix_history_user ON "History" ("user")',
+        'CREATE INDEX IF NOT EXISTS ix_login_history_name ON "Login_history" (name)',
+    ]),
+    (2, 'Индекс времени отложенных сообщений для удаления просроченных', [
+        'CREATE INDEX IF NOT EXISTS ix_offline_messages_created ON "Offline_messages" (created)',
+    ]),
+    (3, 'Версия справочника пользователей для уже зарегистрированных', [
+        'INSERT INTO "Directory" (name, removed) SELECT name, FALSE FROM "Users" '
+        'WHERE name NOT IN (SELECT name FROM "Directory") ORDER BY id',
+    ]),
+]
+
+
+def schema_version(connection):
+    # Текущая версия схемы (0 - миграции не применялись)
+    connection.execute(text('CREATE TABLE IF NOT EXISTS Schema_version (version INTEGER NOT NULL)'))
+    version = connection.execute(text('SELECT MAX(version) FROM Schema_version')).scalar()
+    return version or 0
+
+
+def apply_migrations(engine, migrations=MIGRATIONS):
+    # Применение недостающих миграций, каждая - в своей транзакции вместе с записью номера версии.
+    with engine.begin() as connection:
+        current = schema_version(connection)
+    for version, description, statements in migrations:
+        if version <= current:
+            continue
+        logger.info(f'Применение миграции схемы №{version}: {description}')
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+            connection.execute(text('INSERT INTO Schema_version (version) VALUES (:version)'), {'version': version})
+        current = version
+    return current
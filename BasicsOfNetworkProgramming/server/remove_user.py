@@ -41,7 +41,8 @@ class DelUserDialog(QDialog):
         self.database.remove_user(self.selector.currentText())
         if self.selector.currentText() in self.server.names:
             sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
+            # Сессия снимается до отключения, чтобы не отмечать выход уже удалённого пользователя
+            self.server.end_session(sock)
             self.server.remove_client(sock)
         # Рассылаем клиентам сообщение о необходимости обновить справочники
         self.server.service_update_lists()
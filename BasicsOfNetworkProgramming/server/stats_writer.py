@@ -0,0 +1,110 @@
+import threading
+import logging
+import time
+import sys
+
+sys.path.append('../')
+from sqlalchemy import bindparam
+from common.variables import STATS_FLUSH_INTERVAL, STATS_FLUSH_COUNT
+
+logger = logging.getLogger('server_dist')
+
+
+class MessageStatsWriter(threading.Thread):
+    # Фоновая запись статистики сообщений (таблица History).
+    # Счётчики sent / accepted копятся в памяти и сбрасываются в БД одной транзакцией
+    # по таймеру или по достижении порога, поэтому сетевой поток не ждёт commit на каждое сообщение.
+    def __init__(self, database_engine, history_table, flush_interval=STATS_FLUSH_INTERVAL,
+                 flush_count=STATS_FLUSH_COUNT):
+        super().__init__()
+        self.daemon = True
+        self.database_engine = database_engine
+        self.history_table = history_table
+        self.flush_interval = flush_interval
+        self.flush_count = flush_count
+        # Накопленные приращения {id строки History: [sent, accepted]}
+        self.counters = dict()
+        self.pending = 0
+        # Время самого старого не записанного приращения (для метрики задержки)
+        self.oldest = None
+        self.lock = threading.Lock()
+        # Отдельная блокировка сброса, чтобы транзакции разных потоков не пересекались
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.running = True
+        # Метрики
+        self.flushed_total = 0
+        self.last_flush_duration = 0.0
+        # UPDATE History SET sent = sent + :d_sent, accepted = accepted + :d_accepted WHERE id = :row_id
+        self.statement = self.history_table.update().where(
+            self.history_table.c.id == bindparam('row_id')).values(
+            sent=self.history_table.c.sent + bindparam('d_sent'),
+            accepted=self.history_table.c.accepted + bindparam('d_accepted'))
+
+    def add(self, sender_row, recipient_row):
+        # Учёт одного сообщения: +1 отправленных у отправителя, +1 принятых у получателя
+        with self.lock:
+            if sender_row is not None:
+                self.counters.setdefault(sender_row, [0, 0])[0] += 1
+            if recipient_row is not None:
+                self.counters.setdefault(recipient_row, [0, 0])[1] += 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            self.pending += 1
+            threshold = self.pending >= self.flush_count
+        if threshold:
+            # Если фоновый поток не запущен, сбрасываем сами.
+            if self.is_alive():
+                self.wakeup.set()
+            else:
+                self.flush()
+
+    def flush(self):
+        # Запись накопленных счётчиков одним пакетным UPDATE в одной транзакции
+        with self.flush_lock:
+            with self.lock:
+                counters, self.counters = self.counters, dict()
+                self.pending = 0
+                self.oldest = None
+            if not counters:
+                return
+            start = time.monotonic()
+            params = [{'row_id': row_id, 'd_sent': sent, 'd_accepted': accepted}
+                      for row_id, (sent, accepted) in counters.items()]
+            try:
+                with self.database_engine.begin() as connection:
+                    connection.execute(self.statement, params)
+            except Exception as err:
+                # Не теряем приращения: возвращаем их обратно, запишем при следующем сбросе.
+                logger.error(f'Не удалось записать статистику сообщений: {err}')
+                with self.lock:
+                    for row_id, (sent, accepted) in counters.items():
+                        row = self.counters.setdefault(row_id, [0, 0])
+                        row[0] += sent
+                        row[1] += accepted
+                    if self.oldest is None:
+                        self.oldest = start
+                return
+            self.last_flush_duration = time.monotonic() - start
+            self.flushed_total += len(params)
+
+    def flush_lag(self):
+        # Метрика: сколько секунд ждёт записи самое старое приращение (0 - всё записано)
+        with self.lock:
+            if self.oldest is None:
+                return 0.0
+            return time.monotonic() - self.oldest
+
+    def run(self):
+        while self.running:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        # Остановка с гарантированной записью остатка
+        self.running = False
+        self.wakeup.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
@@ -0,0 +1,185 @@
+import sys
+from abc import ABC, abstractmethod
+
+sys.path.append('../')
+from common.variables import DATABASE_PROFILE, USERS_PAGE_SIZE
+
+# Интерфейс хранилища сервера: все методы, которые вызывают MessageProcessor, GUI сервера и бенчмарки.
+# Реализации:
+#     ServerStorage (server/database.py) - SQL через SQLAlchemy: файл SQLite или сетевая СУБД по URL;
+#     MemoryStorage (server/memory_storage.py) - всё в памяти процесса, для тестов и бенчмарков.
+# Методы без реализации по умолчанию абстрактные: неполное хранилище не создаётся (TypeError).
+# Набор тестов на соответствие интерфейсу - unit_tests/test_storage.py.
+
+# Доступные хранилища
+STORAGE_BACKENDS = ('sqlite', 'sql', 'memory')
+
+
+class StorageBackend(ABC):
+    # Пользователи
+    @abstractmethod
+    def add_user(self, name, passwd_hash):
+        # Регистрация пользователя, passwd_hash - байты
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_user(self, name):
+        # Удаление пользователя со всеми его данными, KeyError для неизвестного
+        raise NotImplementedError
+
+    @abstractmethod
+    def check_user(self, name):
+        # Зарегистрирован ли пользователь
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_hash(self, name):
+        # Хэш пароля (байты), KeyError для неизвестного
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_pubkey(self, name):
+        # Публичный ключ или None
+        raise NotImplementedError
+
+    @abstractmethod
+    def users_list(self):
+        # Список кортежей (имя, время последнего входа)
+        raise NotImplementedError
+
+    @abstractmethod
+    def users_page(self, after=None, limit=USERS_PAGE_SIZE):
+        # Имена пользователей по алфавиту: не более limit имён, следующих за after
+        raise NotImplementedError
+
+    @abstractmethod
+    def directory_version(self):
+        # Версия справочника пользователей: растёт при каждой регистрации, удалении и смене открытого ключа
+        raise NotImplementedError
+
+    @abstractmethod
+    def directory_changes(self, version, limit=USERS_PAGE_SIZE):
+        # Изменения справочника после версии version: (добавленные или сменившие ключ имена, удалённые имена).
+        # None, если версия неизвестна или изменений больше limit - тогда клиенту нужен полный список.
+        raise NotImplementedError
+
+    def load_users(self):
+        # Перечитать справочник пользователей из хранилища
+        pass
+
+    def refresh_users(self):
+        # Перечитать справочник, если его изменил другой процесс с тем же хранилищем. True, если перечитан
+        return False
+
+    # Подключения
+    @abstractmethod
+    def user_login(self, username, ip_address, port, key):
+        # Факт входа, сохранение нового ключа (None - ключ не меняется). ValueError для неизвестного пользователя.
+        # True, если прежний ключ заменён другим (смена ключа записывается как изменение справочника)
+        raise NotImplementedError
+
+    @abstractmethod
+    def user_resume(self, username, ip_address, port):
+        # Вход по токену возобновления сессии: только отметка активного подключения,
+        # без записи в историю входов и обновления ключа. ValueError для неизвестного пользователя
+        raise NotImplementedError
+
+    @abstractmethod
+    def session_secret(self):
+        # Ключ подписи токенов возобновления сессии (байты). Хранится вместе с данными,
+        # поэтому токены действительны после перезапуска сервера и во всех процессах кластера с общей базой.
+        raise NotImplementedError
+
+    @abstractmethod
+    def swap_token(self, username, expected, nonce):
+        # Разовый номер токена возобновления сессии: заменяется на nonce, если текущий номер равен expected
+        # (expected None - без проверки, при входе по паролю; nonce None - токен погашен, действующего нет).
+        # False - предъявленный токен уже использован или после него выдан новый, а также для неизвестного имени
+        raise NotImplementedError
+
+    @abstractmethod
+    def user_logout(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def active_users_list(self):
+        # Список кортежей (имя, адрес, порт, время входа)
+        raise NotImplementedError
+
+    @abstractmethod
+    def login_history(self, username=None):
+        # Список кортежей (имя, время, адрес, порт)
+        raise NotImplementedError
+
+    # Контакты
+    @abstractmethod
+    def add_contact(self, user, contact):
+        # Повторное добавление и неизвестный контакт игнорируются
+        raise NotImplementedError
+
+    @abstractmethod
+    def remove_contact(self, user, contact):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_contacts(self, username):
+        # Список имён контактов
+        raise NotImplementedError
+
+    # Статистика сообщений
+    @abstractmethod
+    def process_message(self, sender, recipient):
+        raise NotImplementedError
+
+    @abstractmethod
+    def message_history(self):
+        # Список кортежей (имя, время последнего входа, отправлено, принято)
+        raise NotImplementedError
+
+    def stats_flush_lag(self):
+        # Задержка записи статистики, секунд
+        return 0.0
+
+    # Сообщения для пользователей не в сети
+    @abstractmethod
+    def store_offline(self, recipient, message):
+        # False, если получатель не зарегистрирован
+        raise NotImplementedError
+
+    @abstractmethod
+    def pop_offline(self, username):
+        # Все ожидающие сообщения в порядке поступления, очередь очищается
+        raise NotImplementedError
+
+    @abstractmethod
+    def offline_count(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def evict_offline(self):
+        # Удаление просроченных сообщений
+        raise NotImplementedError
+
+    def close(self):
+        # Завершение работы: запись всех накопленных данных
+        pass
+
+
+def create_storage(path, profile=None, reset_active=True):
+    # Создание хранилища по профилю: backend = sqlite (файл path), sql (сетевая СУБД по url), memory.
+    # reset_active - очистить список активных пользователей (не нужно процессам шардированного сервера)
+    settings = dict(DATABASE_PROFILE)
+    if profile:
+        settings.update({key: value for key, value in profile.items() if value not in (None, '')})
+    backend = settings['backend']
+    if backend == 'memory':
+        from server.memory_storage import MemoryStorage
+        return MemoryStorage()
+    from server.database import ServerStorage
+    if backend == 'sql':
+        if not settings['url']:
+            raise ValueError('Для хранилища sql необходимо указать url.')
+        return ServerStorage(settings['url'], profile=profile, reset_active=reset_active)
+    if backend == 'sqlite':
+        return ServerStorage(path, profile=profile, reset_active=reset_active)
+    raise ValueError(f'Неизвестное хранилище: {backend}')
@@ -0,0 +1,246 @@
+import sys
+import os
+import asyncio
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common.variables import *
+from common.utils import encode_message, decode_message
+from client.protocol import password_hash, create_presence, create_auth_answer, create_message
+from server.async_core import ClientConnection, AsyncMessageProcessor
+from server.memory_storage import MemoryStorage
+
+
+class Writer:
+    # Транспорт соединения: drain ждёт, пока тест не разрешит запись (клиент не читает данные)
+    def __init__(self):
+        self.data = bytearray()
+        self.ready = asyncio.Event()
+        self.ready.set()
+        self.closed = False
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        await self.ready.wait()
+
+    def close(self):
+        self.closed = True
+
+    def get_extra_info(self, name):
+        return '127.0.0.1', 7777
+
+
+class TestClientConnection(unittest.TestCase):
+    def test_buffer_limit(self):
+        # Клиент, не принимающий данные, отключается при переполнении очереди записи
+        async def scenario():
+            writer = Writer()
+            writer.ready.clear()
+            client = ClientConnection(None, writer)
+            chunk = b'x' * WRITE_BUFFER_LOW
+            sent = 0
+            while client.buffered + len(chunk) <= WRITE_BUFFER_LIMIT:
+                sent += client.send(chunk)
+            with self.assertRaises(ConnectionAbortedError):
+                client.send(chunk)
+            self.assertEqual(client.buffered, sent)
+            # Поставленные в очередь данные отправляются и после закрытия
+            writer.ready.set()
+            client.close()
+            await asyncio.wait_for(client.writer_task, 1)
+            self.assertEqual(len(writer.data), sent)
+            self.assertTrue(writer.closed)
+            with self.assertRaises(ConnectionResetError):
+                client.send(chunk)
+
+        asyncio.run(scenario())
+
+    def test_drained(self):
+        # Событие drained сбрасывается выше верхней границы и выставляется только ниже нижней
+        async def scenario():
+            writer = Writer()
+            writer.ready.clear()
+            client = ClientConnection(None, writer)
+            client.send(b'x' * WRITE_BUFFER_HIGH)
+            self.assertTrue(client.drained.is_set())
+            client.send(b'x')
+            self.assertFalse(client.drained.is_set())
+            waiting = asyncio.create_task(client.wait_writable())
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiting.done())
+            writer.ready.set()
+            await asyncio.wait_for(waiting, 1)
+            self.assertLessEqual(client.buffered, WRITE_BUFFER_LOW)
+            client.close()
+
+        asyncio.run(scenario())
+
+
+class TestAsyncDelivery(unittest.TestCase):
+    # Доставка сообщений движка asyncio: тот же process_message, что и у движка select
+    def setUp(self):
+        self.database = MemoryStorage()
+        for name in ('test1', 'test2'):
+            self.database.add_user(name, b'hash')
+        self.processor = AsyncMessageProcessor('127.0.0.1', DEFAULT_PORT, self.database)
+
+    def tearDown(self):
+        self.processor.auth_pool.shutdown()
+
+    def connect(self, name, writer):
+        client = ClientConnection(None, writer)
+        self.processor.clients.append(client)
+        self.processor.start_session(name, client)
+        return client
+
+    def test_blocked_by(self):
+        # Получатель не успевает принимать - чтение от отправителя ждёт освобождения буфера получателя
+        async def scenario():
+            self.processor.loop = asyncio.get_running_loop()
+            sender = self.connect('test1', Writer())
+            recipient_writer = Writer()
+            recipient_writer.ready.clear()
+            recipient = self.connect('test2', recipient_writer)
+            message = create_message('test1', 'test2', 'x' * WRITE_BUFFER_LOW)
+            while recipient.buffered <= WRITE_BUFFER_HIGH:
+                self.processor.process_message(message)
+            self.assertIs(sender.blocked_by, recipient)
+            waiting = asyncio.create_task(sender.wait_writable())
+            await asyncio.sleep(0.05)
+            self.assertFalse(waiting.done())
+            recipient_writer.ready.set()
+            await asyncio.wait_for(waiting, 1)
+            self.assertIsNone(sender.blocked_by)
+
+        asyncio.run(scenario())
+
+    def test_overflow_offline(self):
+        # Сообщение, не поместившееся в очередь получателя, сохраняется, получатель отключается
+        async def scenario():
+            self.processor.loop = asyncio.get_running_loop()
+            recipient_writer = Writer()
+            recipient_writer.ready.clear()
+            recipient = self.connect('test2', recipient_writer)
+            message = create_message('test1', 'test2', 'x' * WRITE_BUFFER_LOW)
+            while recipient in self.processor.clients and not self.database.offline_count('test2'):
+                self.processor.process_message(message)
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            self.assertNotIn(recipient, self.processor.clients)
+            self.assertNotIn('test2', self.processor.names)
+            self.assertEqual(self.database.offline_count('test2'), 1)
+            # Получатель не в сети - сразу в очередь
+            self.processor.process_message(message)
+            self.assertEqual(self.database.offline_count('test2'), 2)
+
+        asyncio.run(scenario())
+
+
+class TestAsyncAuthorization(unittest.TestCase):
+    # Авторизация через задачу-читатель соединения на локальном TCP сервере
+    def setUp(self):
+        self.database = MemoryStorage()
+        self.database.add_user('test1', password_hash('test1', 'pw'))
+        self.processor = AsyncMessageProcessor('127.0.0.1', DEFAULT_PORT, self.database)
+
+    def tearDown(self):
+        self.processor.auth_pool.shutdown()
+
+    def run_scenario(self, scenario):
+        async def main():
+            self.processor.loop = asyncio.get_running_loop()
+            server = await asyncio.start_server(self.processor.handle_connection, '127.0.0.1', 0)
+            try:
+                await asyncio.wait_for(scenario(server.sockets[0].getsockname()), 5)
+            finally:
+                for client in list(self.processor.clients):
+                    self.processor.remove_client(client)
+                await asyncio.sleep(0.05)
+                server.close()
+                await server.wait_closed()
+
+        asyncio.run(main())
+
+    @staticmethod
+    async def request(reader, writer, message):
+        writer.write(encode_message(message))
+        return decode_message(await reader.read(MAX_PACKAGE_LENGTH))
+
+    async def login(self, address, token=None):
+        # PRESENCE -> 511 -> HMAC -> 200, с токеном - PRESENCE -> 200
+        reader, writer = await asyncio.open_connection(*address)
+        answer = await self.request(reader, writer, create_presence('test1', 'key', framing=False, token=token))
+        if answer[RESPONSE] == 511:
+            answer = await self.request(reader, writer, create_auth_answer(password_hash('test1', 'pw'),
+                                                                           answer[DATA]))
+        return reader, writer, answer
+
+    def test_login(self):
+        async def scenario(address):
+            reader, writer, answer = await self.login(address)
+            self.assertEqual(answer[RESPONSE], 200)
+            self.assertEqual(list(self.processor.names), ['test1'])
+            writer.close()
+
+        self.run_scenario(scenario)
+
+    def test_resume(self):
+        # Вход по токену без 511, токен разовый
+        async def scenario(address):
+            reader, writer, first = await self.login(address)
+            writer.close()
+            await asyncio.sleep(0.1)
+            reader, writer = await asyncio.open_connection(*address)
+            second = await self.request(reader, writer,
+                                        create_presence('test1', 'key', framing=False, token=first[TOKEN]))
+            self.assertEqual(second[RESPONSE], 200)
+            self.assertNotEqual(second[TOKEN], first[TOKEN])
+            writer.close()
+            await asyncio.sleep(0.1)
+            reader, writer = await asyncio.open_connection(*address)
+            answer = await self.request(reader, writer,
+                                        create_presence('test1', 'key', framing=False, token=first[TOKEN]))
+            self.assertEqual(answer[RESPONSE], 511)
+            writer.close()
+
+        self.run_scenario(scenario)
+
+    def test_auth_timeout(self):
+        # Клиент, не ответивший на 511, отключается по истечении auth_timeout
+        self.processor.auth_timeout = 0.2
+
+        async def scenario(address):
+            reader, writer = await asyncio.open_connection(*address)
+            answer = await self.request(reader, writer, create_presence('test1', 'key', framing=False))
+            self.assertEqual(answer[RESPONSE], 511)
+            self.assertEqual(await reader.read(MAX_PACKAGE_LENGTH), b'')
+            self.assertEqual(self.processor.clients, [])
+            self.assertEqual(self.processor.names, {})
+            writer.close()
+
+        self.run_scenario(scenario)
+
+    def test_name_taken_during_challenge(self):
+        # Пока клиент считал ответ на 511, имя занял другой клиент
+        async def scenario(address):
+            reader, writer = await asyncio.open_connection(*address)
+            challenge = await self.request(reader, writer, create_presence('test1', 'key', framing=False))
+            self.assertEqual(challenge[RESPONSE], 511)
+            other = ClientConnection(None, Writer())
+            self.processor.clients.append(other)
+            self.processor.start_session('test1', other)
+            answer = await self.request(reader, writer, create_auth_answer(password_hash('test1', 'pw'),
+                                                                           challenge[DATA]))
+            self.assertEqual(answer[RESPONSE], 400)
+            self.assertEqual(answer[ERROR], 'Имя пользователя уже занято.')
+            self.assertIs(self.processor.names['test1'], other)
+            writer.close()
+
+        self.run_scenario(scenario)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+import sys
+import os
+import socket
+import asyncio
+import tempfile
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common.variables import *
+from common.utils import encode_message, decode_message, MessageDecoder
+from server.cluster import ShardWorker, ShardedServer, route_path, ROUTE_CLAIM, ROUTE_RELEASE, ROUTE_DELIVER, \
+    ROUTE_DATAGRAM_LIMIT, SHARD, PRESENCE_RESYNC_INTERVAL
+from server.memory_storage import MemoryStorage
+
+
+class Connection:
+    # Соединение движка asyncio: запись копится в буфере
+    def __init__(self):
+        self.decoder = MessageDecoder()
+        self.sent = bytearray()
+
+    def send(self, data):
+        self.sent += data
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Нет Unix-сокетов')
+class TestShardWorker(unittest.TestCase):
+    # Обработчик №0 из двух, вместо общего словаря Manager - обычный словарь,
+    # сокет обработчика №1 - в тесте
+    def setUp(self):
+        self.database = MemoryStorage()
+        for name in ('test1', 'test2'):
+            self.database.add_user(name, b'hash')
+        self.presence = dict()
+        self.worker = ShardWorker('127.0.0.1', DEFAULT_PORT, self.database, 0, self.presence, threading.Lock(),
+                                  tempfile.mkdtemp(), 2)
+        self.worker.route_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.worker.route_sock.bind(self.worker.route_path(0))
+        self.worker.route_sock.setblocking(False)
+        self.other = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.other.bind(self.worker.route_path(1))
+        self.other.settimeout(1)
+
+    def tearDown(self):
+        self.worker.route_sock.close()
+        self.other.close()
+
+    def route(self, message):
+        self.other.sendto(encode_message(message), self.worker.route_path(0))
+        self.worker.process_routed()
+
+    def test_remote_presence(self):
+        # Присутствие пользователей других процессов - из служебных пакетов, без обращения к общему словарю
+        self.route({ACTION: ROUTE_CLAIM, ACCOUNT_NAME: 'test1', SHARD: 1})
+        self.assertTrue(self.worker.user_online('test1'))
+        # Освобождение имени процессом, за которым оно уже не закреплено, не учитывается
+        self.route({ACTION: ROUTE_RELEASE, ACCOUNT_NAME: 'test1', SHARD: 2})
+        self.assertTrue(self.worker.user_online('test1'))
+        self.route({ACTION: ROUTE_RELEASE, ACCOUNT_NAME: 'test1', SHARD: 1})
+        self.assertFalse(self.worker.user_online('test1'))
+
+    def process_message(self, message):
+        # Обработка сообщения в цикле событий: проверка по общему словарю выполняется в пуле
+        async def scenario():
+            self.worker.loop = asyncio.get_running_loop()
+            self.worker.process_message(message)
+            await asyncio.sleep(0.1)
+
+        asyncio.run(scenario())
+
+    def test_forward(self):
+        # Сообщение пользователю другого процесса пересылается ему, пользователю не в сети - в очередь
+        self.route({ACTION: ROUTE_CLAIM, ACCOUNT_NAME: 'test2', SHARD: 1})
+        message = {ACTION: MESSAGE, SENDER: 'test1', DESTINATION: 'test2', MESSAGE_TEXT: 'text'}
+        self.worker.process_message(message)
+        self.assertEqual(decode_message(self.other.recv(MAX_FRAME_LENGTH)), message)
+        self.route({ACTION: ROUTE_RELEASE, ACCOUNT_NAME: 'test2', SHARD: 1})
+        self.process_message(message)
+        self.assertEqual(self.database.offline_count('test2'), 1)
+
+    def test_forward_unknown(self):
+        # Пакет о подключении получателя не дошёл: процесс получателя находится по общему словарю
+        self.presence['test2'] = 1
+        message = {ACTION: MESSAGE, SENDER: 'test1', DESTINATION: 'test2', MESSAGE_TEXT: 'text'}
+        self.process_message(message)
+        self.assertEqual(decode_message(self.other.recv(MAX_FRAME_LENGTH)), message)
+        self.assertEqual(self.database.offline_count('test2'), 0)
+
+    def test_announce_flood(self):
+        # Изменений присутствия больше, чем вмещает очередь Unix-сокета получателя: ни одно не теряется
+        received = []
+
+        def reader():
+            time.sleep(0.1)
+            while len(received) < 100:
+                received.append(decode_message(self.other.recv(MAX_FRAME_LENGTH)))
+
+        thread = threading.Thread(target=reader)
+        thread.start()
+        for i in range(100):
+            self.worker.announce(ROUTE_CLAIM, f'user{i}')
+        thread.join(5)
+        self.assertEqual([message[ACCOUNT_NAME] for message in received], [f'user{i}' for i in range(100)])
+
+    def test_resync_presence(self):
+        # Пакет об отключении не дошёл: запись в локальной копии исправляется сверкой с общим словарём
+        self.route({ACTION: ROUTE_CLAIM, ACCOUNT_NAME: 'test1', SHARD: 1})
+        self.presence['test2'] = 1
+
+        async def scenario():
+            self.worker.loop = asyncio.get_running_loop()
+            task = asyncio.create_task(self.worker.resync_presence())
+            await asyncio.sleep(PRESENCE_RESYNC_INTERVAL + 0.2)
+            self.worker.running = False
+            task.cancel()
+
+        asyncio.run(scenario())
+        self.assertEqual(self.worker.remote, {'test2': 1})
+        self.assertFalse(self.worker.user_online('test1'))
+
+    def test_forward_too_long(self):
+        # Пакет больше предела пересылки - через общую очередь и уведомление процессу получателя
+        self.route({ACTION: ROUTE_CLAIM, ACCOUNT_NAME: 'test2', SHARD: 1})
+        message = {ACTION: MESSAGE, SENDER: 'test1', DESTINATION: 'test2', MESSAGE_TEXT: 'x' * ROUTE_DATAGRAM_LIMIT}
+        self.worker.process_message(message)
+        self.assertEqual(decode_message(self.other.recv(MAX_FRAME_LENGTH)),
+                         {ACTION: ROUTE_DELIVER, ACCOUNT_NAME: 'test2'})
+        self.assertEqual(self.database.pop_offline('test2'), [message])
+
+    def test_deliver(self):
+        # Уведомление об отложенных сообщениях для подключённого пользователя - доставка из очереди
+        client = Connection()
+        self.worker.clients.append(client)
+        self.worker.start_session('test2', client)
+        message = {ACTION: MESSAGE, SENDER: 'test1', DESTINATION: 'test2', MESSAGE_TEXT: 'text'}
+        self.database.store_offline('test2', message)
+        self.route({ACTION: ROUTE_DELIVER, ACCOUNT_NAME: 'test2'})
+        self.assertEqual(self.database.offline_count('test2'), 0)
+        decoder = MessageDecoder()
+        decoder.feed(client.sent)
+        self.assertEqual(list(decoder.messages()), [message])
+
+    def test_claim(self):
+        # Имя закрепляется в общем словаре, остальные процессы получают изменение присутствия
+        async def scenario():
+            self.worker.loop = asyncio.get_running_loop()
+            client, peer = socket.socketpair()
+            self.worker.clients.append(client)
+            self.assertTrue(await self.worker.claim_name_async('test1', client))
+            self.assertFalse(await self.worker.claim_name_async('test1', client))
+            self.presence['test2'] = 1
+            self.assertFalse(await self.worker.claim_name_async('test2', client))
+            self.worker.end_session(client)
+            await asyncio.sleep(0.1)
+            client.close()
+            peer.close()
+
+        asyncio.run(scenario())
+        self.assertEqual(self.presence, {'test2': 1})
+        self.assertEqual(decode_message(self.other.recv(MAX_FRAME_LENGTH)),
+                         {ACTION: ROUTE_CLAIM, ACCOUNT_NAME: 'test1', SHARD: 0})
+        self.assertEqual(decode_message(self.other.recv(MAX_FRAME_LENGTH)),
+                         {ACTION: ROUTE_RELEASE, ACCOUNT_NAME: 'test1', SHARD: 0})
+
+
+
+@unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT') and hasattr(socket, 'AF_UNIX'), 'Нет SO_REUSEPORT')
+class TestShardedServer(unittest.TestCase):
+    def test_purge_shard(self):
+        # Имена пользователей аварийно завершившегося обработчика освобождаются
+        server = ShardedServer('127.0.0.1', DEFAULT_PORT, None, 2)
+        server.database = MemoryStorage()
+        server.database.add_user('test1', b'hash')
+        server.database.user_login('test1', '127.0.0.1', 7777, None)
+        server.presence = {'test1': 0, 'test2': 1}
+        server.presence_lock = threading.Lock()
+        server.route_dir = tempfile.mkdtemp()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as other:
+            other.bind(route_path(server.route_dir, 1))
+            other.settimeout(1)
+            server.purge_shard(0)
+            self.assertEqual(decode_message(other.recv(MAX_FRAME_LENGTH)),
+                             {ACTION: ROUTE_RELEASE, ACCOUNT_NAME: 'test1', SHARD: 0})
+        self.assertEqual(server.presence, {'test2': 1})
+        self.assertEqual(server.database.active_users_list(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
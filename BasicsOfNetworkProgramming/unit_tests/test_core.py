@@ -0,0 +1,491 @@
+import sys
+import os
+import socket
+import struct
+import time
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common.variables import *
+from common.utils import MessageDecoder, get_message, send_message, JSON_CODEC, CODECS
+from client.protocol import password_hash, create_presence, create_auth_answer, create_message
+from server.core import MessageProcessor
+from server.memory_storage import MemoryStorage
+from server.database import ServerStorage
+
+
+class TestWriteBuffers(unittest.TestCase):
+    def setUp(self):
+        self.processor = MessageProcessor('127.0.0.1', DEFAULT_PORT, None)
+        self.server_sock, self.client_sock = socket.socketpair()
+        self.server_sock.setblocking(False)
+        self.processor.clients.append(self.server_sock)
+        self.processor.decoders[self.server_sock] = MessageDecoder()
+        self.processor.write_buffers[self.server_sock] = bytearray()
+
+    def tearDown(self):
+        self.server_sock.close()
+        self.client_sock.close()
+
+    def read_all(self):
+        self.client_sock.settimeout(0.1)
+        try:
+            while self.client_sock.recv(MAX_FRAME_LENGTH):
+                pass
+        except socket.timeout:
+            pass
+
+    def test_send_not_blocking(self):
+        # Клиент не читает: запись не блокирует, остаток ждёт в буфере
+        self.processor.write(self.server_sock, b'x' * WRITE_BUFFER_HIGH * 2)
+        self.assertGreater(self.processor.buffer_size(self.server_sock), 0)
+        self.assertIs(self.processor.paused[self.server_sock], self.server_sock)
+
+    def test_resume_after_drain(self):
+        self.processor.write(self.server_sock, b'x' * WRITE_BUFFER_HIGH * 2)
+        while self.processor.buffer_size(self.server_sock):
+            self.read_all()
+            self.processor.flush(self.server_sock)
+        self.assertNotIn(self.server_sock, self.processor.paused)
+
+    def test_limit_disconnects(self):
+        self.processor.write(self.server_sock, b'x' * (WRITE_BUFFER_LIMIT // 2))
+        with self.assertRaises(ConnectionAbortedError):
+            self.processor.write(self.server_sock, b'x' * WRITE_BUFFER_LIMIT)
+
+    def test_drop_client(self):
+        self.processor.write(self.server_sock, b'x' * WRITE_BUFFER_HIGH * 2)
+        self.processor.drop_client(self.server_sock)
+        self.assertEqual(self.processor.paused, {})
+        self.assertNotIn(self.server_sock, self.processor.write_buffers)
+        with self.assertRaises(OSError):
+            self.processor.send(self.server_sock, {RESPONSE: 200})
+
+
+class TestResetClient(unittest.TestCase):
+    # Клиент сбросил соединение (RST): getpeername у сокета сервера уже недоступен
+    def setUp(self):
+        self.database = MemoryStorage()
+        for name in ('test1', 'test2'):
+            self.database.add_user(name, b'hash')
+        self.processor = MessageProcessor('127.0.0.1', DEFAULT_PORT, self.database)
+        self.processor.sock = socket.create_server(('127.0.0.1', 0))
+        self.client_sock = socket.create_connection(self.processor.sock.getsockname())
+        self.processor.accept_client()
+        self.server_sock = self.processor.clients[0]
+        self.processor.start_session('test2', self.server_sock)
+        self.client_sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+        self.client_sock.close()
+        time.sleep(0.1)
+
+    def tearDown(self):
+        self.processor.auth_pool.shutdown()
+        self.processor.sock.close()
+
+    def test_remove_client(self):
+        self.processor.remove_client(self.server_sock)
+        self.assertEqual(self.processor.clients, [])
+        self.assertEqual(self.processor.names, {})
+
+    def test_message_to_reset_client(self):
+        # Сообщение сброшенному получателю сохраняется, получатель отключается
+        message = create_message('test1', 'test2', 'text')
+        for i in range(3):
+            self.processor.process_message(message)
+            if self.server_sock not in self.processor.clients:
+                break
+        self.assertNotIn('test2', self.processor.names)
+        self.assertGreaterEqual(self.database.offline_count('test2'), 1)
+
+
+class TestManyDescriptors(unittest.TestCase):
+    # Дескриптор клиента больше FD_SETSIZE (1024): цикл сервера должен продолжать его обслуживать
+    def setUp(self):
+        resource = __import__('resource')
+        if resource.getrlimit(resource.RLIMIT_NOFILE)[0] < 1200:
+            self.skipTest('лимит открытых файлов меньше 1200')
+        self.database = MemoryStorage()
+        self.database.add_user('test1', password_hash('test1', 'pass'))
+        probe = socket.create_server(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        self.filler = [os.open(os.devnull, os.O_RDONLY) for i in range(1100)]
+        self.processor = MessageProcessor('127.0.0.1', port, self.database)
+        self.processor.daemon = True
+        self.processor.start()
+        time.sleep(0.2)
+        self.client_sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+
+    def tearDown(self):
+        self.client_sock.close()
+        self.processor.running = False
+        self.processor.join(5)
+        self.processor.auth_pool.shutdown()
+        for sock in [self.processor.sock, self.processor.wakeup_recv, self.processor.wakeup_send] + \
+                self.processor.clients:
+            sock.close()
+        for fd in self.filler:
+            os.close(fd)
+
+    def test_presence(self):
+        send_message(self.client_sock, create_presence('test1', 'key', framing=False))
+        response = get_message(self.client_sock)
+        self.assertEqual(response[RESPONSE], 511)
+        self.assertTrue(self.processor.is_alive())
+        self.assertGreater(self.processor.clients[0].fileno(), 1024)
+
+
+class TestUsersResponse(unittest.TestCase):
+    def setUp(self):
+        self.database = MemoryStorage()
+        for i in range(5):
+            self.database.add_user(f'test{i}', b'hash')
+        self.processor = MessageProcessor('127.0.0.1', DEFAULT_PORT, self.database)
+
+    def request(self, **params):
+        message = {ACTION: USERS_REQUEST, ACCOUNT_NAME: 'test0'}
+        message.update(params)
+        return self.processor.users_response(message)
+
+    def test_legacy(self):
+        response = self.request()
+        self.assertEqual(sorted(response[LIST_INFO]), [f'test{i}' for i in range(5)])
+        self.assertNotIn(NEXT_PAGE, response)
+
+    def test_pages(self):
+        response = self.request(**{DIRECTORY_VERSION: 0, PAGE_SIZE: 2})
+        self.assertEqual((response[LIST_INFO], response[NEXT_PAGE]), (['test0', 'test1'], 'test1'))
+        self.assertEqual(response[DIRECTORY_VERSION], self.database.directory_version())
+        response = self.request(**{PAGE_AFTER: 'test3', PAGE_SIZE: 2})
+        self.assertEqual((response[LIST_INFO], response[NEXT_PAGE]), (['test4'], None))
+
+    def test_delta(self):
+        version = self.database.directory_version()
+        self.database.add_user('test5', b'hash')
+        self.database.remove_user('test1')
+        response = self.request(**{DIRECTORY_VERSION: version})
+        self.assertTrue(response[DELTA])
+        self.assertEqual((response[LIST_INFO], response[REMOVED]), (['test5'], ['test1']))
+        # Неизвестная версия - полный справочник
+        response = self.request(**{DIRECTORY_VERSION: version + 100})
+        self.assertNotIn(DELTA, response)
+        self.assertEqual(len(response[LIST_INFO]), 5)
+
+
+class TestUpdates(unittest.TestCase):
+    def setUp(self):
+        self.database = MemoryStorage()
+        self.database.add_user('test1', b'hash')
+        self.processor = MessageProcessor('127.0.0.1', DEFAULT_PORT, self.database)
+        self.pairs = [socket.socketpair() for _ in range(2)]
+        for i, (server_sock, client_sock) in enumerate(self.pairs):
+            server_sock.setblocking(False)
+            client_sock.settimeout(1)
+            self.processor.clients.append(server_sock)
+            self.processor.names[f'user{i}'] = server_sock
+            self.processor.decoders[server_sock] = MessageDecoder()
+            self.processor.write_buffers[server_sock] = bytearray()
+
+    def tearDown(self):
+        for pair in self.pairs:
+            for sock in pair:
+                sock.close()
+
+    def test_debounce(self):
+        version = self.database.directory_version()
+        self.database.add_user('test2', b'hash')
+        self.processor.service_update_lists()
+        self.database.add_user('test3', b'hash')
+        self.database.remove_user('test1')
+        self.processor.service_update_lists()
+        # До окончания окна рассылки нет
+        self.processor.send_updates()
+        self.assertEqual(self.processor.buffer_size(self.pairs[0][0]), 0)
+        self.processor.updates_deadline = 0
+        self.processor.send_updates()
+        self.assertIsNone(self.processor.updates_deadline)
+        for server_sock, client_sock in self.pairs:
+            message = get_message(client_sock)
+            self.assertEqual(message[RESPONSE], 205)
+            self.assertEqual((message[PREVIOUS_VERSION], message[DIRECTORY_VERSION]),
+                             (version, self.database.directory_version()))
+            self.assertEqual((message[LIST_INFO], message[REMOVED]), (['test2', 'test3'], ['test1']))
+        self.assertEqual(self.processor.broadcast_version, self.database.directory_version())
+        self.assertNotIn(DELTA, RESPONSE_205)
+
+
+class TestLoginResponse(unittest.TestCase):
+    def setUp(self):
+        self.processor = MessageProcessor('127.0.0.1', DEFAULT_PORT, None)
+
+    def test_codec(self):
+        decoder = MessageDecoder()
+        response = self.processor.create_login_response({FRAMING: True, PIPELINING: True, CODEC: ['unknown', 'json']})
+        self.assertEqual(response[CODEC], 'json')
+        self.processor.switch_format(decoder, response)
+        self.assertTrue(decoder.framed)
+        self.assertIs(decoder.codec, JSON_CODEC)
+
+    def test_legacy(self):
+        # Старый клиент: без заголовка длины кодек не согласуется
+        decoder = MessageDecoder()
+        response = self.processor.create_login_response({CODEC: list(CODECS)})
+        self.assertEqual(response, {RESPONSE: 200})
+        self.processor.switch_format(decoder, response)
+        self.assertFalse(decoder.framed)
+        self.assertIs(decoder.codec, JSON_CODEC)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class TestDispatch(unittest.TestCase):
+    def setUp(self):
+        self.database = MemoryStorage()
+        self.database.add_user('test1', b'hash')
+        self.processor = MessageProcessor('127.0.0.1', DEFAULT_PORT, self.database)
+        self.server_sock, self.client_sock = socket.socketpair()
+        self.server_sock.setblocking(False)
+        self.client_sock.settimeout(1)
+        self.processor.clients.append(self.server_sock)
+        self.processor.decoders[self.server_sock] = MessageDecoder()
+        self.processor.write_buffers[self.server_sock] = bytearray()
+
+    def tearDown(self):
+        self.server_sock.close()
+        self.client_sock.close()
+
+    def test_not_authorized(self):
+        with self.assertRaises(TypeError):
+            self.processor.process_client_message({ACTION: GET_CONTACTS, USER: 'test1'}, self.server_sock)
+
+    def test_session(self):
+        self.processor.start_session('test1', self.server_sock)
+        self.processor.process_client_message({ACTION: GET_CONTACTS, USER: 'test1'}, self.server_sock)
+        self.assertEqual(get_message(self.client_sock)[RESPONSE], 202)
+        # Запрос от имени другого пользователя
+        self.processor.process_client_message({ACTION: GET_CONTACTS, USER: 'test2'}, self.server_sock)
+        self.assertEqual(get_message(self.client_sock)[RESPONSE], 400)
+        self.assertEqual(self.processor.end_session(self.server_sock), 'test1')
+        self.assertEqual((self.processor.names, self.processor.sessions), ({}, {}))
+
+    def test_relay_request_id(self):
+        # Номер запроса отправителя остаётся только в подтверждении
+        self.processor.start_session('test1', self.server_sock)
+        message = create_message('test1', 'test1', 'text')
+        message[REQUEST_ID] = 7
+        self.processor.process_client_message(message, self.server_sock)
+        decoder = MessageDecoder()
+        relayed, answer = get_message(self.client_sock, decoder), get_message(self.client_sock, decoder)
+        self.assertEqual((relayed[MESSAGE_TEXT], answer[RESPONSE], answer[REQUEST_ID]), ('text', 200, 7))
+        self.assertNotIn(REQUEST_ID, relayed)
+        self.assertEqual(message[REQUEST_ID], 7)
+
+    def test_register_handler(self):
+        class PluginProcessor(MessageProcessor):
+            pass
+
+        def ping(processor, message, client):
+            processor.reply(client, message, {RESPONSE: 200, DATA: message[DATA]})
+
+        PluginProcessor.register_handler('ping', ping, required=(DATA,))
+        self.assertNotIn('ping', MessageProcessor.handlers)
+        processor = PluginProcessor('127.0.0.1', DEFAULT_PORT, self.database)
+        processor.clients = self.processor.clients
+        processor.decoders = self.processor.decoders
+        processor.write_buffers = self.processor.write_buffers
+        processor.start_session('test1', self.server_sock)
+        processor.process_client_message({ACTION: 'ping', DATA: 'pong'}, self.server_sock)
+        self.assertEqual(get_message(self.client_sock)[DATA], 'pong')
+        self.assertEqual(processor.action_timings()['ping']['count'], 1)
+
+
+class TestAuthorization(unittest.TestCase):
+    def setUp(self):
+        self.database = self.create_storage()
+        self.database.add_user('test1', password_hash('test1', 'pw'))
+        self.processor = MessageProcessor('127.0.0.1', DEFAULT_PORT, self.database)
+        self.connect()
+
+    def create_storage(self):
+        return MemoryStorage()
+
+    def connect(self):
+        # Вход записывается с адресом клиента, поэтому нужна пара TCP сокетов
+        with socket.create_server(('127.0.0.1', 0)) as listener:
+            self.client_sock = socket.create_connection(listener.getsockname())
+            self.server_sock, _ = listener.accept()
+        self.server_sock.setblocking(False)
+        self.client_sock.settimeout(1)
+        self.processor.clients.append(self.server_sock)
+        self.processor.decoders[self.server_sock] = MessageDecoder()
+        self.processor.write_buffers[self.server_sock] = bytearray()
+
+    def tearDown(self):
+        self.processor.auth_pool.shutdown()
+        self.server_sock.close()
+        self.client_sock.close()
+        self.database.close()
+
+    def answer(self, password):
+        # presence -> 511 без ожидания ответа, ответ клиента разбирается при следующем чтении сокета
+        self.processor.process_client_message(create_presence('test1', 'key', framing=False), self.server_sock)
+        challenge = get_message(self.client_sock)
+        self.assertEqual(challenge[RESPONSE], 511)
+        self.assertIn(self.server_sock, self.processor.challenges)
+        send_message(self.client_sock, create_auth_answer(password_hash('test1', password), challenge[DATA]))
+        self.processor.read_client(self.server_sock)
+        return get_message(self.client_sock)
+
+    def test_login(self):
+        self.assertEqual(self.answer('pw')[RESPONSE], 200)
+        self.assertEqual(self.processor.sessions, {self.server_sock: 'test1'})
+        # Запись входа выполняется пулом, результат забирает сетевой поток
+        self.processor.auth_pool.shutdown(wait=True)
+        self.processor.finish_logins()
+        self.assertEqual([user[0] for user in self.database.active_users_list()], ['test1'])
+        # Первый ключ пользователя - не изменение справочника
+        self.assertIsNone(self.processor.updates_deadline)
+
+    def test_key_change(self):
+        self.database.user_login('test1', '127.0.0.1', 7777, 'old key')
+        self.database.user_logout('test1')
+        version = self.database.directory_version()
+        self.assertEqual(self.answer('pw')[RESPONSE], 200)
+        self.processor.auth_pool.shutdown(wait=True)
+        self.processor.finish_logins()
+        # Смена ключа попадает в изменения справочника, клиентам уходит 205
+        self.assertEqual(self.database.get_pubkey('test1'), 'key')
+        self.assertEqual(self.database.directory_changes(version), (['test1'], []))
+        self.assertIsNotNone(self.processor.updates_deadline)
+
+    def test_wrong_password(self):
+        self.assertEqual(self.answer('wrong')[RESPONSE], 400)
+        self.assertNotIn(self.server_sock, self.processor.clients)
+        self.assertEqual(self.processor.challenges, {})
+
+    def wait_logins(self):
+        # Пул из одного потока: задача выполнится после записи всех входов
+        self.processor.auth_pool.submit(lambda: None).result()
+        self.processor.finish_logins()
+
+    def test_resume(self):
+        token = self.answer('pw')[TOKEN]
+        self.wait_logins()
+        self.processor.remove_client(self.server_sock)
+        # Повторное подключение с токеном: сразу 200 и новый токен, без 511 и передачи ключа
+        self.client_sock.close()
+        self.connect()
+        presence = create_presence('test1', 'key', framing=False, token=token)
+        self.processor.process_client_message(presence, self.server_sock)
+        self.wait_logins()
+        answer = get_message(self.client_sock)
+        self.assertEqual(answer[RESPONSE], 200)
+        self.assertIn(TOKEN, answer)
+        self.assertEqual(self.processor.sessions, {self.server_sock: 'test1'})
+        self.processor.remove_client(self.server_sock)
+        # Подделанный токен - обычная авторизация через 511
+        self.server_sock, self.client_sock = socket.socketpair()
+        self.client_sock.settimeout(1)
+        self.processor.clients.append(self.server_sock)
+        self.processor.decoders[self.server_sock] = MessageDecoder()
+        self.processor.write_buffers[self.server_sock] = bytearray()
+        presence[TOKEN] = token.replace(':test1.', ':test2.')
+        self.processor.process_client_message(presence, self.server_sock)
+        self.assertEqual(get_message(self.client_sock)[RESPONSE], 511)
+
+    def resume(self, token):
+        # Новое соединение с токеном прошлой сессии
+        self.processor.remove_client(self.server_sock)
+        self.client_sock.close()
+        self.connect()
+        self.processor.process_client_message(create_presence('test1', 'key', framing=False, token=token),
+                                              self.server_sock)
+        # Замена номера токена, затем запись входа
+        self.wait_logins()
+        answer = get_message(self.client_sock)
+        self.wait_logins()
+        return answer
+
+    def test_resume_in_pool(self):
+        # Номер токена заменяется в пуле: пока пул занят, сетевой поток не ждёт, имя не закреплено,
+        # сообщения пользователю уходят в очередь и доставляются после ответа 200
+        token = self.answer('pw')[TOKEN]
+        self.wait_logins()
+        self.processor.remove_client(self.server_sock)
+        self.client_sock.close()
+        self.connect()
+        busy = threading.Event()
+        self.processor.auth_pool.submit(busy.wait, 1)
+        self.processor.process_client_message(create_presence('test1', 'key', framing=False, token=token),
+                                              self.server_sock)
+        self.assertEqual(self.processor.names, {})
+        self.processor.process_message(create_message('test2', 'test1', 'text'))
+        self.assertEqual(self.database.offline_count('test1'), 1)
+        busy.set()
+        self.wait_logins()
+        decoder = MessageDecoder()
+        self.assertEqual(get_message(self.client_sock, decoder)[RESPONSE], 200)
+        self.assertEqual(self.processor.sessions, {self.server_sock: 'test1'})
+        self.assertEqual(get_message(self.client_sock, decoder)[MESSAGE_TEXT], 'text')
+
+    def test_token_single_use(self):
+        # Токен принимается один раз, каждый вход выдаёт новый и гасит прежние
+        first = self.answer('pw')[TOKEN]
+        self.wait_logins()
+        second = self.resume(first)[TOKEN]
+        self.assertEqual(self.resume(first)[RESPONSE], 511)
+        self.assertEqual(self.resume(second)[RESPONSE], 200)
+        # Вход по паролю гасит все выданные ранее токены
+        self.processor.remove_client(self.server_sock)
+        self.client_sock.close()
+        self.connect()
+        third = self.answer('pw')[TOKEN]
+        self.wait_logins()
+        self.assertEqual(self.resume(second)[RESPONSE], 511)
+        self.assertEqual(self.resume(third)[RESPONSE], 200)
+
+    def test_disconnect_before_stored(self):
+        self.answer('pw')
+        self.processor.remove_client(self.server_sock)
+        self.processor.auth_pool.shutdown(wait=True)
+        self.processor.finish_logins()
+        self.assertEqual(self.database.active_users_list(), [])
+
+
+class TestAuthorizationSql(TestAuthorization):
+    # Те же сценарии с записью входов пулом потоков в SQL хранилище (у потока пула своя сессия)
+    def create_storage(self):
+        return ServerStorage(os.path.join(tempfile.mkdtemp(), 'server.db3'))
+
+    def tearDown(self):
+        super().tearDown()
+        self.database.database_engine.dispose()
+
+    def test_reconnect_before_stored(self):
+        # Клиент оборвал соединение и вошёл снова раньше, чем пул записал его первый вход:
+        # обе записи активного подключения попадают в базу, остаётся одна - нового соединения
+        stored = threading.Event()
+        self.processor.auth_pool.submit(stored.wait, 1)
+        self.assertEqual(self.answer('pw')[RESPONSE], 200)
+        self.processor.remove_client(self.server_sock)
+        self.client_sock.close()
+        self.connect()
+        self.assertEqual(self.answer('pw')[RESPONSE], 200)
+        stored.set()
+        # Вход другого пользователя после этого записывается тем же потоком пула
+        self.database.add_user('test2', password_hash('test2', 'pw'))
+        with socket.create_server(('127.0.0.1', 0)) as listener:
+            other = socket.create_connection(listener.getsockname())
+            other_server, _ = listener.accept()
+        self.processor.start_session('test2', other_server)
+        self.processor.login('test2', other_server, 'key2', 'nonce')
+        self.processor.auth_pool.shutdown(wait=True)
+        self.processor.finish_logins()
+        self.assertEqual(sorted(user[0] for user in self.database.active_users_list()), ['test1', 'test2'])
+        other.close()
+        other_server.close()
@@ -0,0 +1,79 @@
+import sys
+import os
+import unittest
+import base64
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from Crypto.PublicKey import RSA
+from common.variables import *
+from client.protocol import create_message
+from client.core import MemoryClientDatabase
+from client.crypto import MessageCipher
+
+
+class TestMessageCipher(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.keys = {name: RSA.generate(1024) for name in ('test1', 'test2', 'test3')}
+
+    def setUp(self):
+        self.pubkey = self.keys['test2'].publickey().export_key().decode('ascii')
+        self.sender = MessageCipher('test1', self.keys['test1'], MemoryClientDatabase())
+        self.recipient = MessageCipher('test2', self.keys['test2'], MemoryClientDatabase())
+
+    def send(self, text, cipher=None):
+        ciphertext, session_key = (cipher or self.sender).encrypt('test2', self.pubkey, text)
+        return create_message('test1', 'test2', ciphertext, session_key)
+
+    def test_hybrid(self):
+        # Длинное сообщение, ключ переписки передаётся под RSA и расшифровывается получателем один раз
+        text = 'Привет! '.encode('utf8') * 1000
+        first, second = self.send(text), self.send(text)
+        self.assertEqual(first[SESSION_KEY], second[SESSION_KEY])
+        self.assertNotEqual(first[MESSAGE_TEXT], second[MESSAGE_TEXT])
+        self.assertEqual(self.recipient.decrypt(first), text)
+        self.recipient.decrypter = None
+        self.assertEqual(self.recipient.decrypt(second), text)
+
+    def test_json_fields(self):
+        # От JSON собеседника двоичные поля приходят строками base64
+        message = self.send(b'text')
+        message[MESSAGE_TEXT] = base64.b64encode(message[MESSAGE_TEXT]).decode('ascii')
+        message[SESSION_KEY] = base64.b64encode(message[SESSION_KEY]).decode('ascii')
+        self.assertEqual(self.recipient.decrypt(message), b'text')
+
+    def test_tampering(self):
+        message = self.send(b'text')
+        message[MESSAGE_TEXT] = message[MESSAGE_TEXT][:-1] + bytes([message[MESSAGE_TEXT][-1] ^ 1])
+        with self.assertRaises(ValueError):
+            self.recipient.decrypt(message)
+        # Имя отправителя защищено тегом
+        message = self.send(b'text')
+        message[SENDER] = 'test3'
+        with self.assertRaises(ValueError):
+            self.recipient.decrypt(message)
+
+    def test_key_change(self):
+        # После смены ключа получателя - новый ключ переписки, сохранённый в базе отправителя
+        first = self.send(b'text')
+        self.pubkey = self.keys['test3'].publickey().export_key().decode('ascii')
+        second = self.send(b'text')
+        self.assertNotEqual(first[SESSION_KEY], second[SESSION_KEY])
+        restarted = MessageCipher('test1', self.keys['test1'], self.sender.database)
+        self.assertEqual(self.send(b'text', restarted)[SESSION_KEY], second[SESSION_KEY])
+
+    def test_rsa_mode(self):
+        # Прежний режим: без ключа переписки, длинный текст не шифруется, получатель принимает оба режима
+        self.sender = MessageCipher('test1', self.keys['test1'], MemoryClientDatabase(), 'rsa')
+        message = self.send(b'text')
+        self.assertNotIn(SESSION_KEY, message)
+        self.assertEqual(self.recipient.decrypt(message), b'text')
+        with self.assertRaises(ValueError):
+            self.send(b'x' * 1000)
+        with self.assertRaises(ValueError):
+            MessageCipher('test1', self.keys['test1'], MemoryClientDatabase(), 'aes')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import sys
+import os
+import unittest
+import datetime
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import IntegrityError
+from server.database import ServerStorage
+from server.migrations import MIGRATIONS, apply_migrations
+
+
+class TestServerStorage(unittest.TestCase):
+    def setUp(self):
+        self.database = ServerStorage(':memory:')
+        self.database.add_user('test1', b'hash1')
+        self.database.add_user('test2', b'hash2')
+
+    def test_directory_loaded(self):
+        # Справочник нового экземпляра загружается из БД
+        self.database.user_login('test1', '127.0.0.1', 7777, 'key1')
+        self.database.load_users()
+        self.assertEqual(set(self.database.users), {'test1', 'test2'})
+        self.assertEqual(self.database.get_pubkey('test1'), 'key1')
+        self.assertEqual(self.database.get_hash('test2'), b'hash2')
+
+    def test_check_user(self):
+        self.assertTrue(self.database.check_user('test1'))
+        self.assertFalse(self.database.check_user('test3'))
+
+    def test_user_login_pubkey(self):
+        self.database.user_login('test1', '127.0.0.1', 7777, 'key1')
+        self.assertEqual([user[0] for user in self.database.active_users_list()], ['test1'])
+        self.database.user_logout('test1')
+        self.database.user_login('test1', '127.0.0.1', 7777, 'key2')
+        self.assertEqual(self.database.get_pubkey('test1'), 'key2')
+        self.database.load_users()
+        self.assertEqual(self.database.get_pubkey('test1'), 'key2')
+
+    def test_remove_user(self):
+        self.database.add_contact('test1', 'test2')
+        self.database.remove_user('test2')
+        self.assertFalse(self.database.check_user('test2'))
+        self.assertIsNone(self.database.get_pubkey('test2'))
+        self.assertEqual(self.database.get_contacts('test1'), [])
+
+    def test_contacts(self):
+        self.database.add_contact('test1', 'test2')
+        self.database.add_contact('test1', 'test2')
+        self.database.add_contact('test1', 'test3')
+        self.assertEqual(self.database.get_contacts('test1'), ['test2'])
+        self.database.remove_contact('test1', 'test2')
+        self.assertEqual(self.database.get_contacts('test1'), [])
+
+    def test_process_message(self):
+        self.database.process_message('test1', 'test2')
+        self.database.process_message('test1', 'test2')
+        # Счётчики накапливаются в памяти до сброса
+        self.assertGreaterEqual(self.database.stats_flush_lag(), 0)
+        stats = {row[0]: (row[2], row[3]) for row in self.database.message_history()}
+        self.assertEqual(stats, {'test1': (2, 0), 'test2': (0, 2)})
+        self.assertEqual(self.database.stats_flush_lag(), 0)
+
+    def test_stats_flush_on_close(self):
+        self.database.process_message('test2', 'test1')
+        self.database.close()
+        stats = {row[0]: (row[2], row[3]) for row in self.database.message_history()}
+        self.assertEqual(stats, {'test1': (0, 1), 'test2': (1, 0)})
+
+    def test_stats_flush_threshold(self):
+        self.database.stats_writer.flush_count = 3
+        for i in range(3):
+            self.database.process_message('test1', 'test2')
+        self.assertEqual(self.database.stats_writer.pending, 0)
+        self.assertEqual(self.database.stats_writer.flushed_total, 2)
+
+    def test_offline_queue(self):
+        # Сообщения отдаются в порядке поступления и удаляются из очереди
+        for i in range(3):
+            self.assertTrue(self.database.store_offline('test2', {'to': 'test2', 'mess_text': str(i)}))
+        self.assertFalse(self.database.store_offline('test3', {'to': 'test3'}))
+        self.assertEqual(self.database.offline_count('test2'), 3)
+        self.assertEqual([m['mess_text'] for m in self.database.pop_offline('test2')], ['0', '1', '2'])
+        self.assertEqual(self.database.pop_offline('test2'), [])
+
+    def test_offline_limit(self):
+        self.database.offline_limit = 2
+        for i in range(4):
+            self.database.store_offline('test2', {'mess_text': str(i)})
+        self.assertEqual([m['mess_text'] for m in self.database.pop_offline('test2')], ['2', '3'])
+
+    def test_offline_ttl(self):
+        self.database.store_offline('test2', {'mess_text': 'old'})
+        self.database.offline_ttl = datetime.timedelta(seconds=-1)
+        self.assertEqual(self.database.pop_offline('test2'), [])
+        self.assertEqual(self.database.offline_count('test2'), 0)
+
+
+class TestMigrations(unittest.TestCase):
+    def test_current_version(self):
+        database = ServerStorage(':memory:')
+        self.assertEqual(database.schema_version, MIGRATIONS[-1][0])
+
+    def test_upgrade_existing(self):
+        # База без индексов и с повторяющимися контактами
+        engine = create_engine('sqlite://')
+        with engine.begin() as connection:
+            connection.execute(text('CREATE TABLE Contacts (id INTEGER PRIMARY KEY, "user" INTEGER, contact INTEGER)'))
+            connection.execute(text('CREATE TABLE History (id INTEGER PRIMARY KEY, "user" INTEGER)'))
+            connection.execute(text('CREATE TABLE Login_history (id INTEGER PRIMARY KEY, name INTEGER)'))
+            connection.execute(text('INSERT INTO Contacts ("user", contact) VALUES (1, 2), (1, 2), (2, 1)'))
+        self.assertEqual(apply_migrations(engine, MIGRATIONS[:1]), 1)
+        # Повторный запуск ничего не применяет
+        self.assertEqual(apply_migrations(engine, MIGRATIONS[:1]), 1)
+        with engine.begin() as connection:
+            self.assertEqual(connection.execute(text('SELECT COUNT(*) FROM Contacts')).scalar(), 2)
+            with self.assertRaises(IntegrityError):
+                connection.execute(text('INSERT INTO Contacts ("user", contact) VALUES (1, 2)'))
+
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'test.db3')
+        self.database = ServerStorage(self.path, profile={'synchronous': 'full', 'cache_size': '-2000'})
+        self.database.add_user('test1', b'hash1')
+
+    def tearDown(self):
+        self.database.close()
+        self.database.database_engine.dispose()
+
+    def test_pragmas(self):
+        self.assertEqual(self.database.session.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+        self.assertEqual(self.database.session.execute(text('PRAGMA synchronous')).scalar(), 2)
+        self.assertEqual(self.database.session.execute(text('PRAGMA cache_size')).scalar(), -2000)
+
+    def test_invalid_profile(self):
+        with self.assertRaises(ValueError):
+            ServerStorage.load_profile({'journal_mode': 'wal; DROP TABLE Users'})
+
+    def test_read_during_write(self):
+        # Незавершённая запись в одном потоке не мешает чтению в другом
+        self.database.session.add(self.database.UsersContacts(1, 1))
+        self.database.session.flush()
+        result = []
+        reader = threading.Thread(target=lambda: result.append(self.database.users_list()))
+        reader.start()
+        reader.join(2)
+        self.database.session.commit()
+        self.assertEqual([row[0] for row in result[0]], ['test1'])
+        # У потоков разные сессии
+        sessions = []
+        reader = threading.Thread(target=lambda: sessions.append(self.database.session))
+        reader.start()
+        reader.join()
+        self.assertIsNot(sessions[0], self.database.session)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import sys
+import os
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common import decos
+from common.decos import log
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+
+@log
+def traced(value):
+    return value * 2
+
+
+def caller():
+    return traced(2)
+
+
+class TestLog(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('server' if 'server.py' in sys.argv[0] else 'client')
+        self.handlers, self.level = self.logger.handlers, self.logger.level
+        self.handler = ListHandler()
+        self.logger.handlers = [self.handler]
+        self.logger.setLevel(logging.DEBUG)
+
+    def tearDown(self):
+        self.logger.handlers = self.handlers
+        self.logger.setLevel(self.level)
+        decos.set_tracing(True)
+
+    def test_trace_caller(self):
+        self.assertEqual(caller(), 4)
+        self.assertEqual(len(self.handler.records), 1)
+        self.assertIn('traced', self.handler.records[0])
+        self.assertIn('Вызов из функции caller', self.handler.records[0])
+
+    def test_level_disabled(self):
+        self.logger.setLevel(logging.INFO)
+        self.assertEqual(caller(), 4)
+        self.assertEqual(self.handler.records, [])
+
+    def test_runtime_switch(self):
+        decos.set_tracing(False)
+        caller()
+        decos.set_tracing(True)
+        caller()
+        self.assertEqual(len(self.handler.records), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import sys
+import os
+import json
+import logging
+import multiprocessing
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from logs.pipeline import BoundedQueueHandler, SamplingFilter, JsonFormatter, setup_logging, stop_listener, \
+    flush_logs
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('test_pipeline')
+        self.logger.propagate = False
+
+    def tearDown(self):
+        self.logger.handlers = []
+
+    def test_drop_and_count(self):
+        handler = BoundedQueueHandler(2)
+        self.logger.addHandler(handler)
+        self.logger.setLevel(logging.DEBUG)
+        for i in range(5):
+            self.logger.debug('record %s', i)
+        self.assertEqual(handler.dropped, 3)
+        self.assertEqual(handler.queue.qsize(), 2)
+        # После освобождения очереди в лог попадает предупреждение о потерях
+        handler.queue.get_nowait()
+        handler.queue.get_nowait()
+        self.logger.debug('after')
+        handler.queue.get_nowait()
+        warning = handler.queue.get_nowait()
+        self.assertEqual(warning.levelno, logging.WARNING)
+        self.assertEqual(warning.args, (3,))
+
+    def test_sampling(self):
+        sampling = SamplingFilter({'test_pipeline': 3})
+        records = [logging.makeLogRecord({'name': 'test_pipeline', 'levelno': logging.DEBUG}) for i in range(6)]
+        self.assertEqual(sum(sampling.filter(record) for record in records), 2)
+        error = logging.makeLogRecord({'name': 'test_pipeline', 'levelno': logging.ERROR})
+        self.assertTrue(all(sampling.filter(error) for i in range(3)))
+
+    def test_listener_json(self):
+        target = ListHandler()
+        target.setFormatter(JsonFormatter())
+        handler, listener = setup_logging(('test_pipeline',), target, logging.INFO, 100)
+        self.logger.debug('skipped')
+        self.logger.info('message %s', 1)
+        try:
+            raise ValueError('test')
+        except ValueError:
+            self.logger.exception('failed')
+        stop_listener(listener)
+        records = [json.loads(line) for line in target.records]
+        self.assertEqual([record['message'] for record in records], ['message 1', 'failed'])
+        self.assertIn('ValueError', records[1]['exc'])
+
+    @unittest.skipUnless(hasattr(os, 'register_at_fork'), 'Нет fork')
+    def test_forked_child(self):
+        # Записи процесса, порождённого через fork (обработчик шардированного сервера), попадают в файл
+        path = os.path.join(tempfile.mkdtemp(), 'test.log')
+        target = logging.FileHandler(path, encoding='utf8')
+        handler, listener = setup_logging(('test_fork',), target, logging.INFO, 100)
+        process = multiprocessing.get_context('fork').Process(target=log_from_child)
+        process.start()
+        process.join(10)
+        stop_listener(listener)
+        target.close()
+        with open(path, encoding='utf8') as file:
+            self.assertEqual(file.read().splitlines(), [f'child {number}' for number in range(5)])
+
+
+def log_from_child():
+    for number in range(5):
+        logging.getLogger('test_fork').info('child %s', number)
+    flush_logs()
+
+
+if __name__ == '__main__':
+    unittest.main()
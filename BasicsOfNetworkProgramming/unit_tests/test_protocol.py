@@ -0,0 +1,148 @@
+import sys
+import os
+import unittest
+import hmac
+import binascii
+import asyncio
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common.variables import *
+from client.protocol import password_hash, create_presence, create_auth_answer, create_message, \
+    create_users_request, reconnect_delay
+from common.utils import key_fingerprint
+from common.utils import FRAME_HEADER
+from client.core import MemoryClientDatabase
+from client.headless import AsyncClient
+
+
+class TestProtocol(unittest.TestCase):
+    def test_password_hash_salt(self):
+        # Соль - логин в нижнем регистре
+        self.assertEqual(password_hash('Test1', 'pass'), password_hash('test1', 'pass'))
+        self.assertNotEqual(password_hash('test1', 'pass'), password_hash('test2', 'pass'))
+
+    def test_presence(self):
+        presence = create_presence('test1', 'key', pipelining=False)
+        presence[TIME] = 1.1
+        self.assertEqual(presence, {ACTION: PRESENCE, TIME: 1.1, USER: {ACCOUNT_NAME: 'test1', PUBLIC_KEY: 'key'},
+                                    FRAMING: True, PIPELINING: False})
+        self.assertEqual(create_presence('test1', 'key', codecs=('msgpack', 'json'))[CODEC], ['msgpack', 'json'])
+        # С токеном ключ не передаётся
+        presence = create_presence('test1', 'key', token='token')
+        self.assertEqual((presence[TOKEN], presence[USER]), ('token', {ACCOUNT_NAME: 'test1'}))
+
+    def test_auth_answer(self):
+        # Ответ совпадает с тем, что проверяет сервер
+        passwd_hash = password_hash('test1', 'pass')
+        answer = create_auth_answer(passwd_hash, 'abcdef')
+        digest = hmac.new(passwd_hash, b'abcdef', 'MD5').digest()
+        self.assertEqual(answer[RESPONSE], 511)
+        self.assertTrue(hmac.compare_digest(binascii.a2b_base64(answer[DATA]), digest))
+        self.assertNotIn(PUBLIC_KEY, answer)
+        self.assertEqual(create_auth_answer(passwd_hash, 'abcdef', 'key')[PUBLIC_KEY], 'key')
+
+    def test_message(self):
+        message = create_message('test1', 'test2', 'text')
+        self.assertEqual((message[ACTION], message[SENDER], message[DESTINATION], message[MESSAGE_TEXT]),
+                         (MESSAGE, 'test1', 'test2', 'text'))
+        self.assertNotIn(SESSION_KEY, message)
+        self.assertEqual(create_message('test1', 'test2', b'text', b'key')[SESSION_KEY], b'key')
+
+    def test_users_request(self):
+        # Без параметров - запрос всего справочника (как у старых клиентов)
+        request = create_users_request('test1')
+        self.assertNotIn(DIRECTORY_VERSION, request)
+        self.assertNotIn(PAGE_AFTER, request)
+        request = create_users_request('test1', version=5, after='test2', limit=10)
+        self.assertEqual((request[DIRECTORY_VERSION], request[PAGE_AFTER], request[PAGE_SIZE]), (5, 'test2', 10))
+
+    def test_reconnect_delay(self):
+        # Случайная задержка от нуля до удвоенной с каждой попыткой границы, не больше максимума
+        for attempt in range(20):
+            bound = min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2 ** attempt)
+            delays = [reconnect_delay(attempt) for i in range(50)]
+            self.assertTrue(all(0 <= delay <= bound for delay in delays))
+            self.assertGreater(len(set(delays)), 1)
+
+
+class TestAsyncClient(unittest.TestCase):
+    def test_oversize_frame(self):
+        # Превышение размера пакета - потеря соединения: приёмник завершается, ожидающие запросы получают ошибку
+        async def scenario():
+            client = AsyncClient('test1', 'pass')
+            client.reader = asyncio.StreamReader()
+            client.decoder.framed = True
+            client.connected = True
+            future = asyncio.get_running_loop().create_future()
+            client.pending[1] = future
+            client.reader.feed_data(FRAME_HEADER.pack(MAX_FRAME_LENGTH + 1))
+            await asyncio.wait_for(client.read_loop(), 1)
+            return client, future
+
+        client, future = asyncio.run(scenario())
+        self.assertFalse(client.connected)
+        self.assertIsInstance(future.exception(), ConnectionResetError)
+        self.assertIsNone(client.inbox.get_nowait())
+
+    def test_send_drain(self):
+        # Отправка ждёт освобождения буфера сокета: сервер не читает - отправитель приостановлен
+        class Writer:
+            def __init__(self):
+                self.data = bytearray()
+                self.ready = asyncio.Event()
+
+            def write(self, data):
+                self.data += data
+
+            async def drain(self):
+                await self.ready.wait()
+
+        async def scenario():
+            client = AsyncClient('test1', 'pass')
+            client.writer = Writer()
+            sending = asyncio.create_task(client.send(create_message('test1', 'test2', 'text')))
+            await asyncio.sleep(0.05)
+            self.assertFalse(sending.done())
+            self.assertTrue(client.writer.data)
+            client.writer.ready.set()
+            await asyncio.wait_for(sending, 1)
+
+        asyncio.run(scenario())
+
+
+class TestMemoryClientDatabase(unittest.TestCase):
+    def test_contacts_users(self):
+        database = MemoryClientDatabase()
+        database.add_contact('test2')
+        database.add_contact('test2')
+        database.add_users(['test1', 'test2'])
+        self.assertEqual(database.get_contacts(), ['test2'])
+        self.assertTrue(database.check_user('test1'))
+        database.contacts_clear()
+        self.assertEqual(database.get_contacts(), [])
+
+    def test_update_users(self):
+        database = MemoryClientDatabase()
+        database.add_users(['test1', 'test2'], 3)
+        database.update_users(['test3', 'test1'], ['test2'], 5)
+        self.assertEqual(database.get_users(), ['test1', 'test3'])
+        self.assertEqual(database.users_version(), 5)
+
+    def test_pubkeys(self):
+        database = MemoryClientDatabase()
+        self.assertIsNone(database.get_pubkey('test1'))
+        database.save_pubkey('test1', 'key1')
+        database.save_pubkey('test2', 'key2')
+        self.assertEqual(database.get_pubkey('test1'), 'key1')
+        # Недействительный ключ не отдаётся, отпечаток прежнего ключа остаётся
+        database.invalidate_pubkeys(['test1', 'test3'])
+        self.assertIsNone(database.get_pubkey('test1'))
+        self.assertEqual(database.pubkey_fingerprint('test1'), key_fingerprint('key1'))
+        self.assertEqual(database.get_pubkey('test2'), 'key2')
+        database.invalidate_pubkeys()
+        self.assertIsNone(database.get_pubkey('test2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+import sys
+import os
+import errno
+import socket
+import threading
+import unittest
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.getcwd(), '..'))
+
+from common.variables import *
+from common.utils import MessageDecoder, encode_message, decode_message
+from common.errors import ServerError
+from client.core import ClientCore
+
+
+class FakeServer:
+    # Сервер на другой стороне поддельного транспорта: принимает подключения, пока выставлен accepting,
+    # подтверждает сообщения и отвечает пустыми справочниками
+    def __init__(self):
+        self.accepting = threading.Event()
+        self.accepting.set()
+        self.connects = 0
+        self.messages = []
+
+    def answer(self, message):
+        if message[ACTION] == MESSAGE:
+            self.messages.append(message[MESSAGE_TEXT])
+            return {RESPONSE: 200}
+        return {RESPONSE: 202, LIST_INFO: []}
+
+
+class FakeTransport:
+    # Сокет клиента: ответ на запрос готов сразу после отправки. broken - связь оборвалась
+    def __init__(self, server):
+        self.server = server
+        self.answers = deque()
+        self.broken = False
+
+    def send(self, data):
+        if self.broken:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение сброшено.')
+        self.answers.append(encode_message(self.server.answer(decode_message(bytes(data)))))
+        return len(data)
+
+    def recv(self, size):
+        if self.broken:
+            raise ConnectionResetError(errno.ECONNRESET, 'Соединение сброшено.')
+        if not self.answers:
+            raise socket.timeout('Нет данных.')
+        return self.answers.popleft()
+
+    def settimeout(self, timeout):
+        pass
+
+    def close(self):
+        self.broken = True
+
+
+class FakeClient(ClientCore):
+    # Клиент без сети: подключение - новый поддельный транспорт (авторизация не проверяется)
+    reconnect_interval = 0.01
+
+    def __init__(self, server, **callbacks):
+        self.server = server
+        super().__init__(DEFAULT_PORT, '127.0.0.1', None, 'test1', 'pw', pipelining=False, **callbacks)
+
+    def connection_init(self, port, ip, attempts=CONNECT_ATTEMPTS):
+        self.server_address = (ip, port)
+        self.server.connects += 1
+        if not self.server.accepting.wait(0.2):
+            raise ServerError('Не удалось установить соединение с сервером')
+        self.transport = FakeTransport(self.server)
+        self.decoder = MessageDecoder()
+        self.pipelined = False
+        self.connected = True
+
+
+class TestReconnect(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeServer()
+        self.reconnecting = threading.Event()
+        self.reconnected = threading.Event()
+        self.lost = []
+        self.client = FakeClient(self.server, on_reconnecting=self.reconnecting.set,
+                                 on_reconnected=self.reconnected.set,
+                                 on_connection_lost=lambda: self.lost.append(True))
+
+    def tearDown(self):
+        self.client.running = False
+        self.server.accepting.set()
+        self.client.join(5)
+        self.client.executor.shutdown()
+
+    def test_replay_outbox(self):
+        # Сообщения, отправленные без связи, уходят после переподключения по одному разу и по порядку
+        self.server.accepting.clear()
+        self.client.transport.broken = True
+        self.client.start()
+        self.assertTrue(self.reconnecting.wait(5))
+        for text in ('first', 'second', 'third'):
+            self.assertFalse(self.client.send_message('test2', text))
+        self.server.accepting.set()
+        self.assertTrue(self.reconnected.wait(5))
+        self.assertEqual(self.server.messages, ['first', 'second', 'third'])
+        self.assertEqual(len(self.client.outbox), 0)
+        # Очередь пуста - новые сообщения снова уходят сразу
+        self.assertTrue(self.client.send_message('test2', 'fourth'))
+        self.assertEqual(self.server.messages, ['first', 'second', 'third', 'fourth'])
+
+    def test_connection_lost(self):
+        # Попытки переподключения исчерпаны - одно событие connection_lost, поток-приёмник завершается
+        self.client.reconnect_attempts = 3
+        self.server.accepting.clear()
+        self.client.transport.broken = True
+        self.client.start()
+        self.client.join(10)
+        self.assertFalse(self.client.is_alive())
+        self.assertEqual(self.lost, [True])
+        self.assertFalse(self.client.running)
+        # Первое подключение и три попытки
+        self.assertEqual(self.server.connects, 4)
+        # Сообщение без связи остаётся в очереди
+        self.assertFalse(self.client.send_message('test2', 'text'))
+        self.assertEqual(len(self.client.outbox), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
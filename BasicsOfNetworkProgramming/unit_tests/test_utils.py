@@ -5,8 +5,11 @@ import json
 
 sys.path.insert(0, os.path.join(os.getcwd(), '..'))
 
-from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, ACTION, PRESENCE, ENCODING
-from common.utils import send_message, get_message
+from common.variables import RESPONSE, ERROR, USER, ACCOUNT_NAME, TIME, ACTION, PRESENCE, ENCODING, REQUEST_ID, \
+    RESPONSE_400
+from common.utils import send_message, get_message, encode_message, MessageDecoder, FRAME_HEADER, EncodedReply, \
+    REPLY_200, CODECS, JSON_CODEC, choose_codec
+from common.errors import ProtocolError
 
 
 class TestSocket:
@@ -60,5 +63,119 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(get_message(test_sock_error), self.test_dict_recv_error)
 
 
+class TestMessageDecoder(unittest.TestCase):
+    test_dict = {
+        ACTION: PRESENCE,
+        TIME: 111111.111111,
+        USER: {
+            ACCOUNT_NAME: 'test_user'
+        }
+    }
+    test_dict_recv_ok = {
+        RESPONSE: 200
+    }
+    test_dict_recv_error = {
+        RESPONSE: 400,
+        ERROR: 'Bad request'
+    }
+
+    def test_framed_header(self):
+        encoded = encode_message(self.test_dict_recv_ok, framed=True)
+        body = json.dumps(self.test_dict_recv_ok).encode(ENCODING)
+        self.assertEqual(encoded, FRAME_HEADER.pack(len(body)) + body)
+
+    def test_framed_split(self):
+        decoder = MessageDecoder(framed=True)
+        encoded = encode_message(self.test_dict, framed=True)
+        decoder.feed(encoded[:3])
+        self.assertIsNone(decoder.next_message())
+        decoder.feed(encoded[3:10])
+        self.assertIsNone(decoder.next_message())
+        decoder.feed(encoded[10:])
+        self.assertEqual(decoder.next_message(), self.test_dict)
+        self.assertIsNone(decoder.next_message())
+
+    def test_framed_coalesced(self):
+        decoder = MessageDecoder(framed=True)
+        decoder.feed(encode_message(self.test_dict, framed=True) + encode_message(self.test_dict_recv_ok, framed=True))
+        self.assertEqual(list(decoder.messages()), [self.test_dict, self.test_dict_recv_ok])
+
+    def test_framed_too_long(self):
+        decoder = MessageDecoder(framed=True)
+        decoder.feed(FRAME_HEADER.pack(2 ** 31))
+        self.assertRaises(ProtocolError, decoder.next_message)
+
+    def test_legacy_coalesced(self):
+        decoder = MessageDecoder()
+        decoder.feed(encode_message(self.test_dict) + encode_message(self.test_dict_recv_ok))
+        self.assertEqual(list(decoder.messages()), [self.test_dict, self.test_dict_recv_ok])
+
+    def test_legacy_split(self):
+        # Старый формат, пакет разрезан TCP (в том числе внутри строки и многобайтового символа)
+        message = dict(self.test_dict, key='-----BEGIN PUBLIC KEY-----\n\\"ключ\\"\n-----END PUBLIC KEY-----')
+        encoded = json.dumps(message, ensure_ascii=False).encode(ENCODING)
+        for split in range(1, len(encoded)):
+            decoder = MessageDecoder()
+            decoder.feed(encoded[:split])
+            self.assertIsNone(decoder.next_message())
+            decoder.feed(encoded[split:])
+            self.assertEqual(decoder.next_message(), message)
+        decoder = MessageDecoder()
+        decoder.feed(b'{"action": "presence", "ti')
+        self.assertIsNone(decoder.next_message())
+
+    def test_legacy_malformed(self):
+        # Закрытый, но некорректный объект - ошибка, а не ожидание данных
+        decoder = MessageDecoder()
+        decoder.feed(b'{"action": presence}')
+        self.assertRaises(json.JSONDecodeError, decoder.next_message)
+
+    def test_switch_to_framed(self):
+        # Ответ 200 в старом формате и следом пакет уже с заголовком длины в одном recv
+        decoder = MessageDecoder()
+        decoder.feed(encode_message(self.test_dict_recv_ok) + encode_message(self.test_dict, framed=True))
+        self.assertEqual(decoder.next_message(), self.test_dict_recv_ok)
+        decoder.framed = True
+        self.assertEqual(decoder.next_message(), self.test_dict)
+
+    def test_encoded_reply(self):
+        # Готовый ответ совпадает с сериализацией словаря, в том числе с номером запроса
+        self.assertEqual(encode_message(REPLY_200, framed=True), encode_message(self.test_dict_recv_ok, framed=True))
+        reply = EncodedReply(self.test_dict_recv_error)
+        decoder = MessageDecoder(framed=True)
+        decoder.feed(reply.encode(True, 7) + reply.encode(True))
+        self.assertEqual(list(decoder.messages()), [dict(self.test_dict_recv_error, **{REQUEST_ID: 7}),
+                                                    self.test_dict_recv_error])
+        self.assertEqual(json.loads(reply.encode(False, 'a"b')), dict(self.test_dict_recv_error, **{REQUEST_ID: 'a"b'}))
+
+    def test_templates_read_only(self):
+        with self.assertRaises(TypeError):
+            RESPONSE_400[ERROR] = 'Bad request'
+        self.assertIsNone(RESPONSE_400.copy()[ERROR])
+
+
+class TestCodecs(unittest.TestCase):
+    message = {RESPONSE: 200, ERROR: b'\x00\xff'}
+
+    def test_json_bytes(self):
+        # В JSON байты передаются строкой base64
+        self.assertEqual(JSON_CODEC.loads(JSON_CODEC.dumps(self.message)), {RESPONSE: 200, ERROR: 'AP8='})
+
+    def test_choose(self):
+        self.assertIs(choose_codec(['unknown', 'json']), JSON_CODEC)
+        self.assertIs(choose_codec(None), JSON_CODEC)
+        self.assertIs(choose_codec(list(CODECS)), next(iter(CODECS.values())))
+
+    @unittest.skipUnless('msgpack' in CODECS, 'msgpack не установлен')
+    def test_msgpack(self):
+        codec = CODECS['msgpack']
+        decoder = MessageDecoder(framed=True, codec=codec)
+        decoder.feed(encode_message(self.message, True, codec) + REPLY_200.encode(True, 3, codec))
+        self.assertEqual(list(decoder.messages()), [self.message, {RESPONSE: 200, REQUEST_ID: 3}])
+        self.assertEqual(REPLY_200.encode(True, codec=codec), encode_message({RESPONSE: 200}, True, codec))
+        decoder.feed(FRAME_HEADER.pack(1) + b'\xc1')
+        self.assertRaises(ProtocolError, decoder.next_message)
+
+
 if __name__ == '__main__':
     unittest.main()